@@ -0,0 +1,59 @@
+import threading
+import time
+from datetime import datetime
+
+
+class SnapshotCache:
+    """State dump rebuilt at most once every max_age seconds
+
+    Building the dump walks every user and session, so admin requests are
+    served from the last snapshot and only the first request after it goes
+    stale pays for a rebuild. Paging through a section therefore sees one
+    consistent snapshot until it expires.
+    """
+
+    def __init__(self, build, max_age=5.0, clock=time.monotonic):
+        self.build = build
+        self.max_age = max_age
+        self.clock = clock
+        self._snapshot = None
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Current snapshot, rebuilding it if it is older than max_age"""
+        with self._lock:
+            if self._snapshot is None or self.clock() - self._built_at >= self.max_age:
+                self._snapshot = {
+                    'generated_at': datetime.now().isoformat(),
+                    'sections': self.build()
+                }
+                self._built_at = self.clock()
+            return self._snapshot
+
+    def age(self):
+        """Seconds since the snapshot was built, None before the first build"""
+        if self._built_at is None:
+            return None
+        return self.clock() - self._built_at
+
+
+def _matches(item, query):
+    if isinstance(item, dict):
+        return any(query in str(value) for value in item.values())
+    return query in str(item)
+
+
+def paginate(items, offset=0, limit=100, query=None):
+    """One page of items, optionally keeping only those containing query"""
+    if query:
+        items = [item for item in items if _matches(item, query)]
+    page = items[offset:offset + limit]
+    next_offset = offset + len(page)
+    return {
+        'total': len(items),
+        'offset': offset,
+        'limit': limit,
+        'next_offset': next_offset if next_offset < len(items) else None,
+        'items': page
+    }
@@ -1,38 +1,108 @@
 # CRITICAL: Eventlet monkey patch must be the very first import
 import eventlet
 eventlet.monkey_patch()
+from eventlet import tpool, wsgi
+from eventlet.event import Event
 
-from flask import Flask, request, jsonify, session
+from flask import Flask, Response, g, request, jsonify, session
 from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect
 from flask_cors import CORS
-import os
+from werkzeug.middleware.proxy_fix import ProxyFix
+from socketio import RedisManager
+import atexit
+import functools
 import uuid
-import json
 import time
-from datetime import datetime
 import logging
-from collections import defaultdict
-import threading
+from logging_setup import configure_logging, sample_debug
+from admin import SnapshotCache, paginate
+import core
+from core import (ADMIN_PAGE_MAX, ADMIN_SNAPSHOT_TTL, ADMIN_TOKEN, CROSS_SHARD_PAIRS,
+                  EMIT_FAILURES, EMIT_RETRIES, HTTP_DURATION, HTTP_MAX_BODY, JSON_BACKEND,
+                  LONG_POLL_MAX_WAIT, MATCH_ACK_TIMEOUT_MS, MATCH_EMIT_RETRIES, MATCH_MAX_BATCH,
+                  MATCH_RELAX_AFTER, MATCH_TICK_DURATION, MATCH_TICK_INTERVAL,
+                  MAX_HTTP_BUFFER_SIZE, MESSAGE_MAX_CHARS, PAYLOADS_REJECTED, PAYLOAD_LIMITS,
+                  PAYLOAD_LIMIT_DEFAULT, RATE_LIMITED, RATE_LIMITS, READY_TIMEOUT_MS,
+                  REAPER_MAX_BATCH, REAPER_RESOLUTION, REDIS_URL, RESUMES, RESUME_GRACE,
+                  RESUME_TOKEN_MAX_AGE, SECRET_KEY, SHARD_BUS_FRAMES, SHARD_COUNT, SHARD_DIR,
+                  SHARD_FORWARDED, SHARD_INDEX, SHARD_OFFER_AFTER_MS, SIGNALS_RELAYED,
+                  SIGNALS_RELAYED_WEBRTC, SIGNAL_BATCH_MAX, SIGNAL_BATCH_SIZE, SIGNAL_COALESCE_MS,
+                  SOCKETIO_SERIALIZER, SOCKET_DURATION, STATE_BACKEND, TRANSCRIPT_BACKPRESSURE,
+                  TRANSCRIPT_FLUSH_DURATION, TRANSCRIPT_FLUSH_MS, TRANSCRIPT_PERSISTED,
+                  TRANSCRIPT_QUEUE, TRUSTED_PROXY_HOPS, TYPING_EXPIRED, TYPING_EXPIRY, TYPING_MIN_INTERVAL_MS,
+                  TYPING_SUPPRESSED, UserManager, create_rate_limiter, create_state_backend,
+                  create_transcript_sink, parse_tags, update_buffer_gauges, update_state_gauges)
+from limits import PacketSizeGuard
+from matchmaking import Matchmaker
+from metrics import REGISTRY, timed
+from message_log import message_to_dict
+from readiness import ReadinessTracker
+from resume import GracePeriods, ResumeTokens
+from serialization import FastJSONProvider, get_codec
+from sharding import (FORWARDED_ENVIRON_KEY, CrossShardMatcher, EngineIOAffinity, HashRing,
+                      ShardBus, ShardClientManager, ShardSids, forward_http, listen_unix,
+                      mark_forwarded, mint_key)
+from signaling import SignalCoalescer, TypingThrottle
 # requests import not needed for this endpoint
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (levels, queueing and sampling come from LOG_* env vars)
+configure_logging()
 logger = logging.getLogger(__name__)
+match_logger = logging.getLogger('app.matchmaking')
+signal_logger = logging.getLogger('app.signaling')
+# Connection and packet events; this logger is at WARNING unless
+# LOG_LEVELS=transport=INFO (or DEBUG) turns its info messages on
+transport_logger = logging.getLogger('app.transport')
+
+JSON_CODEC = get_codec(JSON_BACKEND)
+logger.info("Encoding JSON with %s", JSON_CODEC.name)
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-change-this'
+app.json = FastJSONProvider(app)
+app.json.codec = JSON_CODEC
+app.config['SECRET_KEY'] = SECRET_KEY
 app.config['CORS_HEADERS'] = 'Content-Type'
+app.config['MAX_CONTENT_LENGTH'] = HTTP_MAX_BODY
+
+# Multi-process sharding (supervisor.py): user and session ids hash to the
+# worker holding them on shard_ring, workers talk over shard_bus
+if SHARD_COUNT > 1:
+    shard_ring = HashRing(range(SHARD_COUNT))
+    shard_bus = ShardBus(
+        SHARD_INDEX, SHARD_COUNT, SHARD_DIR, eventlet.spawn,
+        on_frame=lambda kind, direction: SHARD_BUS_FRAMES.labels(kind, direction).inc(),
+        on_error=lambda kind, e: logger.error("❌ Shard bus %s message failed: %s", kind, e)
+    )
+    logger.info("Running as shard %s of %s", SHARD_INDEX, SHARD_COUNT)
+else:
+    shard_ring = shard_bus = None
+
+def create_client_manager():
+    """Socket.IO client manager that relays emits to rooms on other workers"""
+    if shard_bus is not None:
+        return ShardClientManager(shard_bus, shard_ring.lookup)
+    if STATE_BACKEND == 'redis':
+        # Route emits through Redis so rooms on other workers receive them
+        return RedisManager(REDIS_URL, channel='flask-socketio')
+    return None
 
 # Initialize SocketIO with CORS
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*", 
     async_mode='eventlet',
-    logger=True,
-    engineio_logger=True,
+    # Packets are encoded with the same codec as HTTP responses, or as
+    # msgpack for clients using socket.io-msgpack-parser
+    json=JSON_CODEC,
+    serializer='msgpack' if SOCKETIO_SERIALIZER == 'msgpack' else 'default',
+    client_manager=create_client_manager(),
+    # Packet logs go through the transport subsystem logger (WARNING by default)
+    logger=transport_logger,
+    engineio_logger=transport_logger,
     ping_timeout=60,
     ping_interval=25,
-    max_http_buffer_size=1e8,
+    # Larger WebSocket frames and polling POSTs are refused unread
+    max_http_buffer_size=MAX_HTTP_BUFFER_SIZE,
     allow_upgrades=True,
     transports=['websocket', 'polling'],
     always_connect=True,
@@ -42,243 +112,413 @@ socketio = SocketIO(
     reconnection_delay=1000
 )
 CORS(app, origins="*")
+if TRUSTED_PROXY_HOPS:
+    # request.remote_addr (rate limits) is the client the proxies saw
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 
-# Global state management
-class UserManager:
-    def __init__(self):
-        # Room management for Omegle-like functionality
-        self.active_users = set()  # All users who are online
-        self.connected_users = set()  # Users currently in chat sessions
-        self.waiting_rooms = {
-            'video': [],  # Users waiting for video chat
-            'text': []    # Users waiting for text chat
-        }
-        self.active_sessions = {}  # session_id -> ChatSession
-        self.user_sessions = {}  # user_id -> session_id
-        self.socket_user_map = {}  # socket_id -> user_id
-        self.user_rooms = {}  # user_id -> room_id
-        self.lock = threading.Lock()
-    
-    def add_active_user(self, user_id):
-        """Add user to active users (online)"""
-        with self.lock:
-            self.active_users.add(user_id)
-            logger.info(f"User {user_id} added to active users")
-    
-    def remove_active_user(self, user_id):
-        """Remove user from active users"""
-        with self.lock:
-            self.active_users.discard(user_id)
-            logger.info(f"User {user_id} removed from active users")
-    
-    def add_waiting_user(self, user_id, chat_type):
-        """Add user to waiting room"""
-        with self.lock:
-            if user_id not in self.waiting_rooms[chat_type]:
-                self.waiting_rooms[chat_type].append(user_id)
-                logger.info(f"User {user_id} added to {chat_type} waiting room")
-                return True
-            return False
-    
-    def get_waiting_partner(self, chat_type, exclude_user_id=None):
-        """Get next waiting user for matching"""
-        with self.lock:
-            if self.waiting_rooms[chat_type]:
-                # Get the first user that's not the excluded user
-                for i, user_id in enumerate(self.waiting_rooms[chat_type]):
-                    if user_id != exclude_user_id:
-                        partner = self.waiting_rooms[chat_type].pop(i)
-                        logger.info(f"🔍 Found partner {partner} for {exclude_user_id} (excluded {exclude_user_id})")
-                        return partner
-                # If no other user found, return None
-                logger.info(f"⚠️ No partner found for {exclude_user_id} in {chat_type} waiting room")
-                return None
-            return None
-    
-    def add_connected_user(self, user_id):
-        """Add user to connected users (in chat session)"""
-        with self.lock:
-            self.connected_users.add(user_id)
-            logger.info(f"User {user_id} added to connected users")
-    
-    def remove_connected_user(self, user_id):
-        """Remove user from connected users"""
-        with self.lock:
-            self.connected_users.discard(user_id)
-            # Remove from waiting rooms
-            for chat_type in ['video', 'text']:
-                if user_id in self.waiting_rooms[chat_type]:
-                    self.waiting_rooms[chat_type].remove(user_id)
-                    logger.info(f"Removed {user_id} from {chat_type} waiting room")
-            logger.info(f"User {user_id} removed from connected users")
-    
-    def create_session(self, user1_id, user2_id, chat_type):
-        """Create a new chat session"""
-        session_id = str(uuid.uuid4())
-        chat_session = ChatSession(session_id, user1_id, user2_id, chat_type)
-        
-        with self.lock:
-            self.active_sessions[session_id] = chat_session
-            self.user_sessions[user1_id] = session_id
-            self.user_sessions[user2_id] = session_id
-            
-            # Add both users to connected users
-            self.add_connected_user(user1_id)
-            self.add_connected_user(user2_id)
-        
-        logger.info(f"Created session {session_id} between {user1_id} and {user2_id}")
-        return chat_session
-    
-    def get_user_session(self, user_id):
-        """Get session for a user"""
-        return self.user_sessions.get(user_id)
-    
-    def get_session(self, session_id):
-        """Get session by ID"""
-        return self.active_sessions.get(session_id)
-    
-    def remove_session(self, session_id):
-        """Remove a session and clean up"""
-        with self.lock:
-            session = self.active_sessions.pop(session_id, None)
-            if session:
-                self.user_sessions.pop(session.user1_id, None)
-                self.user_sessions.pop(session.user2_id, None)
-                logger.info(f"Removed session {session_id}")
-            return session
-    
+# Per-event size limits, checked on the raw packet before it is decoded
+PacketSizeGuard(
+    PAYLOAD_LIMITS, PAYLOAD_LIMIT_DEFAULT,
+    on_rejected=lambda name, size: PAYLOADS_REJECTED.labels(name, 'packet').inc()
+).install(socketio.server.eio)
 
+if shard_bus is not None:
+    # Engine.IO sids name their worker, so polling requests and WebSocket
+    # upgrades the kernel hands to another worker are passed on to it
+    shard_sids = ShardSids(SECRET_KEY, SHARD_INDEX)
+    generate_sid = socketio.server.eio.generate_id
+    socketio.server.eio.generate_id = lambda: shard_sids.sign(generate_sid())
+    app.wsgi_app = EngineIOAffinity(
+        app.wsgi_app, shard_sids, functools.partial(shard_bus.path, name='http'), eventlet.spawn,
+        on_forward=lambda kind: SHARD_FORWARDED.labels('/socket.io/' + kind).inc(),
+        resume_owner=lambda token: resume_shard(token)
+    )
+
+def resume_shard(token):
+    """Worker owning the user a resume token was issued for, None if invalid"""
+    user_id = resume_tokens.user_id(token)
+    return shard_ring.lookup(user_id) if user_id is not None else None
+
+# Global state management, shared with the asyncio runtime through core.py
+class ChatSession(core.ChatSession):
+    __slots__ = ()
     
-    def get_waiting_count(self, chat_type):
-        """Get number of waiting users"""
-        return len(self.waiting_rooms[chat_type])
+    def wait_for_update(self, timeout):
+        """Park until a message arrives, the session closes or timeout expires"""
+        if self._update is None:
+            self._update = Event()
+        update = self._update
+        with eventlet.Timeout(timeout, False):
+            update.wait()
     
-    def get_active_sessions_count(self):
-        """Get number of active sessions"""
-        return len(self.active_sessions)
+    @staticmethod
+    def _wake(update):
+        update.send()
+
+def mint_user_id():
+    """Fresh user_id, one that hashes to this worker when sharded"""
+    return mint_key(shard_ring, SHARD_INDEX) if shard_ring else str(uuid.uuid4())
 
 # Initialize user manager
-user_manager = UserManager()
-
-class ChatSession:
-    def __init__(self, session_id, user1_id, user2_id, chat_type):
-        self.session_id = session_id
-        self.user1_id = user1_id
-        self.user2_id = user2_id
-        self.chat_type = chat_type
-        self.messages = []
-        self.created_at = datetime.now()
-        self.is_active = True
-        self.last_activity = datetime.now()
-        
-    def add_message(self, user_id, message):
-        """Add a message to the session"""
-        msg = {
-            'id': str(uuid.uuid4()),
-            'from': 'you' if user_id == self.user1_id else 'stranger',
-            'text': message,
-            'timestamp': datetime.now().isoformat()
-        }
-        self.messages.append(msg)
-        self.last_activity = datetime.now()
-        return msg
-    
-    def get_messages(self, since_timestamp=None):
-        """Get messages since a timestamp"""
-        if since_timestamp:
-            return [msg for msg in self.messages if msg['timestamp'] > since_timestamp]
-        return self.messages
-    
-    def get_partner_id(self, user_id):
-        """Get partner's user ID"""
-        return self.user2_id if user_id == self.user1_id else self.user1_id
-    
-    def is_user_in_session(self, user_id):
-        """Check if user is part of this session"""
-        return user_id in [self.user1_id, self.user2_id]
+user_manager = UserManager(create_state_backend(
+    ChatSession,
+    new_session_id=functools.partial(mint_key, shard_ring, SHARD_INDEX) if shard_ring else None
+))
+
+if STATE_BACKEND == 'redis':
+    # Wakes long-polls for messages sent through other workers and drops
+    # sessions they ended
+    eventlet.spawn(user_manager.state.listen)
+
+rate_limiter = create_rate_limiter()
+
+# Optional transcript store, fed by ChatSession.add_message
+transcript_sink = create_transcript_sink()
+ChatSession.transcripts = transcript_sink
+
+def emit_to_client(event, payload, to, callback=None):
+    socketio.emit(event, payload, to=to, callback=callback)
+
+def match_delivery_failed(event, user_id):
+    EMIT_FAILURES.labels(event).inc()
+    match_logger.warning("No ack for %s from %s after %s retries", event, user_id, MATCH_EMIT_RETRIES)
+
+# Sends matched events as soon as each client has acknowledged user_id
+readiness = ReadinessTracker(
+    emit_to_client,
+    eventlet.spawn_after,
+    ready_timeout=READY_TIMEOUT_MS / 1000.0,
+    ack_timeout=MATCH_ACK_TIMEOUT_MS / 1000.0,
+    retries=MATCH_EMIT_RETRIES,
+    on_retry=lambda event: EMIT_RETRIES.labels(event).inc(),
+    on_failed=match_delivery_failed
+)
+
+resume_tokens = ResumeTokens(SECRET_KEY, max_age=RESUME_TOKEN_MAX_AGE)
+
+def user_id_payload(user_id, **extra):
+    """user_id event body, with the token the client presents to resume"""
+    return dict(extra, user_id=user_id, resume_token=resume_tokens.issue(user_id))
+
+def grace_expired(user_id, sid):
+    """Tear the user down unless it resumed, possibly on another worker"""
+    if user_manager.release_user_socket(user_id, sid):
+        RESUMES.labels('expired').inc()
+        end_user(user_id)
+
+# Deferred teardown of users whose socket dropped
+grace_periods = GracePeriods(RESUME_GRACE, eventlet.spawn_after, grace_expired)
+
+def rate_limited(event):
+    """Decorator dropping Socket.IO events a socket sends over its quota"""
+    limited = RATE_LIMITED.labels(event, 'sid')
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not rate_limiter.allow(event, 'sid', request.sid):
+                limited.inc()
+                return None
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def collect_state_gauges():
+    """Refresh state gauges from the O(1) counters, runs on each scrape"""
+    update_state_gauges(user_manager, grace_periods)
+
+REGISTRY.add_collector(collect_state_gauges)
+REGISTRY.add_collector(lambda: update_buffer_gauges(socketio.server.eio.sockets))
 
 def cleanup_inactive_sessions():
-    """Clean up inactive sessions periodically"""
-    current_time = datetime.now()
-    inactive_sessions = []
-    
-    for session_id, session in user_manager.active_sessions.items():
-        # Remove sessions inactive for more than 30 minutes
-        if (current_time - session.last_activity).total_seconds() > 1800:
-            inactive_sessions.append(session_id)
-    
-    for session_id in inactive_sessions:
-        session = user_manager.remove_session(session_id)
+    """End sessions whose inactivity deadline has passed"""
+    ended = []
+    for expired in user_manager.reaper.pop_expired(REAPER_MAX_BATCH):
+        session = user_manager.remove_session(expired.session_id, 'inactivity')
         if session:
-            # Notify both users that session ended
-            socketio.emit('session_ended', {
-                'session_id': session_id,
-                'reason': 'inactivity'
-            }, room=session.user1_id)
+            ended.append(session)
+    
+    # Notify both users of every ended session in one pass
+    for session in ended:
+        for user_id in (session.user1_id, session.user2_id):
             socketio.emit('session_ended', {
-                'session_id': session_id,
+                'session_id': session.session_id,
                 'reason': 'inactivity'
-            }, room=session.user2_id)
-            logger.info(f"Cleaned up inactive session: {session_id}")
+            }, room=user_id)
+    if ended:
+        logger.info("Cleaned up %s inactive sessions", len(ended))
 
 # Start cleanup thread
 def start_cleanup_thread():
     while True:
-        eventlet.sleep(300)  # Run every 5 minutes
-        cleanup_inactive_sessions()
+        eventlet.sleep(REAPER_RESOLUTION)
+        try:
+            cleanup_inactive_sessions()
+            rate_limiter.sweep()
+        except Exception as e:
+            logger.error("❌ Error cleaning up inactive sessions: %s", e)
 
 # Use eventlet greenthread instead of threading
 eventlet.spawn(start_cleanup_thread)
 
+# Transcript writer: batches are written on eventlet's OS thread pool, so
+# disk I/O never blocks the hub
+transcript_writer_stop = Event()
+
+def start_transcript_writer():
+    while not transcript_writer_stop.ready():
+        eventlet.sleep(TRANSCRIPT_FLUSH_MS / 1000.0)
+        try:
+            while transcript_sink.pending:
+                started = time.perf_counter()
+                TRANSCRIPT_PERSISTED.inc(tpool.execute(transcript_sink.flush))
+                TRANSCRIPT_FLUSH_DURATION.observe(time.perf_counter() - started)
+        except Exception as e:
+            logger.error("❌ Error writing transcripts: %s", e)
+
+def close_transcripts(writer):
+    """Let the writer finish its batch and exit, then write the rest"""
+    transcript_writer_stop.send()
+    writer.wait()
+    transcript_sink.close()
+
+if transcript_sink is not None:
+    REGISTRY.add_collector(lambda: TRANSCRIPT_QUEUE.set(transcript_sink.pending))
+    atexit.register(close_transcripts, eventlet.spawn(start_transcript_writer))
+
+def deliver_matched(chat_session, user_id):
+    """Send one user of a new session its matched event"""
+    try:
+        readiness.deliver(user_id, 'matched', {
+            'session_id': chat_session.session_id,
+            'chat_type': chat_session.chat_type,
+            'partner_id': chat_session.get_partner_id(user_id),
+            'is_initiator': user_id == chat_session.initiator_id
+        })
+    except Exception as e:
+        EMIT_FAILURES.labels('matched').inc()
+        match_logger.error("❌ Failed to emit matched event to %s: %s", user_id, e)
+
+def emit_matched_sessions(sessions):
+    """Notify both users of every newly created session"""
+    for chat_session in sessions:
+        deliver_matched(chat_session, chat_session.user1_id)
+        deliver_matched(chat_session, chat_session.user2_id)
+
+matchmaker = Matchmaker(
+    user_manager,
+    emit_matched_sessions,
+    tick_interval=MATCH_TICK_INTERVAL,
+    max_batch=MATCH_MAX_BATCH
+)
+
+def deliver_cross_shard_match(chat_session, user_ids):
+    """Matched events for this worker's users of a session paired across shards"""
+    for user_id in user_ids:
+        deliver_matched(chat_session, user_id)
+
+def cross_shard_pair_failed(chat_session):
+    """The other shard's user was gone by the time the pair arrived"""
+    for user_id in (chat_session.user1_id, chat_session.user2_id):
+        if shard_ring.lookup(user_id) == SHARD_INDEX:
+            socketio.emit('partner_disconnected', {
+                'session_id': chat_session.session_id,
+                'reason': 'partner_disconnected'
+            }, room=user_id)
+
+# Users left unmatched on their own shard are paired across shards
+cross_shard = CrossShardMatcher(
+    user_manager,
+    shard_bus,
+    shard_ring,
+    deliver_cross_shard_match,
+    cross_shard_pair_failed,
+    offer_after=SHARD_OFFER_AFTER_MS / 1000.0,
+    relax_after=MATCH_RELAX_AFTER,
+    max_batch=MATCH_MAX_BATCH,
+    on_pair=lambda cross: CROSS_SHARD_PAIRS.labels('cross_shard' if cross else 'same_shard').inc()
+) if shard_bus is not None else None
+
+# Single matchmaking loop instead of a greenlet per connect
+def start_matchmaker_thread():
+    while True:
+        eventlet.sleep(matchmaker.tick_interval)
+        try:
+            started = time.perf_counter()
+            matchmaker.tick()
+            if cross_shard is not None:
+                cross_shard.tick()
+            MATCH_TICK_DURATION.observe(time.perf_counter() - started)
+        except Exception as e:
+            match_logger.error("❌ Error in matchmaker tick: %s", e)
+
+eventlet.spawn(start_matchmaker_thread)
+
+admin_snapshot = SnapshotCache(user_manager.admin_sections, ADMIN_SNAPSHOT_TTL)
+
 @app.route('/')
 def health_check():
-    """Health check endpoint"""
+    """Health check endpoint, O(1): counters only, no state dump"""
+    counts = user_manager.get_counts()
     return jsonify({
         'status': 'healthy', 
         'message': 'Video Chat Backend is running - UPDATED',
-        'rooms': {
-            'active_users': len(user_manager.active_users),
-            'connected_users': len(user_manager.connected_users),
-            'waiting_video': len(user_manager.waiting_rooms['video']),
-            'waiting_text': len(user_manager.waiting_rooms['text'])
-        },
-        'active_sessions': user_manager.get_active_sessions_count(),
-        'debug_info': {
-            'active_users': list(user_manager.active_users),
-            'connected_users': list(user_manager.connected_users),
-            'waiting_rooms': user_manager.waiting_rooms,
-            'user_sessions': user_manager.user_sessions,
-            'active_session_ids': list(user_manager.active_sessions.keys())
-        }
+        'rooms': counts,
+        'active_sessions': counts['active_sessions'],
+        'matchmaker': matchmaker.stats()
     })
 
+@app.route('/health/live')
+def liveness_check():
+    """Liveness probe, answers as long as the process serves requests"""
+    return jsonify({'status': 'alive'})
+
+@app.route('/health/ready')
+def readiness_check():
+    """Readiness probe, fails if state is unreachable or matching has stalled"""
+    try:
+        counts = user_manager.get_counts()
+    except Exception as e:
+        logger.error("Readiness check could not read state: %s", e)
+        return jsonify({'status': 'unavailable', 'error': 'state backend unreachable'}), 503
+    if matchmaker.is_stalled():
+        return jsonify({'status': 'unavailable', 'error': 'matchmaker stalled', 'counts': counts}), 503
+    return jsonify({'status': 'ready', 'counts': counts})
+
+@app.route('/metrics')
+def metrics_view():
+    """Metrics in the Prometheus text exposition format"""
+    return Response(REGISTRY.render(), content_type=REGISTRY.CONTENT_TYPE)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.errorhandler(413)
+def body_too_large(error):
+    """Count and answer bodies Flask refused for MAX_CONTENT_LENGTH"""
+    PAYLOADS_REJECTED.labels('http', 'body').inc()
+    return jsonify({'error': 'Request body too large'}), 413
+
+@app.before_request
+def enforce_rate_limits():
+    """Reject requests over their route's per-IP or per-user quota
+
+    Runs before the handler, so excess traffic never reaches UserManager.
+    The per-user quota is the resume token's user (X-Resume-Token); requests
+    without a valid token share a bucket with everyone on their IP.
+    """
+    if request.url_rule is None:
+        return None
+    route = request.url_rule.rule
+    # A forwarded request was checked against its IP on the first worker
+    if (not request.environ.get(FORWARDED_ENVIRON_KEY)
+            and not rate_limiter.allow(route, 'ip', request.remote_addr)):
+        RATE_LIMITED.labels(route, 'ip').inc()
+        return jsonify({'error': 'Rate limit exceeded'}), 429
+    if (route, 'user') in RATE_LIMITS:
+        # The user quota is keyed on the user a resume token was signed for;
+        # a user_id from the body or X-User-ID could name anybody, so
+        # requests without a valid token share one user bucket per IP
+        user_id = resume_tokens.user_id(request.headers.get('X-Resume-Token'))
+        if user_id is None:
+            if request.environ.get(FORWARDED_ENVIRON_KEY):
+                return None  # Counted against its IP on the first worker
+            user_id = f'anonymous@{request.remote_addr}'
+        if not rate_limiter.allow(route, 'user', user_id):
+            RATE_LIMITED.labels(route, 'user').inc()
+            return jsonify({'error': 'Rate limit exceeded'}), 429
+    return None
+
+# REST routes served by the worker owning the request's session or user
+SHARDED_ROUTES = frozenset(('/start', '/start_video', '/send', '/receive', '/disconnect'))
+
+@app.before_request
+def forward_to_owner_shard():
+    """Replay REST calls for another shard's session or user on its worker
+
+    The kernel hands each connection to any worker; only the owner of the
+    body's session_id (else of the user_id) holds the state to answer.
+    """
+    if (shard_ring is None or request.url_rule is None
+            or request.url_rule.rule not in SHARDED_ROUTES
+            or request.environ.get(FORWARDED_ENVIRON_KEY)):
+        return None
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    key = (data.get('session_id') or data.get('user_id')
+           or request.headers.get('X-User-ID') or request.args.get('user_id'))
+    if not isinstance(key, str) or shard_ring.lookup(key) == SHARD_INDEX:
+        return None  # Ours, or invalid and rejected by the handler
+    owner = shard_ring.lookup(key)
+    SHARD_FORWARDED.labels(request.url_rule.rule).inc()
+    try:
+        status, headers, body = forward_http(
+            shard_bus.path(owner, 'http'), request.method, request.full_path,
+            request.headers.items(), request.get_data(), LONG_POLL_MAX_WAIT + 10)
+    except OSError as e:
+        logger.error("❌ Could not forward %s to shard %s: %s", request.path, owner, e)
+        return jsonify({'error': 'Shard unavailable'}), 503
+    return Response(body, status=status, headers=headers)
+
+@app.after_request
+def record_request_duration(response):
+    """Observe handler duration per route, method and status"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Route pattern rather than the raw path keeps label cardinality bounded
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_DURATION.labels(endpoint, request.method, str(response.status_code)).observe(
+            time.perf_counter() - started)
+    return response
+
+@app.route('/admin/snapshot')
+def admin_snapshot_view():
+    """Paginated, filterable state dump served from a cached snapshot"""
+    try:
+        if ADMIN_TOKEN and request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+            return jsonify({'error': 'Forbidden'}), 403
+        
+        snapshot = admin_snapshot.get()
+        sections = snapshot['sections']
+        section = request.args.get('section')
+        if not section:
+            # No section asked for, just list the sections and their sizes
+            return jsonify({
+                'generated_at': snapshot['generated_at'],
+                'sections': {name: len(items) for name, items in sections.items()}
+            })
+        if section not in sections:
+            return jsonify({'error': f'Unknown section, expected one of {sorted(sections)}'}), 400
+        
+        try:
+            offset = max(0, int(request.args.get('offset', 0)))
+            limit = min(ADMIN_PAGE_MAX, max(1, int(request.args.get('limit', 100))))
+        except ValueError:
+            return jsonify({'error': 'offset and limit must be integers'}), 400
+        
+        page = paginate(sections[section], offset, limit, request.args.get('q'))
+        page['section'] = section
+        page['generated_at'] = snapshot['generated_at']
+        return jsonify(page)
+    except Exception as e:
+        logger.error("Error in admin_snapshot: %s", e)
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/force_match', methods=['POST'])
 def force_match():
     """Force match two waiting users for testing"""
     try:
         # Get two users from waiting room
-        waiting_users = user_manager.waiting_rooms['video']
-        if len(waiting_users) >= 2:
-            user1 = waiting_users.pop(0)
-            user2 = waiting_users.pop(0)
-            
-            # Create session
-            chat_session = user_manager.create_session(user1, user2, 'video')
+        waiting_count = user_manager.get_waiting_count('video')
+        sessions = user_manager.match_waiting_users('video', 1)
+        if sessions:
+            chat_session = sessions[0]
+            user1 = chat_session.user1_id
+            user2 = chat_session.user2_id
             
             # Emit matched events
-            socketio.emit('matched', {
-                'session_id': chat_session.session_id,
-                'chat_type': 'video',
-                'partner_id': user2,
-                'is_initiator': True
-            }, room=user1)
-            
-            socketio.emit('matched', {
-                'session_id': chat_session.session_id,
-                'chat_type': 'video',
-                'partner_id': user1,
-                'is_initiator': False
-            }, room=user2)
+            emit_matched_sessions(sessions)
             
             return jsonify({
                 'success': True,
@@ -289,10 +529,10 @@ def force_match():
         else:
             return jsonify({
                 'success': False,
-                'message': f'Not enough users waiting. Need 2, have {len(waiting_users)}'
+                'message': f'Not enough users waiting. Need 2, have {waiting_count}'
             })
     except Exception as e:
-        logger.error(f"Error in force_match: {str(e)}")
+        match_logger.error("Error in force_match: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/test_emit', methods=['POST'])
@@ -304,18 +544,18 @@ def test_emit():
         test_message = data.get('message', 'test')
         
         if socket_id:
-            logger.info(f"Testing emit to socket {socket_id}")
+            transport_logger.info("Testing emit to socket %s", socket_id)
             try:
                 emit('test_event', {'message': test_message}, room=socket_id)
-                logger.info(f"✅ Test emit successful to {socket_id}")
+                transport_logger.info("✅ Test emit successful to %s", socket_id)
                 return jsonify({'success': True, 'message': 'Test emit sent'})
             except Exception as e:
-                logger.error(f"❌ Test emit failed: {str(e)}")
+                transport_logger.error("❌ Test emit failed: %s", e)
                 return jsonify({'success': False, 'error': str(e)}), 500
         else:
             return jsonify({'success': False, 'error': 'No socket_id provided'}), 400
     except Exception as e:
-        logger.error(f"Error in test_emit: {str(e)}")
+        transport_logger.error("Error in test_emit: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/auto_match_all', methods=['POST'])
@@ -323,11 +563,11 @@ def auto_match_all():
     """Automatically match all active users who are not in sessions"""
     try:
         # Get all active users who are not in sessions
-        active_users = list(user_manager.active_users)
-        sessioned_users = set(user_manager.user_sessions.keys())
+        active_users = user_manager.get_active_users()
+        sessioned_users = set(user_manager.state.user_session_items())
         available_users = [user for user in active_users if user not in sessioned_users]
         
-        logger.info(f"Auto matching: {len(available_users)} available users out of {len(active_users)} active users")
+        match_logger.info("Auto matching: %s available users out of %s active users", len(available_users), len(active_users))
         
         matched_pairs = []
         
@@ -338,21 +578,23 @@ def auto_match_all():
             
             # Create session
             chat_session = user_manager.create_session(user1, user2, 'video')
+            if chat_session is None:
+                continue
             
             # Emit matched events
-            socketio.emit('matched', {
+            readiness.deliver(user1, 'matched', {
                 'session_id': chat_session.session_id,
                 'chat_type': 'video',
                 'partner_id': user2,
-                'is_initiator': True
-            }, room=user1)
+                'is_initiator': user1 == chat_session.initiator_id
+            })
             
-            socketio.emit('matched', {
+            readiness.deliver(user2, 'matched', {
                 'session_id': chat_session.session_id,
                 'chat_type': 'video',
                 'partner_id': user1,
-                'is_initiator': False
-            }, room=user2)
+                'is_initiator': user2 == chat_session.initiator_id
+            })
             
             matched_pairs.append({
                 'session_id': chat_session.session_id,
@@ -360,7 +602,7 @@ def auto_match_all():
                 'user2': user2
             })
             
-            logger.info(f"Auto matched: {user1} with {user2} in session {chat_session.session_id}")
+            match_logger.info("Auto matched: %s with %s in session %s", user1, user2, chat_session.session_id)
         
         return jsonify({
             'success': True,
@@ -370,38 +612,38 @@ def auto_match_all():
         })
         
     except Exception as e:
-        logger.error(f"Error in auto_match_all: {str(e)}")
+        match_logger.error("Error in auto_match_all: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/trigger_auto_match', methods=['POST'])
 def trigger_auto_match():
     """Manually trigger auto-match for all active users"""
     try:
-        logger.info("🔧 Manual auto-match trigger requested")
+        match_logger.info("🔧 Manual auto-match trigger requested")
         
         # Get all active users who are not in sessions
-        active_users = list(user_manager.active_users)
-        sessioned_users = set(user_manager.user_sessions.keys())
+        active_users = user_manager.get_active_users()
+        sessioned_users = set(user_manager.state.user_session_items())
         available_users = [user for user in active_users if user not in sessioned_users]
         
-        logger.info(f"📊 Available users for auto-match: {available_users}")
+        match_logger.info("📊 Available users for auto-match: %s", available_users)
         
         matched_count = 0
         
         # Process each available user
         for user_id in available_users:
             try:
-                logger.info(f"🔍 Processing user {user_id} for auto-match")
+                match_logger.info("🔍 Processing user %s for auto-match", user_id)
                 auto_match_user(user_id)
                 matched_count += 1
             except Exception as e:
-                logger.error(f"❌ Error processing user {user_id}: {str(e)}")
+                match_logger.error("❌ Error processing user %s: %s", user_id, e)
         
         # Check final status by accessing user_manager directly
         final_status = {
-            'active_users': len(user_manager.active_users),
-            'waiting_video': len(user_manager.waiting_rooms['video']),
-            'active_sessions': len(user_manager.active_sessions)
+            'active_users': user_manager.get_counts()['active_users'],
+            'waiting_video': user_manager.get_waiting_count('video'),
+            'active_sessions': user_manager.get_active_sessions_count()
         }
 
         return jsonify({
@@ -412,7 +654,7 @@ def trigger_auto_match():
         })
         
     except Exception as e:
-        logger.error(f"Error in trigger_auto_match: {str(e)}")
+        match_logger.error("Error in trigger_auto_match: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -426,30 +668,30 @@ def start_text_chat():
             return jsonify({'error': 'User ID required'}), 400
         
         # Verify user is active (connected via WebSocket)
-        if user_id not in user_manager.active_users:
+        if not user_manager.is_active_user(user_id):
             return jsonify({'error': 'User not connected via WebSocket'}), 400
         
-        # Check if there's a waiting user
-        partner_id = user_manager.get_waiting_partner('text')
+        # Match with a waiting user, if there is one
+        tags = request_tags(request.get_json(silent=True))
+        chat_session = user_manager.match_with_waiting_partner(user_id, 'text', tags)
         
-        if partner_id:
-            # Match with waiting user
-            chat_session = user_manager.create_session(user_id, partner_id, 'text')
+        if chat_session:
+            partner_id = chat_session.user2_id
             
             # Notify both users
-            socketio.emit('matched', {
+            readiness.deliver(user_id, 'matched', {
                 'session_id': chat_session.session_id,
                 'chat_type': 'text',
                 'partner_id': partner_id
-            }, room=user_id)
+            })
             
-            socketio.emit('matched', {
+            readiness.deliver(partner_id, 'matched', {
                 'session_id': chat_session.session_id,
                 'chat_type': 'text',
                 'partner_id': user_id
-            }, room=partner_id)
+            })
             
-            logger.info(f"Text chat matched: {user_id} with {partner_id}")
+            match_logger.info("Text chat matched: %s with %s", user_id, partner_id)
             
             return jsonify({
                 'session_id': chat_session.session_id,
@@ -458,8 +700,8 @@ def start_text_chat():
             })
         else:
             # Add to waiting list
-            user_manager.add_waiting_user(user_id, 'text')
-            logger.info(f"User {user_id} waiting for text chat")
+            user_manager.add_waiting_user(user_id, 'text', tags)
+            match_logger.info("User %s waiting for text chat", user_id)
             
             return jsonify({
                 'session_id': None,
@@ -467,7 +709,7 @@ def start_text_chat():
             })
         
     except Exception as e:
-        logger.error(f"Error starting text chat: {str(e)}")
+        match_logger.error("Error starting text chat: %s", e)
         return jsonify({'error': 'Failed to start chat'}), 500
 
 @app.route('/start_video', methods=['POST'])
@@ -478,24 +720,25 @@ def start_video_chat():
         data = request.get_json() or {}
         user_id = data.get('user_id') or request.headers.get('X-User-ID') or request.args.get('user_id')
         
-        logger.info(f"Received video chat request - Body: {data}, Headers: {dict(request.headers)}, Args: {dict(request.args)}, user_id: {user_id}")
+        match_logger.debug("Received video chat request - Body: %s, Args: %s, user_id: %s", data, request.args, user_id)
         
         if not user_id:
-            logger.error("No user_id provided in request")
+            match_logger.error("No user_id provided in request")
             return jsonify({'error': 'User ID required'}), 400
         
         # Verify user is active (connected via WebSocket)
-        logger.info(f"Checking if user {user_id} is in active_users: {user_id in user_manager.active_users}")
-        logger.info(f"Active users: {list(user_manager.active_users)}")
+        is_active = user_manager.is_active_user(user_id)
+        match_logger.debug("Checking if user %s is in active_users: %s", user_id, is_active)
+        sample_debug(match_logger, "Active users: %s", user_manager.get_active_users)
         
-        if user_id not in user_manager.active_users:
-            logger.error(f"User {user_id} not found in active_users")
+        if not is_active:
+            match_logger.error("User %s not found in active_users", user_id)
             return jsonify({'error': 'User not connected via WebSocket'}), 400
         
         # Check if user is already in a session
         existing_session_id = user_manager.get_user_session(user_id)
         if existing_session_id:
-            logger.info(f"User {user_id} already in session {existing_session_id}")
+            match_logger.info("User %s already in session %s", user_id, existing_session_id)
             chat_session = user_manager.get_session(existing_session_id)
             if chat_session:
                 partner_id = chat_session.get_partner_id(user_id)
@@ -505,44 +748,43 @@ def start_video_chat():
                     'partner_id': partner_id
                 })
         
-        # Check if there's a waiting user
-        partner_id = user_manager.get_waiting_partner('video', exclude_user_id=user_id)
-        logger.info(f"Video chat request from {user_id}, waiting users: {user_manager.waiting_rooms['video']}, partner_id: {partner_id}")
+        # Match with a waiting user, if there is one
+        tags = request_tags(data)
+        chat_session = user_manager.match_with_waiting_partner(user_id, 'video', tags)
+        match_logger.debug("Video chat request from %s, matched: %s", user_id, chat_session is not None)
         
-        if partner_id and partner_id != user_id:
-            # Match with waiting user
-            logger.info(f"Creating session between {user_id} and {partner_id}")
-            chat_session = user_manager.create_session(user_id, partner_id, 'video')
+        if chat_session:
+            partner_id = chat_session.user2_id
             
-            # Add a small delay to ensure both users are ready
-            eventlet.sleep(0.5)
-            
-            # Notify both users
-            logger.info(f"Emitting matched event to {user_id} with session {chat_session.session_id}")
+            # Notify both users, held by readiness until each one has
+            # acknowledged its user_id
+            match_logger.info("Emitting matched event to %s with session %s", user_id, chat_session.session_id)
             try:
-                socketio.emit('matched', {
+                readiness.deliver(user_id, 'matched', {
                     'session_id': chat_session.session_id,
                     'chat_type': 'video',
                     'partner_id': partner_id,
-                    'is_initiator': False  # The user who just joined is not the initiator
-                }, room=user_id)
-                logger.info(f"✅ Successfully emitted matched event to {user_id}")
+                    'is_initiator': user_id == chat_session.initiator_id
+                })
+                match_logger.debug("✅ Successfully emitted matched event to %s", user_id)
             except Exception as e:
-                logger.error(f"❌ Failed to emit matched event to {user_id}: {str(e)}")
+                EMIT_FAILURES.labels('matched').inc()
+                match_logger.error("❌ Failed to emit matched event to %s: %s", user_id, e)
             
-            logger.info(f"Emitting matched event to {partner_id} with session {chat_session.session_id}")
+            match_logger.info("Emitting matched event to %s with session %s", partner_id, chat_session.session_id)
             try:
-                socketio.emit('matched', {
+                readiness.deliver(partner_id, 'matched', {
                     'session_id': chat_session.session_id,
                     'chat_type': 'video',
                     'partner_id': user_id,
-                    'is_initiator': True  # The user who was waiting is the initiator
-                }, room=partner_id)
-                logger.info(f"✅ Successfully emitted matched event to {partner_id}")
+                    'is_initiator': partner_id == chat_session.initiator_id
+                })
+                match_logger.debug("✅ Successfully emitted matched event to %s", partner_id)
             except Exception as e:
-                logger.error(f"❌ Failed to emit matched event to {partner_id}: {str(e)}")
+                EMIT_FAILURES.labels('matched').inc()
+                match_logger.error("❌ Failed to emit matched event to %s: %s", partner_id, e)
             
-            logger.info(f"Video chat matched: {user_id} with {partner_id}, session: {chat_session.session_id}")
+            match_logger.info("Video chat matched: %s with %s, session: %s", user_id, partner_id, chat_session.session_id)
             
             return jsonify({
                 'session_id': chat_session.session_id,
@@ -551,9 +793,9 @@ def start_video_chat():
             })
         else:
             # Add to waiting list
-            user_manager.add_waiting_user(user_id, 'video')
-            logger.info(f"User {user_id} waiting for video chat. Total waiting: {user_manager.get_waiting_count('video')}")
-            logger.info(f"📊 Current waiting room: {user_manager.waiting_rooms['video']}")
+            user_manager.add_waiting_user(user_id, 'video', tags)
+            match_logger.info("User %s waiting for video chat. Total waiting: %s", user_id, user_manager.get_waiting_count('video'))
+            sample_debug(match_logger, "📊 Current waiting room: %s", lambda: user_manager.state.waiting_snapshot('video'))
             
             return jsonify({
                 'session_id': None,
@@ -561,7 +803,7 @@ def start_video_chat():
             })
         
     except Exception as e:
-        logger.error(f"Error starting video chat: {str(e)}")
+        match_logger.error("Error starting video chat: %s", e)
         return jsonify({'error': 'Failed to start video chat'}), 500
 
 @app.route('/send', methods=['POST'])
@@ -575,13 +817,27 @@ def send_message():
         
         if not session_id or not message or not user_id:
             return jsonify({'error': 'Missing session_id, message, or user_id'}), 400
+        if not isinstance(message, str):
+            return jsonify({'error': 'Message must be a string'}), 400
+        if len(message) > MESSAGE_MAX_CHARS:
+            PAYLOADS_REJECTED.labels('/send', 'length').inc()
+            return jsonify({'error': 'Message too long'}), 413
         
         chat_session = user_manager.get_session(session_id)
         if not chat_session or not chat_session.is_user_in_session(user_id):
             return jsonify({'error': 'Session not found or user not in session'}), 404
         
+        # Push back while the transcript writer is behind, before accepting
+        if transcript_sink is not None and transcript_sink.saturated:
+            TRANSCRIPT_BACKPRESSURE.inc()
+            return jsonify({'error': 'Transcript store is behind, retry shortly'}), 503, {'Retry-After': '1'}
+        
         # Add message to session
-        msg = chat_session.add_message(user_id, message)
+        added = chat_session.add_message(user_id, message)
+        if added is None:
+            PAYLOADS_REJECTED.labels('/send', 'budget').inc()
+            return jsonify({'error': 'Session message budget used up'}), 413
+        msg = message_to_dict(session_id, added)
         
         # Get partner ID
         partner_id = chat_session.get_partner_id(user_id)
@@ -595,7 +851,7 @@ def send_message():
         return jsonify({'ok': True, 'message_id': msg['id']})
         
     except Exception as e:
-        logger.error(f"Error sending message: {str(e)}")
+        signal_logger.error("Error sending message: %s", e)
         return jsonify({'error': 'Failed to send message'}), 500
 
 @app.route('/receive', methods=['POST'])
@@ -613,17 +869,35 @@ def receive_messages():
         if not chat_session or not chat_session.is_user_in_session(user_id):
             return jsonify({'error': 'Session not found or user not in session'}), 404
         
-        # Get messages since last check
+        # Get messages since last check, since_seq is preferred over the
+        # legacy since_timestamp cursor
+        since_seq = data.get('since_seq')
+        if since_seq is not None:
+            try:
+                since_seq = int(since_seq)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'since_seq must be an integer'}), 400
         since_timestamp = data.get('since_timestamp')
-        messages = chat_session.get_messages(since_timestamp)
+        try:
+            wait = min(float(data.get('wait') or 0), LONG_POLL_MAX_WAIT)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'wait must be a number of seconds'}), 400
+        messages = chat_session.get_messages(since_timestamp, since_seq)
+        
+        # Long-poll: with nothing new, park until add_message, a disconnect
+        # or the requested wait (capped at LONG_POLL_MAX_WAIT) expires
+        if not messages and wait > 0 and chat_session.is_active:
+            chat_session.wait_for_update(wait)
+            messages = chat_session.get_messages(since_timestamp, since_seq)
         
         return jsonify({
-            'messages': messages,
+            'messages': [message_to_dict(session_id, msg) for msg in messages],
+            'last_seq': chat_session.messages.last_seq,
             'disconnected': not chat_session.is_active
         })
         
     except Exception as e:
-        logger.error(f"Error receiving messages: {str(e)}")
+        signal_logger.error("Error receiving messages: %s", e)
         return jsonify({'error': 'Failed to receive messages'}), 500
 
 @app.route('/disconnect', methods=['POST'])
@@ -654,314 +928,432 @@ def disconnect_chat():
         }, room=partner_id)
         
         # Remove session
-        user_manager.remove_session(session_id)
+        user_manager.remove_session(session_id, 'partner_left')
         
-        logger.info(f"User {user_id} disconnected from session {session_id}")
+        signal_logger.info("User %s disconnected from session %s", user_id, session_id)
         
         return jsonify({'ok': True})
         
     except Exception as e:
-        logger.error(f"Error disconnecting: {str(e)}")
+        signal_logger.error("Error disconnecting: %s", e)
         return jsonify({'error': 'Failed to disconnect'}), 500
 
 # Socket.IO event handlers
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
     """Handle client connection"""
-    logger.info(f"🎉 CONNECT EVENT TRIGGERED for socket {request.sid}")
+    if not rate_limiter.allow('connect', 'ip', request.remote_addr):
+        RATE_LIMITED.labels('connect', 'ip').inc()
+        return False
+    
+    transport_logger.info("🎉 CONNECT EVENT TRIGGERED for socket %s", request.sid)
+    
+    # A client coming back from a transport drop takes over its old user_id
+    if resume_user(auth):
+        return
     
     # Generate user_id immediately
-    user_id = str(uuid.uuid4())
-    logger.info(f"Generated new user_id: {user_id}")
+    user_id = mint_user_id()
+    transport_logger.info("Generated new user_id: %s", user_id)
     
     # Map socket to user_id
-    user_manager.socket_user_map[request.sid] = user_id
-    logger.info(f"Mapped socket {request.sid} to user {user_id}")
+    user_manager.map_socket(request.sid, user_id)
+    user_manager.bind_user_socket(user_id, request.sid)
+    transport_logger.info("Mapped socket %s to user %s", request.sid, user_id)
     
     # Join user's personal room
     try:
         join_room(user_id)
-        logger.info(f"Joined room: {user_id}")
+        transport_logger.info("Joined room: %s", user_id)
+        readiness.register(user_id, request.sid)
     except Exception as e:
-        logger.error(f"❌ Error joining room: {str(e)}")
+        transport_logger.error("❌ Error joining room: %s", e)
     
     # Add to active users
     try:
         user_manager.add_active_user(user_id)
-        logger.info(f"Added to active users")
+        transport_logger.info("Added to active users")
     except Exception as e:
-        logger.error(f"❌ Error adding to active users: {str(e)}")
+        transport_logger.error("❌ Error adding to active users: %s", e)
     
     # CRITICAL: Emit user_id using the most reliable method
-    logger.info(f"📤 Emitting user_id {user_id} to client {request.sid}")
+    transport_logger.info("📤 Emitting user_id %s to client %s", user_id, request.sid)
     
-    # Use socketio.emit with room - this is the most reliable method
+    # Use socketio.emit to the sid - this is the most reliable method. The
+    # client's ack marks it ready to receive matched events
     try:
-        socketio.emit('user_id', {'user_id': user_id}, room=request.sid)
-        logger.info(f"✅ Successfully emitted user_id to client {request.sid}")
+        socketio.emit('user_id', user_id_payload(user_id), to=request.sid,
+                      callback=lambda *args: readiness.mark_ready(user_id))
+        transport_logger.debug("✅ Successfully emitted user_id to client %s", request.sid)
     except Exception as emit_error:
-        logger.error(f"❌ Error emitting user_id: {str(emit_error)}")
+        EMIT_FAILURES.labels('user_id').inc()
+        transport_logger.error("❌ Error emitting user_id: %s", emit_error)
         # Fallback: try direct emit
         try:
-            emit('user_id', {'user_id': user_id})
-            logger.info(f"✅ Fallback emit successful")
+            emit('user_id', user_id_payload(user_id))
+            transport_logger.info("✅ Fallback emit successful")
         except Exception as fallback_error:
-            logger.error(f"❌ Fallback emit also failed: {str(fallback_error)}")
+            transport_logger.error("❌ Fallback emit also failed: %s", fallback_error)
     
-    # Schedule auto-match
-    try:
-        eventlet.spawn_after(1.0, auto_match_user, user_id)
-        logger.info(f"✅ Auto-match scheduled for user {user_id}")
-    except Exception as e:
-        logger.error(f"❌ Failed to schedule auto-match: {str(e)}")
-        # Call immediately as fallback
-        try:
-            auto_match_user(user_id)
-            logger.info(f"✅ Auto-match called immediately")
-        except Exception as e2:
-            logger.error(f"❌ Auto-match failed: {str(e2)}")
+    # Queue for auto-match, the matchmaker loop pairs users on its next tick.
+    # Interest tags may come in the connect query (?tags=a,b&language=en)
+    auto_match_user(user_id, request_tags())
 
+def resume_user(auth):
+    """Reattach this socket to the user named by a resume token
+    
+    The token comes from the Socket.IO auth payload ({resume_token}) or the
+    connect query string. The user keeps its personal room, waiting position
+    and session. Returns False if there is nothing to resume, in which case
+    the caller connects the socket as a new user.
+    """
+    token = auth.get('resume_token') if isinstance(auth, dict) else None
+    token = token or request.args.get('resume_token')
+    if not token:
+        return False
+    user_id = resume_tokens.user_id(token)
+    if user_id is None:
+        RESUMES.labels('invalid').inc()
+        transport_logger.info("Rejected resume token on socket %s", request.sid)
+        return False
+    
+    # Swapping the user's socket is atomic in the state backend, so a grace
+    # timer on any worker sees the new sid and leaves the user alone
+    old_sid = user_manager.bind_user_socket(user_id, request.sid)
+    if old_sid is None or not user_manager.is_active_user(user_id):
+        # Grace period already over, the user is gone
+        user_manager.release_user_socket(user_id, request.sid)
+        RESUMES.labels('expired').inc()
+        return False
+    grace_periods.cancel(user_id)
+    
+    user_manager.map_socket(request.sid, user_id)
+    if old_sid != request.sid:
+        # The old socket may still be open if the client noticed the drop first
+        if user_manager.unmap_socket(old_sid):
+            user_manager.signal_routes.drop_sid(old_sid)
+            disconnect(old_sid)
+    join_room(user_id)
+    readiness.register(user_id, request.sid)
+    RESUMES.labels('resumed').inc()
+    transport_logger.info("Resumed user %s on socket %s (was %s)", user_id, request.sid, old_sid)
+    
+    session_id = user_manager.get_user_session(user_id)
+    socketio.emit('user_id', user_id_payload(user_id, resumed=True, session_id=session_id),
+                  to=request.sid, callback=lambda *args: readiness.mark_ready(user_id))
+    chat_session = user_manager.get_session(session_id) if session_id else None
+    if chat_session:
+        partner_id = chat_session.get_partner_id(user_id)
+        # Repeat matched in case the match happened while the socket was
+        # down; clients ignore a repeat for the same session_id
+        readiness.deliver(user_id, 'matched', {
+            'session_id': session_id,
+            'chat_type': chat_session.chat_type,
+            'partner_id': partner_id,
+            'is_initiator': user_id == chat_session.initiator_id
+        })
+        socketio.emit('partner_reconnected', {'session_id': session_id}, room=partner_id)
+    return True
 
+def request_tags(data=None):
+    """Interest tags from a JSON body or the query string, None if there are none"""
+    return parse_tags(data, request.args)
 
-def auto_match_user(new_user_id):
-    """Automatically match a new user with waiting users"""
+def auto_match_user(new_user_id, tags=None):
+    """Queue a user for the matchmaker loop to pair with a waiting user"""
     try:
-        logger.info(f"🔍 Auto-match function called for user {new_user_id}")
+        match_logger.info("🔍 Auto-match function called for user %s", new_user_id)
         
         # Check if user is already in a session
-        if new_user_id in user_manager.user_sessions:
-            logger.info(f"⚠️ User {new_user_id} already in session, skipping auto-match")
+        if user_manager.get_user_session(new_user_id):
+            match_logger.info("⚠️ User %s already in session, skipping auto-match", new_user_id)
             return
         
-        # Check if user is already in waiting room
-        if new_user_id in user_manager.waiting_rooms['video']:
-            logger.info(f"⚠️ User {new_user_id} already in waiting room, skipping duplicate add")
+        # Add user to waiting room, duplicates are ignored by the queue
+        if user_manager.add_waiting_user(new_user_id, 'video', tags):
+            match_logger.info("⏳ User %s queued for the next matchmaker tick", new_user_id)
         else:
-            # Add user to waiting room
-            user_manager.add_waiting_user(new_user_id, 'video')
-            logger.info(f"✅ User {new_user_id} added to video waiting room")
-        
-        # Check if there's a waiting partner (CRITICAL: exclude self)
-        partner_id = user_manager.get_waiting_partner('video', exclude_user_id=new_user_id)
-        logger.info(f"🔍 Looking for partner for {new_user_id}, found: {partner_id}")
-        logger.info(f"📊 Current waiting room: {user_manager.waiting_rooms['video']}")
-        
-        if partner_id and partner_id != new_user_id:
-            logger.info(f"🎯 Auto-matching {new_user_id} with {partner_id}")
-            
-            # Create session
-            chat_session = user_manager.create_session(new_user_id, partner_id, 'video')
-            logger.info(f"✅ Created session {chat_session.session_id}")
-            
-            # Add delay to ensure both users are ready
-            eventlet.sleep(0.5)
-            
-            # Emit matched events
-            logger.info(f"📤 Emitting matched event to {new_user_id}")
-            try:
-                socketio.emit('matched', {
-                    'session_id': chat_session.session_id,
-                    'chat_type': 'video',
-                    'partner_id': partner_id,
-                    'is_initiator': False
-                }, room=new_user_id)
-                logger.info(f"✅ Successfully emitted matched event to {new_user_id}")
-            except Exception as e:
-                logger.error(f"❌ Failed to emit matched event to {new_user_id}: {str(e)}")
-            
-            logger.info(f"📤 Emitting matched event to {partner_id}")
-            try:
-                socketio.emit('matched', {
-                    'session_id': chat_session.session_id,
-                    'chat_type': 'video',
-                    'partner_id': new_user_id,
-                    'is_initiator': True
-                }, room=partner_id)
-                logger.info(f"✅ Successfully emitted matched event to {partner_id}")
-            except Exception as e:
-                logger.error(f"❌ Failed to emit matched event to {partner_id}: {str(e)}")
-            
-            logger.info(f"🎉 Auto-matched {new_user_id} with {partner_id} in session {chat_session.session_id}")
-        else:
-            logger.info(f"⏳ User {new_user_id} added to waiting room (no partner available)")
-            logger.info(f"📊 Current waiting room: {user_manager.waiting_rooms['video']}")
+            match_logger.info("⚠️ User %s already in waiting room, skipping duplicate add", new_user_id)
             
     except Exception as e:
-        logger.error(f"❌ Error in auto_match_user: {str(e)}")
+        match_logger.error("❌ Error in auto_match_user: %s", e)
         import traceback
-        logger.error(f"❌ Traceback: {traceback.format_exc()}")
+        match_logger.error("❌ Traceback: %s", traceback.format_exc())
 
 @socketio.on('*')
 def catch_all(event, data=None):
     """Catch all events for debugging"""
-    logger.info(f"🔍 Received event: {event}, data: {data}, socket: {request.sid}")
+    transport_logger.debug("🔍 Received event: %s, data: %s, socket: %s", event, data, request.sid)
     
     # Special handling for request_user_id event
     if event == 'request_user_id':
-        logger.info(f"📞 REQUEST_USER_ID event received via catch_all for socket {request.sid}")
+        transport_logger.info("📞 REQUEST_USER_ID event received via catch_all for socket %s", request.sid)
         handle_request_user_id(data)
 
 # Removed register event handler - auto-matching is now handled in connect event
 
 @socketio.on('request_user_id')
+@rate_limited('request_user_id')
+@timed(SOCKET_DURATION.labels('request_user_id'))
 def handle_request_user_id(data=None):
     """Handle user_id request from client"""
-    logger.info(f"📞 REQUEST_USER_ID event triggered for socket {request.sid}")
-    logger.info(f"📊 Current socket mappings: {user_manager.socket_user_map}")
+    transport_logger.info("📞 REQUEST_USER_ID event triggered for socket %s", request.sid)
+    sample_debug(transport_logger, "📊 Current socket mappings: %s", lambda: user_manager.state.map_items('socket_user_map'))
     
-    user_id = user_manager.socket_user_map.get(request.sid)
+    user_id = user_manager.get_socket_user(request.sid)
     if user_id:
-        logger.info(f"Re-sending user_id {user_id} to client {request.sid}")
+        transport_logger.info("Re-sending user_id %s to client %s", user_id, request.sid)
+        # Asking for its user_id means the client is listening by now
+        readiness.mark_ready(user_id, acks=False)
         try:
             # Try multiple emit methods to ensure delivery
-            emit('user_id', {'user_id': user_id})
-            logger.info(f"✅ Successfully re-sent user_id to client {request.sid}")
+            emit('user_id', user_id_payload(user_id))
+            transport_logger.debug("✅ Successfully re-sent user_id to client %s", request.sid)
         except Exception as e:
-            logger.error(f"❌ Error re-sending user_id: {str(e)}")
+            transport_logger.error("❌ Error re-sending user_id: %s", e)
             try:
                 # Fallback emit methods
-                socketio.emit('user_id', {'user_id': user_id}, room=request.sid)
-                logger.info(f"✅ Successfully re-sent user_id to client {request.sid} (room)")
+                socketio.emit('user_id', user_id_payload(user_id), room=request.sid)
+                transport_logger.debug("✅ Successfully re-sent user_id to client %s (room)", request.sid)
             except Exception as e2:
-                logger.error(f"❌ Error re-sending user_id (room): {str(e2)}")
+                transport_logger.error("❌ Error re-sending user_id (room): %s", e2)
                 try:
                     # Last resort: emit to namespace
                     socketio.emit('user_id', {'user_id': user_id}, namespace='/')
-                    logger.info(f"✅ Successfully re-sent user_id to client {request.sid} (namespace)")
+                    transport_logger.debug("✅ Successfully re-sent user_id to client %s (namespace)", request.sid)
                 except Exception as e3:
-                    logger.error(f"❌ Error re-sending user_id (namespace): {str(e3)}")
+                    transport_logger.error("❌ Error re-sending user_id (namespace): %s", e3)
     else:
-        logger.error(f"❌ No user_id found for socket {request.sid}")
-        logger.error(f"📊 Available socket mappings: {user_manager.socket_user_map}")
+        transport_logger.error("❌ No user_id found for socket %s", request.sid)
+        sample_debug(transport_logger, "📊 Available socket mappings: %s", lambda: user_manager.state.map_items('socket_user_map'))
         # Try to generate a new user_id
         try:
-            new_user_id = str(uuid.uuid4())
-            user_manager.socket_user_map[request.sid] = new_user_id
+            new_user_id = mint_user_id()
+            user_manager.map_socket(request.sid, new_user_id)
+            user_manager.bind_user_socket(new_user_id, request.sid)
             session['user_id'] = new_user_id
             user_manager.add_active_user(new_user_id)
             join_room(new_user_id)
-            logger.info(f"🆕 Generated new user_id {new_user_id} for socket {request.sid}")
-            emit('user_id', {'user_id': new_user_id})
-            logger.info(f"✅ Successfully sent new user_id to client {request.sid}")
+            readiness.register(new_user_id, request.sid)
+            readiness.mark_ready(new_user_id, acks=False)
+            transport_logger.info("🆕 Generated new user_id %s for socket %s", new_user_id, request.sid)
+            emit('user_id', user_id_payload(new_user_id))
+            transport_logger.debug("✅ Successfully sent new user_id to client %s", request.sid)
         except Exception as e:
-            logger.error(f"❌ Error generating new user_id: {str(e)}")
+            transport_logger.error("❌ Error generating new user_id: %s", e)
+
+@socketio.on('client_ready')
+@rate_limited('client_ready')
+@timed(SOCKET_DURATION.labels('client_ready'))
+def handle_client_ready(data=None):
+    """Client has its handlers in place, alternative to acking user_id"""
+    user_id = user_manager.get_socket_user(request.sid)
+    if user_id:
+        readiness.mark_ready(user_id)
+    return True
 
 @socketio.on('disconnect')
+@timed(SOCKET_DURATION.labels('disconnect'))
 def handle_disconnect():
     """Handle client disconnection"""
     try:
-        user_id = user_manager.socket_user_map.get(request.sid)
+        user_id = user_manager.get_socket_user(request.sid)
         if user_id:
-            logger.info(f"Client disconnecting: {user_id} (socket: {request.sid})")
-            
-            # Remove from active users
-            user_manager.remove_active_user(user_id)
-            
-            # Remove from connected users if in session
-            user_manager.remove_connected_user(user_id)
+            transport_logger.info("Client disconnecting: %s (socket: %s)", user_id, request.sid)
             
             # Remove socket mapping
-            user_manager.socket_user_map.pop(request.sid, None)
+            user_manager.unmap_socket(request.sid)
+            user_manager.signal_routes.drop_sid(request.sid)
+            if user_manager.get_user_socket(user_id) != request.sid:
+                # Superseded by a resumed socket, the user lives on there
+                transport_logger.info("Socket %s of %s replaced by a resume", request.sid, user_id)
+                return
+            readiness.forget(user_id)
             
-            # Handle active session disconnection
-            session_id = user_manager.get_user_session(user_id)
-            if session_id:
-                chat_session = user_manager.get_session(session_id)
+            if RESUME_GRACE > 0:
+                # Keep the user, its session and waiting position for a
+                # while in case the client reconnects with its resume token
+                grace_periods.start(user_id, request.sid)
+                session_id = user_manager.get_user_session(user_id)
+                chat_session = user_manager.get_session(session_id) if session_id else None
                 if chat_session:
-                    partner_id = chat_session.get_partner_id(user_id)
-                    try:
-                        socketio.emit('partner_disconnected', {
-                            'session_id': session_id,
-                            'reason': 'partner_disconnected'
-                        }, room=partner_id)
-                    except Exception as e:
-                        logger.error(f"Error emitting partner_disconnected: {str(e)}")
-                    
-                    # Remove session
-                    user_manager.remove_session(session_id)
+                    socketio.emit('partner_reconnecting', {
+                        'session_id': session_id,
+                        'grace': RESUME_GRACE
+                    }, room=chat_session.get_partner_id(user_id))
+                transport_logger.info("Client detached: %s (socket: %s), grace %ss",
+                                      user_id, request.sid, RESUME_GRACE)
+                return
             
-            logger.info(f"Client disconnected: {user_id} (socket: {request.sid})")
+            user_manager.release_user_socket(user_id, request.sid)
+            end_user(user_id)
+            transport_logger.info("Client disconnected: %s (socket: %s)", user_id, request.sid)
         else:
             # Gracefully handle unknown socket disconnects (transport upgrades, etc.)
-            logger.debug(f"Disconnect event for unknown socket: {request.sid} (likely transport upgrade)")
+            transport_logger.debug("Disconnect event for unknown socket: %s (likely transport upgrade)", request.sid)
     except Exception as e:
-        logger.error(f"Error in handle_disconnect: {str(e)}")
+        transport_logger.error("Error in handle_disconnect: %s", e)
+
+def end_user(user_id):
+    """Take a user offline and end its session, telling the partner"""
+    # Remove from active users
+    user_manager.remove_active_user(user_id)
+    
+    # Remove from connected users if in session
+    user_manager.remove_connected_user(user_id)
+    if cross_shard is not None:
+        cross_shard.withdraw(user_id)
+    
+    # Handle active session disconnection
+    session_id = user_manager.get_user_session(user_id)
+    if session_id:
+        chat_session = user_manager.get_session(session_id)
+        if chat_session:
+            partner_id = chat_session.get_partner_id(user_id)
+            try:
+                socketio.emit('partner_disconnected', {
+                    'session_id': session_id,
+                    'reason': 'partner_disconnected'
+                }, room=partner_id)
+            except Exception as e:
+                EMIT_FAILURES.labels('partner_disconnected').inc()
+                transport_logger.error("Error emitting partner_disconnected: %s", e)
+            
+            # Remove session
+            user_manager.remove_session(session_id, 'partner_disconnected')
 
 @socketio.on('join_session')
+@rate_limited('join_session')
+@timed(SOCKET_DURATION.labels('join_session'))
 def handle_join_session(data):
     """Handle joining a chat session"""
     session_id = data.get('session_id')
-    user_id = user_manager.socket_user_map.get(request.sid)
+    user_id = user_manager.get_socket_user(request.sid)
     
     if session_id and user_id:
         join_room(session_id)
         user_manager.user_rooms[user_id] = session_id
-        logger.info(f"User {user_id} joined session {session_id}")
+        signal_logger.info("User %s joined session %s", user_id, session_id)
 
 @socketio.on('leave_session')
+@rate_limited('leave_session')
+@timed(SOCKET_DURATION.labels('leave_session'))
 def handle_leave_session(data):
     """Handle leaving a chat session"""
     session_id = data.get('session_id')
-    user_id = user_manager.socket_user_map.get(request.sid)
+    user_id = user_manager.get_socket_user(request.sid)
     
     if session_id and user_id:
         leave_room(session_id)
         user_manager.user_rooms.pop(user_id, None)
-        logger.info(f"User {user_id} left session {session_id}")
+        signal_logger.info("User %s left session %s", user_id, session_id)
+
+def emit_signal(event, payload, room):
+    socketio.emit(event, payload, room=room)
+
+signal_coalescer = SignalCoalescer(
+    emit_signal,
+    eventlet.spawn_after,
+    window=SIGNAL_COALESCE_MS / 1000.0,
+    max_batch=SIGNAL_BATCH_MAX,
+    on_batch=SIGNAL_BATCH_SIZE.observe
+) if SIGNAL_COALESCE_MS > 0 else None
 
 @socketio.on('webrtc_signal')
+@rate_limited('webrtc_signal')
+@timed(SOCKET_DURATION.labels('webrtc_signal'))
 def handle_webrtc_signal(data):
-    """Handle WebRTC signaling"""
+    """Relay a WebRTC signal to the partner
+
+    Only the first signal per socket and session hits the state backend,
+    later ones take the cached route. The received payload is forwarded
+    as is, with 'from' set by the server. With SIGNAL_COALESCE_MS set, ICE
+    candidates are batched by signal_coalescer.
+    """
     session_id = data.get('session_id')
-    signal = data.get('signal')
-    user_id = user_manager.socket_user_map.get(request.sid)
+    if not session_id or not data.get('signal'):
+        return
     
-    if session_id and signal and user_id:
-        chat_session = user_manager.get_session(session_id)
-        if chat_session and chat_session.is_user_in_session(user_id):
-            # Forward signal to partner
-            partner_id = chat_session.get_partner_id(user_id)
-            socketio.emit('webrtc_signal', {
-                'session_id': session_id,
-                'signal': signal,
-                'from': user_id
-            }, room=partner_id)
+    route = user_manager.signal_routes.get(request.sid, session_id)
+    if route is None:
+        route = user_manager.resolve_signal_route(request.sid, session_id)
+        if route is None:
+            return
+    
+    route.chat_session.touch()
+    data['from'] = route.user_id
+    if signal_coalescer is not None:
+        signal_coalescer.relay(route, data)
+    else:
+        socketio.emit('webrtc_signal', data, room=route.partner_id)
+    SIGNALS_RELAYED_WEBRTC.inc()
+
+def emit_partner_typing(route, is_typing):
+    socketio.emit('partner_typing', {
+        'session_id': route.session_id,
+        'is_typing': is_typing
+    }, room=route.partner_id)
+    SIGNALS_RELAYED.labels('partner_typing').inc()
+
+typing_throttle = TypingThrottle(
+    emit_partner_typing,
+    eventlet.spawn_after,
+    min_interval=TYPING_MIN_INTERVAL_MS / 1000.0,
+    expiry=TYPING_EXPIRY,
+    on_suppressed=lambda reason: TYPING_SUPPRESSED.labels(reason).inc(),
+    on_expired=TYPING_EXPIRED.inc
+)
+
+def session_removed(chat_session):
+    typing_throttle.drop_session(chat_session)
+    if cross_shard is not None:
+        cross_shard.session_removed(chat_session)
+
+user_manager.on_session_removed = session_removed
 
 @socketio.on('user_typing')
+@rate_limited('user_typing')
+@timed(SOCKET_DURATION.labels('user_typing'))
 def handle_user_typing(data):
-    """Handle user typing indicator"""
+    """Handle user typing indicator
+
+    Uses the same cached route as webrtc_signal. typing_throttle only
+    forwards changes of state, at most once per TYPING_MIN_INTERVAL_MS,
+    and clears "typing" on its own after TYPING_EXPIRY seconds.
+    """
     session_id = data.get('session_id')
-    user_id = user_manager.socket_user_map.get(request.sid)
-    is_typing = data.get('is_typing', False)
+    if not session_id:
+        return
     
-    if session_id and user_id:
-        chat_session = user_manager.get_session(session_id)
-        if chat_session and chat_session.is_user_in_session(user_id):
-            partner_id = chat_session.get_partner_id(user_id)
-            socketio.emit('partner_typing', {
-                'session_id': session_id,
-                'is_typing': is_typing
-            }, room=partner_id)
+    route = user_manager.signal_routes.get(request.sid, session_id)
+    if route is None:
+        route = user_manager.resolve_signal_route(request.sid, session_id)
+        if route is None:
+            return
+    
+    route.chat_session.touch()
+    typing_throttle.update(route, bool(data.get('is_typing', False)))
 
 @app.route('/debug_socket/<socket_id>')
 def debug_socket(socket_id):
     """Debug endpoint to check socket status"""
-    user_id = user_manager.socket_user_map.get(socket_id)
+    user_id = user_manager.get_socket_user(socket_id)
+    session_id = user_manager.get_user_session(user_id) if user_id else None
     return jsonify({
         'socket_id': socket_id,
         'user_id': user_id,
-        'is_active': user_id in user_manager.active_users if user_id else False,
-        'in_session': user_id in user_manager.user_sessions if user_id else False,
-        'session_id': user_manager.user_sessions.get(user_id) if user_id else None
+        'is_active': user_manager.is_active_user(user_id) if user_id else False,
+        'in_session': session_id is not None,
+        'session_id': session_id
     })
 
 @app.route('/manual_emit_user_id/<socket_id>', methods=['POST'])
 def manual_emit_user_id(socket_id):
     """Manually emit user_id to a specific socket for testing"""
     try:
-        user_id = user_manager.socket_user_map.get(socket_id)
+        user_id = user_manager.get_socket_user(socket_id)
         if user_id:
-            logger.info(f"🔧 Manual emit request for socket {socket_id}, user_id: {user_id}")
+            transport_logger.info("🔧 Manual emit request for socket %s, user_id: %s", socket_id, user_id)
             
             # Try multiple emit methods
             success = False
@@ -969,19 +1361,19 @@ def manual_emit_user_id(socket_id):
             # Method 1: socketio.emit to room
             try:
                 socketio.emit('user_id', {'user_id': user_id}, room=socket_id)
-                logger.info(f"✅ Manual emit successful (room method)")
+                transport_logger.info("✅ Manual emit successful (room method)")
                 success = True
             except Exception as e:
-                logger.error(f"❌ Manual emit failed (room): {str(e)}")
+                transport_logger.error("❌ Manual emit failed (room): %s", e)
             
             # Method 2: socketio.emit to namespace
             if not success:
                 try:
                     socketio.emit('user_id', {'user_id': user_id}, namespace='/')
-                    logger.info(f"✅ Manual emit successful (namespace)")
+                    transport_logger.info("✅ Manual emit successful (namespace)")
                     success = True
                 except Exception as e:
-                    logger.error(f"❌ Manual emit failed (namespace): {str(e)}")
+                    transport_logger.error("❌ Manual emit failed (namespace): %s", e)
             
             if success:
                 return jsonify({
@@ -1000,9 +1392,21 @@ def manual_emit_user_id(socket_id):
                 'error': f'No user_id found for socket {socket_id}'
             }), 404
     except Exception as e:
-        logger.error(f"Error in manual_emit_user_id: {str(e)}")
+        transport_logger.error("Error in manual_emit_user_id: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def run_shard_worker(host, port):
+    """Serve as one shard worker, started by supervisor.py
+
+    All workers accept on the same public port (eventlet.listen sets
+    SO_REUSEPORT); requests forwarded by other workers come in on a private
+    Unix socket next to the bus.
+    """
+    shard_bus.start()
+    eventlet.spawn(wsgi.server, listen_unix(shard_bus.path(SHARD_INDEX, 'http')),
+                   mark_forwarded(app), log_output=False)
+    socketio.run(app, host=host, port=port, log_output=False)
+
 if __name__ == '__main__':
     logger.info("Starting Video Chat Backend...")
     socketio.run(app, host='0.0.0.0', port=8081, debug=True)
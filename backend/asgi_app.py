@@ -0,0 +1,722 @@
+# Native asyncio runtime: python-socketio's AsyncServer behind an ASGI server,
+# with no monkey patching. Matchmaking, sessions and signaling come from the
+# same modules as app.py (core.py, matchmaking.py, signaling.py, ...); this
+# file only adapts them to asyncio. Run with `python asgi_app.py` or
+# `uvicorn asgi_app:app --port 8081`.
+import asyncio
+import functools
+import logging
+import threading
+import time
+import uuid
+from urllib.parse import parse_qsl
+
+import socketio
+
+import core
+from core import (EMIT_FAILURES, EMIT_RETRIES, HTTP_DURATION, HTTP_MAX_BODY, JSON_BACKEND,
+                  LONG_POLL_MAX_WAIT, MATCH_ACK_TIMEOUT_MS, MATCH_EMIT_RETRIES, MATCH_MAX_BATCH,
+                  MATCH_TICK_DURATION, MATCH_TICK_INTERVAL, MAX_HTTP_BUFFER_SIZE,
+                  MESSAGE_MAX_CHARS, PAYLOADS_REJECTED, PAYLOAD_LIMITS, PAYLOAD_LIMIT_DEFAULT,
+                  RATE_LIMITED, RATE_LIMITS, READY_TIMEOUT_MS, REAPER_MAX_BATCH,
+                  REAPER_RESOLUTION, REDIS_URL, RESUMES, RESUME_GRACE, RESUME_TOKEN_MAX_AGE,
+                  SECRET_KEY, SIGNALS_RELAYED, SIGNALS_RELAYED_WEBRTC, SIGNAL_BATCH_MAX,
+                  SIGNAL_BATCH_SIZE, SIGNAL_COALESCE_MS, SOCKETIO_SERIALIZER, SOCKET_DURATION,
+                  STATE_BACKEND, TRANSCRIPT_BACKPRESSURE, TRANSCRIPT_FLUSH_DURATION,
+                  TRANSCRIPT_FLUSH_MS, TRANSCRIPT_PERSISTED, TRANSCRIPT_QUEUE, TRUSTED_PROXY_HOPS, TYPING_EXPIRED,
+                  TYPING_EXPIRY, TYPING_MIN_INTERVAL_MS, TYPING_SUPPRESSED, UserManager,
+                  create_rate_limiter, create_state_backend, create_transcript_sink, parse_tags,
+                  update_buffer_gauges, update_state_gauges)
+from limits import PacketSizeGuard
+from logging_setup import configure_logging
+from matchmaking import Matchmaker
+from message_log import message_to_dict
+from metrics import REGISTRY, timed
+from ratelimit import forwarded_client
+from readiness import ReadinessTracker
+from resume import GracePeriods, ResumeTokens
+from serialization import get_codec
+from signaling import SignalCoalescer, TypingThrottle
+
+configure_logging()
+logger = logging.getLogger('app')
+match_logger = logging.getLogger('app.matchmaking')
+signal_logger = logging.getLogger('app.signaling')
+transport_logger = logging.getLogger('app.transport')
+
+JSON_CODEC = get_codec(JSON_BACKEND)
+
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    cors_allowed_origins='*',
+    json=JSON_CODEC,
+    serializer='msgpack' if SOCKETIO_SERIALIZER == 'msgpack' else 'default',
+    # Route emits through Redis so rooms on other workers receive them
+    client_manager=socketio.AsyncRedisManager(REDIS_URL) if STATE_BACKEND == 'redis' else None,
+    logger=transport_logger,
+    engineio_logger=transport_logger,
+    ping_timeout=60,
+    ping_interval=25,
+    max_http_buffer_size=MAX_HTTP_BUFFER_SIZE,
+    allow_upgrades=True,
+    transports=['websocket', 'polling'],
+    always_connect=True,
+    cookie=None
+)
+
+# Per-event size limits, checked on the raw packet before it is decoded
+PacketSizeGuard(
+    PAYLOAD_LIMITS, PAYLOAD_LIMIT_DEFAULT,
+    on_rejected=lambda name, size: PAYLOADS_REJECTED.labels(name, 'packet').inc()
+).install(sio.eio)
+
+
+class ChatSession(core.ChatSession):
+    __slots__ = ()
+
+    async def wait_for_update(self, timeout):
+        """Park until a message arrives, the session closes or timeout expires"""
+        if self._update is None:
+            self._update = asyncio.Event()
+        update = self._update
+        try:
+            await asyncio.wait_for(update.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Emits started from synchronous code (timers, the matchmaker, helpers
+# shared with app.py) run as tasks; keep a reference until they finish
+_background = set()
+
+def spawn(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+def spawn_after(seconds, fn, *args):
+    """eventlet.spawn_after stand-in, the handle has cancel() too"""
+    return asyncio.get_running_loop().call_later(seconds, fn, *args)
+
+async def safe_emit(event, payload, room, callback=None):
+    try:
+        await sio.emit(event, payload, to=room, callback=callback)
+    except Exception as e:
+        EMIT_FAILURES.labels(event).inc()
+        transport_logger.error("❌ Error emitting %s: %s", event, e)
+
+def emit_later(event, payload, room, callback=None):
+    spawn(safe_emit(event, payload, room, callback))
+
+user_manager = UserManager(create_state_backend(ChatSession))
+rate_limiter = create_rate_limiter()
+transcript_sink = create_transcript_sink()
+ChatSession.transcripts = transcript_sink
+
+def match_delivery_failed(event, user_id):
+    EMIT_FAILURES.labels(event).inc()
+    match_logger.warning("No ack for %s from %s after %s retries", event, user_id, MATCH_EMIT_RETRIES)
+
+readiness = ReadinessTracker(
+    emit_later,
+    spawn_after,
+    ready_timeout=READY_TIMEOUT_MS / 1000.0,
+    ack_timeout=MATCH_ACK_TIMEOUT_MS / 1000.0,
+    retries=MATCH_EMIT_RETRIES,
+    on_retry=lambda event: EMIT_RETRIES.labels(event).inc(),
+    on_failed=match_delivery_failed
+)
+
+resume_tokens = ResumeTokens(SECRET_KEY, max_age=RESUME_TOKEN_MAX_AGE)
+
+def user_id_payload(user_id, **extra):
+    """user_id event body, with the token the client presents to resume"""
+    return dict(extra, user_id=user_id, resume_token=resume_tokens.issue(user_id))
+
+def grace_expired(user_id, sid):
+    """Tear the user down unless it resumed, possibly on another worker"""
+    if user_manager.release_user_socket(user_id, sid):
+        RESUMES.labels('expired').inc()
+        end_user(user_id)
+
+grace_periods = GracePeriods(RESUME_GRACE, spawn_after, grace_expired)
+
+def emit_partner_typing(route, is_typing):
+    emit_later('partner_typing', {
+        'session_id': route.session_id,
+        'is_typing': is_typing
+    }, route.partner_id)
+    SIGNALS_RELAYED.labels('partner_typing').inc()
+
+typing_throttle = TypingThrottle(
+    emit_partner_typing,
+    spawn_after,
+    min_interval=TYPING_MIN_INTERVAL_MS / 1000.0,
+    expiry=TYPING_EXPIRY,
+    on_suppressed=lambda reason: TYPING_SUPPRESSED.labels(reason).inc(),
+    on_expired=TYPING_EXPIRED.inc
+)
+user_manager.on_session_removed = typing_throttle.drop_session
+
+signal_coalescer = SignalCoalescer(
+    emit_later,
+    spawn_after,
+    window=SIGNAL_COALESCE_MS / 1000.0,
+    max_batch=SIGNAL_BATCH_MAX,
+    on_batch=SIGNAL_BATCH_SIZE.observe
+) if SIGNAL_COALESCE_MS > 0 else None
+
+REGISTRY.add_collector(lambda: update_state_gauges(user_manager, grace_periods))
+REGISTRY.add_collector(lambda: update_buffer_gauges(sio.eio.sockets))
+if transcript_sink is not None:
+    REGISTRY.add_collector(lambda: TRANSCRIPT_QUEUE.set(transcript_sink.pending))
+
+def deliver_matched(chat_session, user_id):
+    """Send matched to user_id, held by readiness until it can receive it"""
+    readiness.deliver(user_id, 'matched', {
+        'session_id': chat_session.session_id,
+        'chat_type': chat_session.chat_type,
+        'partner_id': chat_session.get_partner_id(user_id),
+        'is_initiator': user_id == chat_session.initiator_id
+    })
+
+def emit_matched_sessions(sessions):
+    """Notify both users of every newly created session"""
+    for chat_session in sessions:
+        deliver_matched(chat_session, chat_session.user1_id)
+        deliver_matched(chat_session, chat_session.user2_id)
+
+matchmaker = Matchmaker(
+    user_manager,
+    emit_matched_sessions,
+    tick_interval=MATCH_TICK_INTERVAL,
+    max_batch=MATCH_MAX_BATCH
+)
+
+def end_user(user_id):
+    """Take a user offline and end its session, telling the partner"""
+    user_manager.remove_active_user(user_id)
+    user_manager.remove_connected_user(user_id)
+    session_id = user_manager.get_user_session(user_id)
+    chat_session = user_manager.get_session(session_id) if session_id else None
+    if chat_session:
+        emit_later('partner_disconnected', {
+            'session_id': session_id,
+            'reason': 'partner_disconnected'
+        }, chat_session.get_partner_id(user_id))
+        user_manager.remove_session(session_id, 'partner_disconnected')
+
+def cleanup_inactive_sessions():
+    """End sessions whose inactivity deadline has passed"""
+    ended = 0
+    for expired in user_manager.reaper.pop_expired(REAPER_MAX_BATCH):
+        chat_session = user_manager.remove_session(expired.session_id, 'inactivity')
+        if chat_session:
+            ended += 1
+            for user_id in (chat_session.user1_id, chat_session.user2_id):
+                emit_later('session_ended', {
+                    'session_id': chat_session.session_id,
+                    'reason': 'inactivity'
+                }, user_id)
+    if ended:
+        logger.info("Cleaned up %s inactive sessions", ended)
+
+async def cleanup_loop():
+    while True:
+        await asyncio.sleep(REAPER_RESOLUTION)
+        try:
+            cleanup_inactive_sessions()
+            rate_limiter.sweep()
+        except Exception as e:
+            logger.error("❌ Error cleaning up inactive sessions: %s", e)
+
+async def matchmaker_loop():
+    while True:
+        await asyncio.sleep(matchmaker.tick_interval)
+        try:
+            started = time.perf_counter()
+            matchmaker.tick()
+            MATCH_TICK_DURATION.observe(time.perf_counter() - started)
+        except Exception as e:
+            match_logger.error("❌ Error in matchmaker tick: %s", e)
+
+transcript_writer_stop = asyncio.Event()
+
+async def transcript_writer_loop():
+    # Batches are written on the default executor, off the event loop
+    loop = asyncio.get_running_loop()
+    while not transcript_writer_stop.is_set():
+        await asyncio.sleep(TRANSCRIPT_FLUSH_MS / 1000.0)
+        try:
+            while transcript_sink.pending:
+                started = time.perf_counter()
+                TRANSCRIPT_PERSISTED.inc(await loop.run_in_executor(None, transcript_sink.flush))
+                TRANSCRIPT_FLUSH_DURATION.observe(time.perf_counter() - started)
+        except Exception as e:
+            logger.error("❌ Error writing transcripts: %s", e)
+
+transcript_writer = None  # Task of transcript_writer_loop
+
+async def start_background_tasks():
+    global transcript_writer
+    if STATE_BACKEND == 'redis':
+        # Blocking pub/sub reads on a thread, session updates on the loop
+        threading.Thread(target=user_manager.state.listen,
+                         args=(asyncio.get_running_loop().call_soon_threadsafe,), daemon=True).start()
+    spawn(cleanup_loop())
+    spawn(matchmaker_loop())
+    if transcript_sink is not None:
+        transcript_writer = spawn(transcript_writer_loop())
+    logger.info("Asyncio runtime started, encoding JSON with %s", JSON_CODEC.name)
+
+async def stop_background_tasks():
+    if transcript_writer is not None:
+        # Let the writer finish the batch it is writing, on the executor,
+        # before close() writes what is still queued
+        transcript_writer_stop.set()
+        await transcript_writer
+        transcript_sink.close()
+
+
+# HTTP API, the same routes and responses as app.py minus the debug and
+# admin endpoints
+
+class HTTPRequest:
+    __slots__ = ('method', 'path', 'args', 'headers', 'remote_addr', 'body')
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode()))
+        self.headers = {name.decode().lower(): value.decode() for name, value in scope['headers']}
+        self.remote_addr = forwarded_client((scope.get('client') or ('unknown',))[0],
+                                            self.headers.get('x-forwarded-for'), TRUSTED_PROXY_HOPS)
+        self.body = body
+
+    def get_json(self):
+        """Decoded JSON body, None if it is missing or invalid"""
+        if not self.body:
+            return None
+        try:
+            return JSON_CODEC.loads(self.body)
+        except ValueError:
+            return None
+
+    def user_id(self, data=None):
+        return ((data.get('user_id') if isinstance(data, dict) else None)
+                or self.headers.get('x-user-id') or self.args.get('user_id'))
+
+routes = {}
+
+def route(path, method='GET'):
+    def decorator(func):
+        routes[(method, path)] = func
+        return func
+    return decorator
+
+@route('/')
+async def health_check(req):
+    """Health check endpoint, O(1): counters only, no state dump"""
+    counts = user_manager.get_counts()
+    return 200, {
+        'status': 'healthy',
+        'message': 'Video Chat Backend is running - UPDATED',
+        'rooms': counts,
+        'active_sessions': counts['active_sessions'],
+        'matchmaker': matchmaker.stats(),
+        'runtime': 'asyncio'
+    }
+
+@route('/health/live')
+async def liveness_check(req):
+    return 200, {'status': 'alive'}
+
+@route('/health/ready')
+async def readiness_check(req):
+    """Readiness probe, fails if state is unreachable or matching has stalled"""
+    try:
+        counts = user_manager.get_counts()
+    except Exception as e:
+        logger.error("Readiness check could not read state: %s", e)
+        return 503, {'status': 'unavailable', 'error': 'state backend unreachable'}
+    if matchmaker.is_stalled():
+        return 503, {'status': 'unavailable', 'error': 'matchmaker stalled', 'counts': counts}
+    return 200, {'status': 'ready', 'counts': counts}
+
+@route('/metrics')
+async def metrics_view(req):
+    return 200, REGISTRY.render()
+
+async def start_chat(req, chat_type):
+    """Shared body of /start and /start_video"""
+    data = req.get_json() or {}
+    user_id = req.user_id(data)
+    if not user_id:
+        return 400, {'error': 'User ID required'}
+    if not user_manager.is_active_user(user_id):
+        return 400, {'error': 'User not connected via WebSocket'}
+
+    existing_session_id = user_manager.get_user_session(user_id)
+    chat_session = user_manager.get_session(existing_session_id) if existing_session_id else None
+    if chat_session:
+        return 200, {
+            'session_id': existing_session_id,
+            'status': 'matched',
+            'partner_id': chat_session.get_partner_id(user_id)
+        }
+
+    tags = parse_tags(data, req.args)
+    chat_session = user_manager.match_with_waiting_partner(user_id, chat_type, tags)
+    if chat_session:
+        partner_id = chat_session.user2_id
+        deliver_matched(chat_session, user_id)
+        deliver_matched(chat_session, partner_id)
+        match_logger.info("%s chat matched: %s with %s", chat_type, user_id, partner_id)
+        return 200, {
+            'session_id': chat_session.session_id,
+            'status': 'matched',
+            'partner_id': partner_id
+        }
+    user_manager.add_waiting_user(user_id, chat_type, tags)
+    return 200, {'session_id': None, 'status': 'waiting'}
+
+@route('/start', 'POST')
+async def start_text_chat(req):
+    return await start_chat(req, 'text')
+
+@route('/start_video', 'POST')
+async def start_video_chat(req):
+    return await start_chat(req, 'video')
+
+def session_for(data):
+    """(chat_session, user_id, error response) for a session_id/user_id body"""
+    session_id = data.get('session_id')
+    user_id = data.get('user_id')
+    if not session_id or not user_id:
+        return None, None, (400, {'error': 'Missing session_id or user_id'})
+    chat_session = user_manager.get_session(session_id)
+    if not chat_session or not chat_session.is_user_in_session(user_id):
+        return None, None, (404, {'error': 'Session not found or user not in session'})
+    return chat_session, user_id, None
+
+@route('/send', 'POST')
+async def send_message(req):
+    data = req.get_json() or {}
+    message = data.get('message')
+    if not message:
+        return 400, {'error': 'Missing session_id, message, or user_id'}
+    if not isinstance(message, str):
+        return 400, {'error': 'Message must be a string'}
+    if len(message) > MESSAGE_MAX_CHARS:
+        PAYLOADS_REJECTED.labels('/send', 'length').inc()
+        return 413, {'error': 'Message too long'}
+    chat_session, user_id, error = session_for(data)
+    if error:
+        return error
+    if transcript_sink is not None and transcript_sink.saturated:
+        TRANSCRIPT_BACKPRESSURE.inc()
+        return 503, {'error': 'Transcript store is behind, retry shortly'}
+    added = chat_session.add_message(user_id, message)
+    if added is None:
+        PAYLOADS_REJECTED.labels('/send', 'budget').inc()
+        return 413, {'error': 'Session message budget used up'}
+    msg = message_to_dict(chat_session.session_id, added)
+    await safe_emit('new_message', {
+        'session_id': chat_session.session_id,
+        'message': msg
+    }, chat_session.get_partner_id(user_id))
+    return 200, {'ok': True, 'message_id': msg['id']}
+
+@route('/receive', 'POST')
+async def receive_messages(req):
+    data = req.get_json() or {}
+    chat_session, user_id, error = session_for(data)
+    if error:
+        return error
+    since_seq = data.get('since_seq')
+    if since_seq is not None:
+        try:
+            since_seq = int(since_seq)
+        except (TypeError, ValueError):
+            return 400, {'error': 'since_seq must be an integer'}
+    since_timestamp = data.get('since_timestamp')
+    try:
+        wait = min(float(data.get('wait') or 0), LONG_POLL_MAX_WAIT)
+    except (TypeError, ValueError):
+        return 400, {'error': 'wait must be a number of seconds'}
+    messages = chat_session.get_messages(since_timestamp, since_seq)
+    if not messages and wait > 0 and chat_session.is_active:
+        await chat_session.wait_for_update(wait)
+        messages = chat_session.get_messages(since_timestamp, since_seq)
+    return 200, {
+        'messages': [message_to_dict(chat_session.session_id, msg) for msg in messages],
+        'last_seq': chat_session.messages.last_seq,
+        'disconnected': not chat_session.is_active
+    }
+
+@route('/disconnect', 'POST')
+async def disconnect_chat(req):
+    data = req.get_json() or {}
+    chat_session, user_id, error = session_for(data)
+    if error:
+        return error
+    chat_session.is_active = False
+    await safe_emit('partner_disconnected', {
+        'session_id': chat_session.session_id,
+        'reason': 'partner_left'
+    }, chat_session.get_partner_id(user_id))
+    user_manager.remove_session(chat_session.session_id, 'partner_left')
+    return 200, {'ok': True}
+
+def rate_limit_response(req):
+    """429 response if the request is over its route's quota, else None"""
+    if not rate_limiter.allow(req.path, 'ip', req.remote_addr):
+        RATE_LIMITED.labels(req.path, 'ip').inc()
+        return 429, {'error': 'Rate limit exceeded'}
+    if (req.path, 'user') in RATE_LIMITS:
+        # Keyed on the user a resume token was signed for, never on a
+        # client-supplied user_id; requests without one share a bucket per IP
+        user_id = (resume_tokens.user_id(req.headers.get('x-resume-token'))
+                   or f'anonymous@{req.remote_addr}')
+        if not rate_limiter.allow(req.path, 'user', user_id):
+            RATE_LIMITED.labels(req.path, 'user').inc()
+            return 429, {'error': 'Rate limit exceeded'}
+    return None
+
+CORS_HEADERS = [(b'access-control-allow-origin', b'*')]
+
+async def http_app(scope, receive, send):
+    """Minimal JSON router for the REST API, with permissive CORS"""
+    if scope['type'] != 'http':
+        return
+    started = time.perf_counter()
+    # Bodies over HTTP_MAX_BODY are refused from their Content-Length, or
+    # once a chunked body grows past it, without buffering the rest
+    declared = dict(scope['headers']).get(b'content-length', b'')
+    too_large = declared.isdigit() and int(declared) > HTTP_MAX_BODY
+    body = b''
+    while not too_large:
+        message = await receive()
+        body += message.get('body', b'')
+        too_large = len(body) > HTTP_MAX_BODY
+        if not message.get('more_body'):
+            break
+    req = HTTPRequest(scope, body)
+    headers = list(CORS_HEADERS)
+    if too_large:
+        PAYLOADS_REJECTED.labels('http', 'body').inc()
+        headers.append((b'content-type', b'application/json'))
+        await send({'type': 'http.response.start', 'status': 413, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'{"error": "Request body too large"}'})
+        return
+    if req.method == 'OPTIONS':
+        # CORS preflight for the JSON POSTs
+        requested = req.headers.get('access-control-request-headers', '')
+        headers += [(b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+                    (b'access-control-allow-headers', requested.encode())]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    handler = routes.get((req.method, req.path))
+    endpoint = req.path if handler else 'unmatched'
+    if handler is None:
+        status, payload = 404, {'error': 'Not found'}
+    else:
+        try:
+            status, payload = rate_limit_response(req) or await handler(req)
+        except Exception as e:
+            logger.error("Error handling %s %s: %s", req.method, req.path, e)
+            status, payload = 500, {'error': 'Internal server error'}
+
+    if isinstance(payload, str):
+        content_type, body = REGISTRY.CONTENT_TYPE, payload.encode()
+    else:
+        content_type, body = 'application/json', JSON_CODEC.dumps(payload).encode()
+    headers.append((b'content-type', content_type.encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+    HTTP_DURATION.labels(endpoint, req.method, str(status)).observe(time.perf_counter() - started)
+
+
+# Socket.IO event handlers
+
+def rate_limited(event):
+    """Decorator dropping Socket.IO events a socket sends over its quota"""
+    limited = RATE_LIMITED.labels(event, 'sid')
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(sid, *args):
+            if not rate_limiter.allow(event, 'sid', sid):
+                limited.inc()
+                return None
+            return await func(sid, *args)
+        return wrapper
+    return decorator
+
+def remote_addr(environ):
+    # The ASGI environ hardcodes REMOTE_ADDR, the real peer is in the scope
+    return forwarded_client((environ['asgi.scope'].get('client') or ('unknown',))[0],
+                            environ.get('HTTP_X_FORWARDED_FOR'), TRUSTED_PROXY_HOPS)
+
+@sio.on('connect')
+async def handle_connect(sid, environ, auth=None):
+    if not rate_limiter.allow('connect', 'ip', remote_addr(environ)):
+        RATE_LIMITED.labels('connect', 'ip').inc()
+        return False
+    args = dict(parse_qsl(environ.get('QUERY_STRING', '')))
+    if await resume_user(sid, auth, args):
+        return
+
+    user_id = str(uuid.uuid4())
+    user_manager.map_socket(sid, user_id)
+    user_manager.bind_user_socket(user_id, sid)
+    await sio.enter_room(sid, user_id)
+    readiness.register(user_id, sid)
+    user_manager.add_active_user(user_id)
+    # The client's ack marks it ready to receive matched events
+    await safe_emit('user_id', user_id_payload(user_id), sid,
+                    callback=lambda *args: readiness.mark_ready(user_id))
+    # Queue for auto-match, the matchmaker loop pairs users on its next tick
+    if not user_manager.get_user_session(user_id):
+        user_manager.add_waiting_user(user_id, 'video', parse_tags(None, args))
+
+async def resume_user(sid, auth, args):
+    """Reattach sid to the user named by a resume token, see app.resume_user"""
+    token = auth.get('resume_token') if isinstance(auth, dict) else None
+    token = token or args.get('resume_token')
+    if not token:
+        return False
+    user_id = resume_tokens.user_id(token)
+    if user_id is None:
+        RESUMES.labels('invalid').inc()
+        return False
+    old_sid = user_manager.bind_user_socket(user_id, sid)
+    if old_sid is None or not user_manager.is_active_user(user_id):
+        user_manager.release_user_socket(user_id, sid)
+        RESUMES.labels('expired').inc()
+        return False
+    grace_periods.cancel(user_id)
+
+    user_manager.map_socket(sid, user_id)
+    if old_sid != sid and user_manager.unmap_socket(old_sid):
+        user_manager.signal_routes.drop_sid(old_sid)
+        await sio.disconnect(old_sid)
+    await sio.enter_room(sid, user_id)
+    readiness.register(user_id, sid)
+    RESUMES.labels('resumed').inc()
+
+    session_id = user_manager.get_user_session(user_id)
+    await safe_emit('user_id', user_id_payload(user_id, resumed=True, session_id=session_id), sid,
+                    callback=lambda *args: readiness.mark_ready(user_id))
+    chat_session = user_manager.get_session(session_id) if session_id else None
+    if chat_session:
+        deliver_matched(chat_session, user_id)
+        await safe_emit('partner_reconnected', {'session_id': session_id},
+                        chat_session.get_partner_id(user_id))
+    return True
+
+@sio.on('request_user_id')
+@rate_limited('request_user_id')
+@timed(SOCKET_DURATION.labels('request_user_id'))
+async def handle_request_user_id(sid, data=None):
+    user_id = user_manager.get_socket_user(sid)
+    if user_id:
+        readiness.mark_ready(user_id, acks=False)
+        await safe_emit('user_id', user_id_payload(user_id), sid)
+
+@sio.on('client_ready')
+@rate_limited('client_ready')
+@timed(SOCKET_DURATION.labels('client_ready'))
+async def handle_client_ready(sid, data=None):
+    user_id = user_manager.get_socket_user(sid)
+    if user_id:
+        readiness.mark_ready(user_id)
+    return True
+
+@sio.on('disconnect')
+@timed(SOCKET_DURATION.labels('disconnect'))
+async def handle_disconnect(sid):
+    user_id = user_manager.unmap_socket(sid)
+    user_manager.signal_routes.drop_sid(sid)
+    if not user_id or user_manager.get_user_socket(user_id) != sid:
+        return  # Unknown socket, or superseded by a resumed one
+    readiness.forget(user_id)
+    if RESUME_GRACE > 0:
+        grace_periods.start(user_id, sid)
+        session_id = user_manager.get_user_session(user_id)
+        chat_session = user_manager.get_session(session_id) if session_id else None
+        if chat_session:
+            await safe_emit('partner_reconnecting', {
+                'session_id': session_id,
+                'grace': RESUME_GRACE
+            }, chat_session.get_partner_id(user_id))
+        return
+    user_manager.release_user_socket(user_id, sid)
+    end_user(user_id)
+
+@sio.on('join_session')
+@rate_limited('join_session')
+@timed(SOCKET_DURATION.labels('join_session'))
+async def handle_join_session(sid, data=None):
+    session_id = data.get('session_id') if isinstance(data, dict) else None
+    user_id = user_manager.get_socket_user(sid)
+    if session_id and user_id:
+        await sio.enter_room(sid, session_id)
+        user_manager.user_rooms[user_id] = session_id
+
+@sio.on('leave_session')
+@rate_limited('leave_session')
+@timed(SOCKET_DURATION.labels('leave_session'))
+async def handle_leave_session(sid, data=None):
+    session_id = data.get('session_id') if isinstance(data, dict) else None
+    user_id = user_manager.get_socket_user(sid)
+    if session_id and user_id:
+        await sio.leave_room(sid, session_id)
+        user_manager.user_rooms.pop(user_id, None)
+
+def signal_route(sid, data):
+    """Cached partner route for a signaling event, None if it is invalid"""
+    session_id = data.get('session_id') if isinstance(data, dict) else None
+    if not session_id:
+        return None
+    route = user_manager.signal_routes.get(sid, session_id)
+    if route is None:
+        route = user_manager.resolve_signal_route(sid, session_id)
+    return route
+
+@sio.on('webrtc_signal')
+@rate_limited('webrtc_signal')
+@timed(SOCKET_DURATION.labels('webrtc_signal'))
+async def handle_webrtc_signal(sid, data=None):
+    """Relay a WebRTC signal to the partner, see app.handle_webrtc_signal"""
+    route = signal_route(sid, data)
+    if route is None or not data.get('signal'):
+        return
+    route.chat_session.touch()
+    data['from'] = route.user_id
+    if signal_coalescer is not None:
+        signal_coalescer.relay(route, data)
+    else:
+        await sio.emit('webrtc_signal', data, to=route.partner_id)
+    SIGNALS_RELAYED_WEBRTC.inc()
+
+@sio.on('user_typing')
+@rate_limited('user_typing')
+@timed(SOCKET_DURATION.labels('user_typing'))
+async def handle_user_typing(sid, data=None):
+    route = signal_route(sid, data)
+    if route is None:
+        return
+    route.chat_session.touch()
+    typing_throttle.update(route, bool(data.get('is_typing', False)))
+
+
+app = socketio.ASGIApp(sio, http_app, on_startup=start_background_tasks,
+                       on_shutdown=stop_background_tasks)
+
+if __name__ == '__main__':
+    import uvicorn
+    logger.info("Starting Video Chat Backend (asyncio)...")
+    uvicorn.run(app, host='0.0.0.0', port=8081, log_level='warning')
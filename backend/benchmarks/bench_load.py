@@ -0,0 +1,534 @@
+"""End-to-end load test of the Socket.IO + REST flow against a real server
+
+Launches the server in a subprocess on a free local port (or targets
+--url) and drives N simulated users through what the frontend does: connect over
+WebSocket and wait for user_id, call /start_video, wait for matched,
+exchange an offer, an answer and trickle ICE candidates with the partner
+via webrtc_signal, send one text message through /send, then disconnect.
+Every phase runs for all users before the next one starts, so a slow
+phase shows up in its own numbers.
+
+Reports connects/s, time-to-match percentiles (from user_id to matched),
+webrtc_signal relay latency percentiles (sender to partner, both in this
+process), server RSS per connected user and server CPU time. Server
+numbers come from /proc and are only available on Linux when the server
+was launched by this script. The driver's own CPU time is printed too: if
+it is close to the wall time, the driver and not the server is the limit.
+
+--mode picks the server runtime: eventlet (app.py, the default), asyncio
+(asgi_app.py under uvicorn) or both, which runs the scenario against each
+in turn and ends with a side by side table of connects/s, server memory
+per connection and p99 signal latency. --workers N launches the eventlet
+runtime as N sharded workers through supervisor.py instead; server memory
+and CPU are then summed over the workers. Such a run also counts the
+pairs whose users live on different workers (from the same hash ring the
+workers use) and exits with status 1 if there were none, or if any
+connected user was left without a complete pair.
+
+--transport polling connects over Engine.IO long-polling instead of
+WebSocket, and both runs the scenario once with each to put a price on
+the polling fallback. With --workers, polling requests that arrive on a
+new connection are forwarded to the worker holding their session.
+
+Needs python-socketio's asyncio client with aiohttp
+(aiohttp is pinned in requirements.txt). Large presets need a
+high open file limit (ulimit -n) for both processes; the script raises
+the soft limit to the hard limit where it can. Rate limits are turned off
+for the launched server, since every simulated user shares 127.0.0.1.
+
+Usage: python benchmarks/bench_load.py [smoke|small|medium|large|xlarge|<users>]
+                                       [--url URL] [--concurrency N] [--candidates N]
+                                       [--mode eventlet|asyncio|both] [--workers N]
+                                       [--transport websocket|polling|both]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    import aiohttp
+    import socketio
+except ImportError:
+    sys.exit('bench_load.py needs aiohttp and python-socketio: pip install -r requirements.txt')
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from sharding import HashRing
+
+# Scenario presets: simulated users and how many connect at once
+PRESETS = {
+    'smoke': (100, 50),
+    'small': (1000, 100),
+    'medium': (5000, 200),
+    'large': (10000, 200),
+    'xlarge': (20000, 250),
+}
+
+PHASE_TIMEOUT = 120.0
+
+# Run each runtime without the debug reloader and with the open file limit raised
+SERVER_PRELUDE = """
+import resource, sys
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+"""
+SERVER_CODE = {
+    'eventlet': SERVER_PRELUDE + """
+import app
+app.socketio.run(app.app, host='127.0.0.1', port=int(sys.argv[1]), log_output=False)
+""",
+    'asyncio': SERVER_PRELUDE + """
+import uvicorn, asgi_app
+uvicorn.run(asgi_app.app, host='127.0.0.1', port=int(sys.argv[1]), log_level='warning', access_log=False)
+""",
+}
+
+# Raises the limit for the supervisor, its workers inherit it
+SUPERVISOR_CODE = """
+import supervisor
+sys.argv[0] = 'supervisor.py'
+supervisor.main()
+"""
+
+# Every route and event the benchmark uses, from a single IP
+NO_IP_LIMITS = 'connect.ip=0,/start_video.ip=0,/start.ip=0,/send.ip=0,/receive.ip=0'
+
+OFFER_SDP = (
+    'v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n'
+    'a=group:BUNDLE 0 1\r\na=msid-semantic: WMS stream\r\n'
+    'm=audio 9 UDP/TLS/RTP/SAVPF 111 103 104 9 0 8 106 105 13 110 112 113 126\r\n'
+    'c=IN IP4 0.0.0.0\r\na=rtcp:9 IN IP4 0.0.0.0\r\na=ice-ufrag:sXy2\r\n'
+    'a=ice-pwd:0d8Bhq7kTQ1e1b1aBFcbmUcQ\r\na=ice-options:trickle\r\n'
+    'a=fingerprint:sha-256 7B:8B:F0:65:5F:78:E2:51:3B:AC:6F:F3:3F:46:1B:35:DC:B8:5F:64:'
+    '1A:24:C2:43:F0:A1:58:D0:A1:2C:19:08\r\na=setup:actpass\r\na=mid:0\r\n'
+    'a=sendrecv\r\na=rtcp-mux\r\na=rtpmap:111 opus/48000/2\r\na=fmtp:111 minptime=10;useinbandfec=1\r\n'
+    'm=video 9 UDP/TLS/RTP/SAVPF 96 97 98 99 100 101 102\r\nc=IN IP4 0.0.0.0\r\n'
+    'a=mid:1\r\na=sendrecv\r\na=rtcp-mux\r\na=rtcp-rsize\r\na=rtpmap:96 VP8/90000\r\n'
+    'a=rtcp-fb:96 goog-remb\r\na=rtcp-fb:96 transport-cc\r\na=rtcp-fb:96 ccm fir\r\n'
+    'a=rtcp-fb:96 nack\r\na=rtcp-fb:96 nack pli\r\na=rtpmap:97 rtx/90000\r\na=fmtp:97 apt=96\r\n'
+)
+
+CANDIDATE = ('candidate:842163049 1 udp 1677729535 203.0.113.7 46154 typ srflx '
+             'raddr 10.0.0.12 rport 46154 generation 0 ufrag sXy2 network-cost 999')
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def proc_tree(pid):
+    """pid and its child processes, e.g. the supervisor and its workers"""
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as children:
+            return [pid] + [int(child) for child in children.read().split()]
+    except OSError:
+        return [pid]
+
+
+def proc_rss(pid):
+    """Resident set size of pid and its children in bytes, None if /proc is unavailable"""
+    try:
+        total = 0
+        for member in proc_tree(pid):
+            with open(f'/proc/{member}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        return total
+    except OSError:
+        return None
+
+
+def proc_cpu(pid):
+    """User + system CPU seconds used by pid and its children, None if /proc is unavailable"""
+    try:
+        total = 0
+        for member in proc_tree(pid):
+            with open(f'/proc/{member}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        return total / os.sysconf('SC_CLK_TCK')
+    except OSError:
+        return None
+
+
+class Stats:
+    def __init__(self):
+        self.connect_times = []
+        self.match_times = []
+        self.signal_latencies = []
+        self.signals_received = 0
+        self.messages_received = 0
+        self.errors = {}
+
+    def error(self, phase):
+        self.errors[phase] = self.errors.get(phase, 0) + 1
+
+
+class LoadClient:
+    """One simulated user"""
+
+    def __init__(self, stats, candidates, transport='websocket'):
+        self.stats = stats
+        self.candidates = candidates
+        self.transport = transport
+        # Engine.IO's HTTP session is owned here, so close() always closes it
+        # (left to itself, a polling client can open a new one after disconnect)
+        self.http = aiohttp.ClientSession()
+        self.sio = socketio.AsyncClient(reconnection=False, http_session=self.http)
+        self.user_id = None
+        self.user_id_at = None
+        self.headers = {}  # X-Resume-Token, what per-user rate limits key on
+        self.session_id = None
+        self.is_initiator = False
+        # The partner sends an offer or an answer plus its candidates
+        self.signals_seen = 0
+        self.signals_expected = 1 + candidates
+        self.got_user_id = asyncio.Event()
+        self.matched = asyncio.Event()
+        self.signals_done = asyncio.Event()
+        self.message_received = asyncio.Event()
+        self.sio.on('user_id', self.on_user_id)
+        self.sio.on('matched', self.on_matched)
+        self.sio.on('webrtc_signal', self.on_signal)
+        self.sio.on('webrtc_signal_batch', self.on_signal_batch)
+        self.sio.on('new_message', self.on_message)
+
+    async def on_user_id(self, data):
+        if self.user_id is None:
+            self.user_id = data['user_id']
+            self.user_id_at = time.perf_counter()
+            self.headers = {'X-Resume-Token': data['resume_token']}
+            self.got_user_id.set()
+        return True  # Ack, tells the server matched can be sent right away
+
+    async def on_matched(self, data):
+        if self.session_id is None:
+            self.session_id = data['session_id']
+            self.is_initiator = bool(data.get('is_initiator'))
+            self.stats.match_times.append(time.perf_counter() - self.user_id_at)
+            self.matched.set()
+        return True  # Ack, or the server sends matched again
+
+    def _received(self, signal):
+        self.stats.signal_latencies.append(time.perf_counter() - signal['t'])
+        self.stats.signals_received += 1
+        self.signals_seen += 1
+        if self.signals_seen >= self.signals_expected:
+            self.signals_done.set()
+
+    async def on_signal(self, data):
+        signal = data['signal']
+        self._received(signal)
+        if signal.get('type') == 'offer':
+            await self.send_signal({'type': 'answer', 'sdp': OFFER_SDP})
+
+    async def on_signal_batch(self, data):
+        for signal in data['signals']:
+            self._received(signal)
+
+    async def on_message(self, data):
+        self.stats.messages_received += 1
+        self.message_received.set()
+
+    async def send_signal(self, signal):
+        signal['t'] = time.perf_counter()
+        await self.sio.emit('webrtc_signal', {'session_id': self.session_id, 'signal': signal})
+
+    async def connect(self, url):
+        started = time.perf_counter()
+        await self.sio.connect(url, transports=[self.transport])
+        await self.got_user_id.wait()
+        self.stats.connect_times.append(time.perf_counter() - started)
+
+    async def start_video(self, http, url):
+        async with http.post(f'{url}/start_video', json={'user_id': self.user_id},
+                             headers=self.headers) as response:
+            response.raise_for_status()
+            await response.read()
+
+    async def exchange_signals(self):
+        if self.is_initiator:
+            await self.send_signal({'type': 'offer', 'sdp': OFFER_SDP})
+        for index in range(self.candidates):
+            await self.send_signal({'type': 'candidate', 'candidate': {
+                'candidate': CANDIDATE, 'sdpMid': '0', 'sdpMLineIndex': index % 2}})
+        await self.signals_done.wait()
+
+    async def close(self):
+        """Disconnect if still connected, then close the HTTP session"""
+        eio = self.sio.eio
+        try:
+            if self.sio.connected:
+                await self.sio.disconnect()
+            tasks = [task for task in (eio.read_loop_task, eio.write_loop_task) if task is not None]
+            if tasks:
+                # A long-poll in flight ends when the server closes the session
+                _, pending = await asyncio.wait(tasks, timeout=PHASE_TIMEOUT)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        except Exception:
+            pass
+        finally:
+            await self.http.close()
+
+    async def send_text(self, http, url):
+        if self.is_initiator:
+            body = {'session_id': self.session_id, 'user_id': self.user_id, 'message': 'hello'}
+            async with http.post(f'{url}/send', json=body, headers=self.headers) as response:
+                response.raise_for_status()
+                await response.read()
+        else:
+            await self.message_received.wait()
+
+
+def hold_back_for_cross_shard(clients, ring):
+    """Set aside up to two clients so at least two workers own an odd number
+
+    Each of those workers is left with a user it cannot pair locally, so
+    the run always has to make pairs across workers. Returns (clients to
+    match, clients held back).
+    """
+    by_shard = {}
+    for client in clients:
+        by_shard.setdefault(ring.lookup(client.user_id), []).append(client)
+    if len(by_shard) < 2 or any(len(owned) % 2 for owned in by_shard.values()):
+        return clients, []
+    held = [owned[-1] for owned in list(by_shard.values())[:2]]
+    return [client for client in clients if client not in held], held
+
+
+async def run_phase(name, clients, step, stats, concurrency=None):
+    """Run step(client) for every client, returns (seconds, clients that succeeded)"""
+    gate = asyncio.Semaphore(concurrency) if concurrency else None
+
+    async def guarded(client):
+        try:
+            if gate is None:
+                await asyncio.wait_for(step(client), PHASE_TIMEOUT)
+            else:
+                async with gate:
+                    await asyncio.wait_for(step(client), PHASE_TIMEOUT)
+            return client
+        except Exception:
+            stats.error(name)
+            return None
+
+    started = time.perf_counter()
+    done = await asyncio.gather(*(guarded(client) for client in clients))
+    return time.perf_counter() - started, [client for client in done if client is not None]
+
+
+async def run_scenario(url, users, concurrency, candidates, server_pid, transport='websocket', workers=1):
+    stats = Stats()
+    clients = [LoadClient(stats, candidates, transport) for _ in range(users)]
+    cpu_start = proc_cpu(server_pid) if server_pid else None
+    rss_idle = proc_rss(server_pid) if server_pid else None
+    driver_cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as http:
+            connect_time, connected = await run_phase(
+                'connect', clients, lambda c: c.connect(url), stats, concurrency)
+            # Users are owned by the worker their user_id hashes to
+            ring = HashRing(range(workers))
+            matching, held = hold_back_for_cross_shard(connected, ring) if workers > 1 else (connected, [])
+            _, started = await run_phase(
+                'start_video', matching, lambda c: c.start_video(http, url), stats, concurrency)
+            match_time, matched = await run_phase(
+                'match', started, lambda c: c.matched.wait(), stats)
+            rss_matched = proc_rss(server_pid) if server_pid else None
+
+            # Only pairs where both users saw matched take part in signaling
+            in_session = {}
+            for client in matched:
+                in_session.setdefault(client.session_id, []).append(client)
+            pairs = [pair for pair in in_session.values() if len(pair) == 2]
+            paired = [client for pair in pairs for client in pair]
+            cross_shard = sum(1 for a, b in pairs if ring.lookup(a.user_id) != ring.lookup(b.user_id))
+            signal_time, _ = await run_phase('signal', paired, LoadClient.exchange_signals, stats)
+            await run_phase('send', paired, lambda c: c.send_text(http, url), stats)
+            disconnect_time, _ = await run_phase(
+                'disconnect', connected, lambda c: c.sio.disconnect(), stats, concurrency)
+            wall = time.perf_counter() - wall_start
+    finally:
+        # Clients that failed to connect or disconnect hold a session too
+        await asyncio.gather(*(client.close() for client in clients))
+
+    cpu_end = proc_cpu(server_pid) if server_pid else None
+    return {
+        'users': users,
+        'connected': len(connected),
+        'connects_per_s': len(connected) / connect_time if connect_time else 0,
+        'matched': len(matched),
+        'paired': len(paired),
+        'held_back': len(held),
+        'workers': workers,
+        'cross_shard_pairs': cross_shard,
+        'match_phase_s': match_time,
+        'signal_phase_s': signal_time,
+        'disconnect_s': disconnect_time,
+        'rss_per_user': ((rss_matched - rss_idle) / len(connected)
+                         if rss_idle is not None and rss_matched is not None and connected else None),
+        'server_cpu_s': cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None,
+        'driver_cpu_s': time.process_time() - driver_cpu_start,
+        'wall_s': wall,
+        'stats': stats,
+    }
+
+
+def launch_server(port, mode, workers=1):
+    env = dict(os.environ)
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    env['RATE_LIMITS'] = ','.join(filter(None, (env.get('RATE_LIMITS'), NO_IP_LIMITS)))
+    if workers > 1:
+        command = [sys.executable, '-c', SERVER_PRELUDE + SUPERVISOR_CODE,
+                   '--workers', str(workers), '--host', '127.0.0.1', '--port', str(port)]
+    else:
+        command = [sys.executable, '-c', SERVER_CODE[mode], str(port)]
+    server = subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'Server exited with status {server.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                if workers > 1:
+                    time.sleep(3)  # The first worker is up, give the others time to start
+                return server, url
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit('Server did not start listening within 30s')
+
+
+def print_report(r):
+    s = r['stats']
+    ms = 1000.0
+    print(f"users      {r['users']} requested, {r['connected']} connected, "
+          f"{r['matched']} matched, {r['paired']} in complete pairs")
+    print(f"connect    {r['connects_per_s']:.0f} connects/s   "
+          f"p50 {percentile(s.connect_times, 50) * ms:.1f}ms  "
+          f"p99 {percentile(s.connect_times, 99) * ms:.1f}ms")
+    print(f"match      p50 {percentile(s.match_times, 50) * ms:.1f}ms  "
+          f"p90 {percentile(s.match_times, 90) * ms:.1f}ms  "
+          f"p99 {percentile(s.match_times, 99) * ms:.1f}ms  "
+          f"max {max(s.match_times, default=float('nan')) * ms:.1f}ms")
+    print(f"signal     {s.signals_received} relayed in {r['signal_phase_s']:.2f}s   "
+          f"p50 {percentile(s.signal_latencies, 50) * ms:.2f}ms  "
+          f"p90 {percentile(s.signal_latencies, 90) * ms:.2f}ms  "
+          f"p99 {percentile(s.signal_latencies, 99) * ms:.2f}ms")
+    print(f"messages   {s.messages_received} delivered")
+    if r['workers'] > 1:
+        print(f"shards     {r['cross_shard_pairs']} of {r['paired'] // 2} pairs across workers, "
+              f"{r['held_back']} users held back to force some")
+    if r['rss_per_user'] is not None:
+        print(f"memory     {r['rss_per_user'] / 1024:.1f} KiB server RSS per connected user")
+    if r['server_cpu_s'] is not None:
+        print(f"cpu        server {r['server_cpu_s']:.2f}s, driver {r['driver_cpu_s']:.2f}s, "
+              f"wall {r['wall_s']:.2f}s")
+    else:
+        print(f"cpu        driver {r['driver_cpu_s']:.2f}s, wall {r['wall_s']:.2f}s")
+    if s.errors:
+        print('errors     ' + ', '.join(f'{phase}={count}' for phase, count in s.errors.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenario', nargs='?', default='smoke',
+                        help=f"one of {', '.join(PRESETS)} or a number of users")
+    parser.add_argument('--url', help='benchmark a server that is already running instead')
+    parser.add_argument('--concurrency', type=int, help='connects and HTTP calls in flight at once')
+    parser.add_argument('--candidates', type=int, default=4, help='ICE candidates each user sends')
+    parser.add_argument('--mode', choices=('eventlet', 'asyncio', 'both'), default='eventlet',
+                        help='server runtime to launch, ignored with --url')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='launch N sharded eventlet workers through supervisor.py')
+    parser.add_argument('--transport', choices=('websocket', 'polling', 'both'), default='websocket',
+                        help='Engine.IO transport the simulated users connect with')
+    args = parser.parse_args()
+
+    if args.scenario in PRESETS:
+        users, concurrency = PRESETS[args.scenario]
+    else:
+        users, concurrency = int(args.scenario), 100
+    users -= users % 2  # An odd user out would only time out waiting for a partner
+    concurrency = args.concurrency or concurrency
+    raise_file_limit()
+
+    transports = ('websocket', 'polling') if args.transport == 'both' else (args.transport,)
+    if args.url is not None:
+        for transport in transports:
+            run_one(args.url, None, users, concurrency, args.candidates, transport)
+        return
+    if args.workers > 1:
+        args.mode = f'{args.workers} shards'
+    modes = ('eventlet', 'asyncio') if args.mode == 'both' else (args.mode,)
+    results = {}
+    for mode in modes:
+        for transport in transports:
+            # A fresh server per run, so memory and CPU are not carried over
+            server, url = launch_server(free_port(), mode, args.workers)
+            name = f'{mode} {transport}' if len(transports) > 1 else mode
+            try:
+                print(f"[{name}]")
+                results[name] = run_one(url, server.pid, users, concurrency, args.candidates, transport,
+                                        args.workers)
+            finally:
+                server.terminate()
+                server.wait()
+            print()
+    if len(results) > 1:
+        print_comparison(results)
+    if args.workers > 1:
+        failed = [name for name, r in results.items()
+                  if not r['cross_shard_pairs'] or r['paired'] < r['connected'] - r['held_back']]
+        if failed:
+            sys.exit(f"Sharded run failed for {', '.join(failed)}: "
+                     "no pairs across workers, or users left without a partner")
+
+
+def run_one(url, server_pid, users, concurrency, candidates, transport='websocket', workers=1):
+    print(f"{users} users against {url} over {transport}, {concurrency} in flight, "
+          f"{candidates} candidates each")
+    result = asyncio.run(run_scenario(url, users, concurrency, candidates, server_pid, transport, workers))
+    print_report(result)
+    return result
+
+
+def print_comparison(results):
+    width = max(10, max(len(name) for name in results) + 2)
+    print(f"{'runtime':<{width}}{'connects/s':>12}{'KiB/conn':>10}{'signal p99':>12}{'server cpu':>12}")
+    for mode, r in results.items():
+        rss = f"{r['rss_per_user'] / 1024:.1f}" if r['rss_per_user'] is not None else 'n/a'
+        cpu = f"{r['server_cpu_s']:.2f}s" if r['server_cpu_s'] is not None else 'n/a'
+        p99 = percentile(r['stats'].signal_latencies, 99) * 1000.0
+        print(f"{mode:<{width}}{r['connects_per_s']:>12.0f}{rss:>10}{p99:>10.2f}ms{cpu:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Handler latency with logging on and off
+
+Runs /start_video (waiting path) and /send through the Flask test client
+with a few thousand users online, under several logging setups:
+
+  off             root level WARNING
+  info-sync       INFO, records written synchronously (LOG_QUEUE=0)
+  info-queued     INFO, records handed to the listener thread
+  debug-sampled   DEBUG everywhere, state dumps sampled 1 in LOG_SAMPLE_N
+
+Log output goes to /dev/null so terminal speed doesn't skew the numbers.
+
+Usage: python benchmarks/bench_logging.py [online_users] [requests]
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as backend
+from logging_setup import configure_logging
+
+MODES = {
+    'off': {'LOG_LEVEL': 'WARNING', 'LOG_QUEUE': '1'},
+    'info-sync': {'LOG_LEVEL': 'INFO', 'LOG_QUEUE': '0'},
+    'info-queued': {'LOG_LEVEL': 'INFO', 'LOG_QUEUE': '1'},
+    'debug-sampled': {'LOG_LEVEL': 'DEBUG', 'LOG_QUEUE': '1', 'LOG_LEVELS': 'transport=WARNING'}
+}
+
+
+def reconfigure(env):
+    os.environ.pop('LOG_LEVELS', None)
+    os.environ.update(env)
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+    try:
+        configure_logging()
+    finally:
+        sys.stderr = stderr
+
+
+def bench(mode, requests):
+    client = backend.app.test_client()
+    users = [f"{mode}-{i}" for i in range(requests)]
+    for user_id in users:
+        backend.user_manager.add_active_user(user_id)
+
+    # Every /start_video takes the waiting path, the one that used to dump
+    # the waiting room; the user is taken back out between requests
+    elapsed = 0.0
+    for user_id in users:
+        start = time.perf_counter()
+        client.post('/start_video', json={'user_id': user_id})
+        elapsed += time.perf_counter() - start
+        backend.user_manager.remove_connected_user(user_id)
+    start_video = elapsed / requests
+
+    chat_session = backend.user_manager.create_session(users[0], users[1], 'text')
+    body = {'session_id': chat_session.session_id, 'user_id': users[0], 'message': 'hi'}
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.post('/send', json=body)
+    send = (time.perf_counter() - start) / requests
+
+    return start_video, send
+
+
+def main():
+    online = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    reconfigure(MODES['off'])
+    for i in range(online):
+        backend.user_manager.add_active_user(f"idle-{i}")
+
+    print(f"{online} idle users online, {requests} requests per endpoint")
+    print(f"{'mode':<16}{'/start_video':>14}{'/send':>12}")
+    for mode, env in MODES.items():
+        reconfigure(env)
+        start_video, send = bench(mode, requests)
+        print(f"{mode:<16}{start_video * 1e6:>11.1f} us{send * 1e6:>9.1f} us")
+    logging.shutdown()
+
+
+if __name__ == '__main__':
+    main()
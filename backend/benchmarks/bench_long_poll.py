@@ -0,0 +1,98 @@
+"""Load test comparing short-polling and long-polling on /receive
+
+Creates text sessions directly through user_manager, then runs one
+receiver greenlet per session against the Flask test client while a sender
+posts a message to every session at a fixed interval. Reports /receive
+requests per second, the share of empty polls and process CPU time.
+
+Usage: python benchmarks/bench_long_poll.py [sessions] [seconds]
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eventlet
+
+import app as backend
+
+POLL_INTERVAL = 0.1    # How often a short-polling client asks for messages
+SEND_INTERVAL = 1.0    # How often each session receives a new message
+LONG_POLL_WAIT = 25
+
+
+def run(mode, sessions, duration):
+    client = backend.app.test_client()
+    stats = {'requests': 0, 'empty': 0, 'delivered': 0}
+    deadline = time.monotonic() + duration
+
+    def receiver(chat_session):
+        cursor = 0
+        body = {'session_id': chat_session.session_id, 'user_id': chat_session.user2_id}
+        if mode == 'long-poll':
+            body['wait'] = LONG_POLL_WAIT
+        while time.monotonic() < deadline:
+            body['since_seq'] = cursor
+            data = client.post('/receive', json=body).get_json()
+            stats['requests'] += 1
+            if data['messages']:
+                stats['delivered'] += len(data['messages'])
+                cursor = data['last_seq']
+            else:
+                stats['empty'] += 1
+            if mode == 'poll':
+                eventlet.sleep(POLL_INTERVAL)
+
+    def sender():
+        while time.monotonic() < deadline:
+            eventlet.sleep(SEND_INTERVAL)
+            for chat_session in chat_sessions:
+                client.post('/send', json={
+                    'session_id': chat_session.session_id,
+                    'user_id': chat_session.user1_id,
+                    'message': 'ping'
+                })
+
+    chat_sessions = [
+        backend.user_manager.create_session(f"{mode}-a{i}", f"{mode}-b{i}", 'text')
+        for i in range(sessions)
+    ]
+
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    pool = eventlet.GreenPool(sessions + 1)
+    pool.spawn(sender)
+    for chat_session in chat_sessions:
+        pool.spawn(receiver, chat_session)
+    # Close sessions at the deadline so parked long-polls return promptly
+    eventlet.sleep(duration)
+    for chat_session in chat_sessions:
+        backend.user_manager.remove_session(chat_session.session_id)
+    pool.waitall()
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+
+    return {
+        'rps': stats['requests'] / elapsed,
+        'empty_pct': 100.0 * stats['empty'] / max(stats['requests'], 1),
+        'delivered': stats['delivered'],
+        'cpu': cpu
+    }
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    logging.disable(logging.INFO)
+
+    print(f"{sessions} sessions, {duration:.0f}s, one message per session every {SEND_INTERVAL}s")
+    print(f"{'mode':<12}{'req/s':>10}{'empty %':>10}{'delivered':>12}{'cpu s':>10}")
+    for mode in ('poll', 'long-poll'):
+        r = run(mode, sessions, duration)
+        print(f"{mode:<12}{r['rps']:>10.1f}{r['empty_pct']:>10.1f}{r['delivered']:>12}{r['cpu']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Microbenchmark for the matchmaking waiting room
+
+Compares the old list-based waiting room against MatchQueue for the three
+operations on the connect/disconnect path: enqueue (with duplicate check),
+dequeue-excluding-self and cancel.
+
+Then compares interest matching: a filtered scan over a list of tagged
+users (best tag overlap, oldest first) against TagMatchQueue's per-tag
+buckets, for a requester with tags picking a partner and a new tagged
+user joining to keep the room size constant.
+
+Usage: python benchmarks/bench_matchmaking.py [sizes...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matchmaking import MatchQueue, TagMatchQueue
+
+
+class ListRoom:
+    """The original list-based waiting room, kept here for comparison"""
+
+    def __init__(self):
+        self.users = []
+
+    def enqueue(self, user_id):
+        if user_id not in self.users:
+            self.users.append(user_id)
+            return True
+        return False
+
+    def dequeue(self, exclude_user_id=None):
+        for i, user_id in enumerate(self.users):
+            if user_id != exclude_user_id:
+                return self.users.pop(i)
+        return None
+
+    def cancel(self, user_id):
+        if user_id in self.users:
+            self.users.remove(user_id)
+            return True
+        return False
+
+
+def bench(room_cls, size, ops=2000):
+    """Time enqueue/dequeue/cancel with `size` users already waiting"""
+    room = room_cls()
+    for i in range(size):
+        room.enqueue(f"user-{i}")
+
+    results = {}
+
+    start = time.perf_counter()
+    for i in range(ops):
+        room.enqueue(f"new-{i}")
+    results['enqueue'] = (time.perf_counter() - start) / ops
+
+    # Cancel users spread across the queue, as disconnects would
+    victims = [f"user-{i}" for i in random.sample(range(size), ops)]
+    start = time.perf_counter()
+    for user_id in victims:
+        room.cancel(user_id)
+    results['cancel'] = (time.perf_counter() - start) / ops
+
+    start = time.perf_counter()
+    for i in range(ops):
+        # Exclude the head so the excluded-self branch is exercised too
+        head = next(iter(room.users)) if isinstance(room, ListRoom) else next(iter(room))
+        room.dequeue(exclude_user_id=head if i % 2 else None)
+    results['dequeue'] = (time.perf_counter() - start) / ops
+
+    return results
+
+
+INTERESTS = [f"topic-{i}" for i in range(500)]
+LANGUAGES = [f"lang:{i}" for i in range(30)]
+
+
+def random_tags(rng):
+    return frozenset(rng.sample(INTERESTS, 2) + [rng.choice(LANGUAGES)])
+
+
+class ScanTagRoom:
+    """Tag matching by scanning every waiting user"""
+
+    def __init__(self):
+        self.users = []  # (user_id, tags), oldest first
+
+    def enqueue(self, user_id, tags):
+        self.users.append((user_id, tags))
+
+    def dequeue(self, exclude_user_id=None, tags=None):
+        best = best_overlap = None
+        for i, (user_id, user_tags) in enumerate(self.users):
+            overlap = len(tags & user_tags)
+            if user_id != exclude_user_id and overlap and (best is None or overlap > best_overlap):
+                best, best_overlap = i, overlap
+        return self.users.pop(best)[0] if best is not None else None
+
+
+def bench_tags(room_cls, size, ops=2000):
+    """Time a tagged dequeue plus a tagged enqueue with `size` users waiting"""
+    rng = random.Random(7)
+    room = room_cls()
+    for i in range(size):
+        room.enqueue(f"user-{i}", random_tags(rng))
+    requests = [random_tags(rng) for _ in range(ops)]
+    arrivals = [random_tags(rng) for _ in range(ops)]
+
+    matched = 0
+    start = time.perf_counter()
+    for i in range(ops):
+        if room.dequeue(f"req-{i}", requests[i]) is not None:
+            matched += 1
+        room.enqueue(f"new-{i}", arrivals[i])
+    return (time.perf_counter() - start) / ops, matched / ops
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    print(f"{'impl':<12}{'waiting':>10}{'enqueue':>14}{'dequeue':>14}{'cancel':>14}")
+    for size in sizes:
+        for name, room_cls in (('list', ListRoom), ('MatchQueue', MatchQueue)):
+            r = bench(room_cls, size)
+            print(f"{name:<12}{size:>10}"
+                  f"{r['enqueue'] * 1e6:>11.2f} us"
+                  f"{r['dequeue'] * 1e6:>11.2f} us"
+                  f"{r['cancel'] * 1e6:>11.2f} us")
+
+    print(f"\n{'tag room':<14}{'waiting':>10}{'match+join':>14}{'matched':>10}")
+    for size in sizes:
+        for name, room_cls in (('scan', ScanTagRoom), ('TagMatchQueue', TagMatchQueue)):
+            per_op, matched = bench_tags(room_cls, size)
+            print(f"{name:<14}{size:>10}{per_op * 1e6:>11.2f} us{matched * 100:>9.0f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Microbenchmark for the JSON and msgpack serializers on signaling payloads
+
+Encodes and decodes representative payloads (a webrtc_signal carrying an
+SDP offer, an ICE candidate, a matched event, a new_message event and a
+/receive response with 50 messages) with the standard library codec, the
+orjson codec from serialization.py and msgpack, whichever are installed (a missing one is left out).
+Reports encode and decode throughput and the encoded size. If
+python-socketio is installed it also times a full Socket.IO event packet
+encode, text (with each JSON codec) and msgpack.
+
+Usage: python benchmarks/bench_serialization.py [iterations]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serialization import OrjsonCodec, StdlibCodec, orjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SDP = (
+    'v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n'
+    'a=group:BUNDLE 0 1\r\na=msid-semantic: WMS stream\r\n'
+    'm=audio 9 UDP/TLS/RTP/SAVPF 111 103 104 9 0 8 106 105 13 110 112 113 126\r\n'
+    'c=IN IP4 0.0.0.0\r\na=rtcp:9 IN IP4 0.0.0.0\r\na=ice-ufrag:sXy2\r\n'
+    'a=ice-pwd:0d8Bhq7kTQ1e1b1aBFcbmUcQ\r\na=ice-options:trickle\r\n'
+    'a=fingerprint:sha-256 7B:8B:F0:65:5F:78:E2:51:3B:AC:6F:F3:3F:46:1B:35:DC:B8:5F:64:'
+    '1A:24:C2:43:F0:A1:58:D0:A1:2C:19:08\r\na=setup:actpass\r\na=mid:0\r\n'
+    'a=extmap:1 urn:ietf:params:rtp-hdrext:ssrc-audio-level\r\n'
+    'a=extmap:2 http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time\r\n'
+    'a=sendrecv\r\na=rtcp-mux\r\na=rtpmap:111 opus/48000/2\r\na=rtcp-fb:111 transport-cc\r\n'
+    'a=fmtp:111 minptime=10;useinbandfec=1\r\na=rtpmap:103 ISAC/16000\r\na=rtpmap:104 ISAC/32000\r\n'
+    'a=rtpmap:9 G722/8000\r\na=rtpmap:0 PCMU/8000\r\na=rtpmap:8 PCMA/8000\r\n'
+    'a=ssrc:1001 cname:0mX3dq6uJ3OyW4Cs\r\na=ssrc:1001 msid:stream audio0\r\n'
+    'm=video 9 UDP/TLS/RTP/SAVPF 96 97 98 99 100 101 102\r\nc=IN IP4 0.0.0.0\r\n'
+    'a=rtcp:9 IN IP4 0.0.0.0\r\na=ice-ufrag:sXy2\r\na=ice-pwd:0d8Bhq7kTQ1e1b1aBFcbmUcQ\r\n'
+    'a=mid:1\r\na=sendrecv\r\na=rtcp-mux\r\na=rtcp-rsize\r\na=rtpmap:96 VP8/90000\r\n'
+    'a=rtcp-fb:96 goog-remb\r\na=rtcp-fb:96 transport-cc\r\na=rtcp-fb:96 ccm fir\r\n'
+    'a=rtcp-fb:96 nack\r\na=rtcp-fb:96 nack pli\r\na=rtpmap:97 rtx/90000\r\na=fmtp:97 apt=96\r\n'
+    'a=rtpmap:98 VP9/90000\r\na=fmtp:98 profile-id=0\r\na=rtpmap:99 rtx/90000\r\na=fmtp:99 apt=98\r\n'
+    'a=ssrc-group:FID 2002 2003\r\na=ssrc:2002 cname:0mX3dq6uJ3OyW4Cs\r\na=ssrc:2003 cname:0mX3dq6uJ3OyW4Cs\r\n'
+)
+
+SESSION_ID = '5b0e6c1e-6f0a-4d5e-9a59-0f3c2c7d1a10'
+USER_ID = 'a4f1c9d2-3b7e-4f61-8c2d-9e0b5a7c3f18'
+
+PAYLOADS = {
+    'offer': {'session_id': SESSION_ID, 'from': USER_ID, 'signal': {'type': 'offer', 'sdp': SDP}},
+    'candidate': {'session_id': SESSION_ID, 'from': USER_ID, 'signal': {
+        'type': 'candidate',
+        'candidate': {
+            'candidate': 'candidate:842163049 1 udp 1677729535 203.0.113.7 46154 typ srflx '
+                         'raddr 10.0.0.12 rport 46154 generation 0 ufrag sXy2 network-cost 999',
+            'sdpMid': '0',
+            'sdpMLineIndex': 0
+        }
+    }},
+    'matched': {'session_id': SESSION_ID, 'chat_type': 'video', 'partner_id': USER_ID, 'is_initiator': True},
+    'new_message': {'session_id': SESSION_ID, 'message': {
+        'id': 42, 'from': 'stranger', 'text': 'hey, where are you from? 👋', 'timestamp': 1760648065.123}},
+    'receive': {
+        'messages': [{'id': i, 'from': 'you' if i % 2 else 'stranger',
+                      'text': f'message number {i} with a bit of text', 'timestamp': 1760648065.0 + i}
+                     for i in range(50)],
+        'last_seq': 50,
+        'disconnected': False
+    },
+}
+
+
+def codecs():
+    found = [('stdlib', StdlibCodec.dumps, StdlibCodec.loads)]
+    if orjson is not None:
+        found.append(('orjson', OrjsonCodec.dumps, OrjsonCodec.loads))
+    if msgpack is not None:
+        found.append(('msgpack', msgpack.packb, msgpack.unpackb))
+    return found
+
+
+def per_second(func, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return iterations / (time.perf_counter() - start)
+
+
+def bench_payloads(iterations):
+    print(f"{'payload':<12}{'codec':<10}{'encode/s':>12}{'decode/s':>12}{'bytes':>8}")
+    for name, payload in PAYLOADS.items():
+        for codec, dumps, loads in codecs():
+            encoded = dumps(payload)
+            size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+            print(f"{name:<12}{codec:<10}{per_second(dumps, payload, iterations):>12.0f}"
+                  f"{per_second(loads, encoded, iterations):>12.0f}{size:>8}")
+
+
+def bench_packets(iterations):
+    try:
+        from socketio import packet
+    except ImportError as exc:
+        print(f"\nSkipping packet encoding, {exc}")
+        return
+
+    class TextPacket(packet.Packet):
+        pass
+
+    print("\nSocket.IO event packet encode, webrtc_signal offer")
+    kinds = [('text/stdlib', StdlibCodec)]
+    if orjson is not None:
+        kinds.append(('text/orjson', OrjsonCodec))
+    for name, codec in kinds:
+        TextPacket.json = codec
+        rate = per_second(lambda data: TextPacket(packet.EVENT, data=data).encode(),
+                          ['webrtc_signal', PAYLOADS['offer']], iterations)
+        print(f"  {name:<14}{rate:>10.0f} packets/s")
+    if msgpack is None:
+        print("  msgpack not installed, skipping msgpack packets")
+    else:
+        from socketio import msgpack_packet
+        rate = per_second(lambda data: msgpack_packet.MsgPackPacket(packet.EVENT, data=data).encode(),
+                          ['webrtc_signal', PAYLOADS['offer']], iterations)
+        print(f"  {'msgpack':<14}{rate:>10.0f} packets/s")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench_payloads(iterations)
+    bench_packets(iterations)
+
+
+if __name__ == '__main__':
+    main()
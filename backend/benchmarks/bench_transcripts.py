@@ -0,0 +1,131 @@
+"""Benchmark of messages persisted per second by the transcript stores
+
+First writes messages straight through a TranscriptSink into the segment
+and SQLite stores at several batch sizes, reporting messages/sec written
+and read back. Then runs /send through the Flask test client with the
+sink enabled, several sender greenlets against text sessions, and reports
+messages accepted and persisted per second, /send latency and how often
+backpressure answered 503.
+
+Usage: python benchmarks/bench_transcripts.py [messages] [--fsync]
+"""
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transcripts import SQLiteTranscriptStore, SegmentTranscriptStore, TranscriptRecord, TranscriptSink
+
+BATCH_SIZES = (1, 100, 1000)
+SESSIONS = 200
+SENDERS = 50
+TEXT = 'hey, how is it going over there? ' * 3  # ~100 characters, a typical chat line
+
+
+def open_store(kind, directory, fsync):
+    if kind == 'sqlite':
+        return SQLiteTranscriptStore(os.path.join(directory, 'transcripts.sqlite3'), fsync=fsync)
+    return SegmentTranscriptStore(directory, 8 * 1024 * 1024, fsync=fsync)
+
+
+def bench_store(kind, batch_max, messages, fsync):
+    directory = tempfile.mkdtemp(prefix='bench-transcripts-')
+    try:
+        sink = TranscriptSink(open_store(kind, directory, fsync), max_pending=messages, batch_max=batch_max)
+        for i in range(messages):
+            sink.offer(TranscriptRecord(f's{i % SESSIONS}', i // SESSIONS + 1, f'u{i % SESSIONS}', TEXT, time.time()))
+        start = time.perf_counter()
+        while sink.flush():
+            pass
+        write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        read = sum(1 for _ in sink.store.read())
+        read_time = time.perf_counter() - start
+        sink.store.close()
+        assert read == messages, (read, messages)
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        return messages / write, read / read_time, size / messages
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_send(messages):
+    """/send through the eventlet app with TRANSCRIPT_STORE=segments"""
+    directory = tempfile.mkdtemp(prefix='bench-transcripts-')
+    os.environ.update(TRANSCRIPT_STORE='segments', TRANSCRIPT_PATH=directory, RATE_LIMITS='/send.user=0,/send.ip=0',
+                      SESSION_BYTE_BUDGET=str(1 << 40), LOG_LEVEL='WARNING')
+    import eventlet
+    import app as backend
+
+    client = backend.app.test_client()
+    chat_sessions = [backend.user_manager.create_session(f'a{i}', f'b{i}', 'text') for i in range(SESSIONS)]
+    latencies, refused = [], [0]
+    per_sender = messages // SENDERS
+
+    def sender(index):
+        for i in range(per_sender):
+            chat_session = chat_sessions[(index + i * SENDERS) % SESSIONS]
+            started = time.perf_counter()
+            status = client.post('/send', json={
+                'session_id': chat_session.session_id,
+                'user_id': chat_session.user1_id,
+                'message': TEXT
+            }).status_code
+            latencies.append(time.perf_counter() - started)
+            if status == 503:
+                refused[0] += 1
+                eventlet.sleep(0.05)
+
+    start = time.perf_counter()
+    pool = eventlet.GreenPool(SENDERS)
+    for index in range(SENDERS):
+        pool.spawn(sender, index)
+    pool.waitall()
+    accepted_time = time.perf_counter() - start
+    # pending includes the batch the writer is still writing
+    while backend.transcript_sink.pending:
+        eventlet.sleep(0.01)
+    persisted_time = time.perf_counter() - start
+    stored = sum(1 for _ in backend.transcript_sink.store.read())
+    shutil.rmtree(directory, ignore_errors=True)
+    latencies.sort()
+    return {
+        'accepted': len(latencies) - refused[0],
+        'refused': refused[0],
+        'stored': stored,
+        'accepted_rate': (len(latencies) - refused[0]) / accepted_time,
+        'persisted_rate': stored / persisted_time,
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    messages = int(args[0]) if args else 100000
+    fsync = '--fsync' in sys.argv
+
+    print(f"{messages} messages of {len(TEXT)} characters{', fsync per batch' if fsync else ''}")
+    print(f"{'store':<10}{'batch':>7}{'written/s':>12}{'read/s':>12}{'bytes/msg':>11}")
+    for kind in ('segments', 'sqlite'):
+        for batch_max in BATCH_SIZES:
+            # One write per message is slow enough that a tenth shows the rate
+            count = messages if batch_max > 1 else messages // 10
+            written, read, size = bench_store(kind, batch_max, count, fsync)
+            print(f"{kind:<10}{batch_max:>7}{written:>12,.0f}{read:>12,.0f}{size:>11.0f}")
+
+    result = bench_send(messages // 10)
+    if result['stored'] != result['accepted']:
+        sys.exit(f"/send accepted {result['accepted']} messages but {result['stored']} were persisted")
+    print(f"/send with segments: {result['accepted']} accepted at {result['accepted_rate']:,.0f}/s, "
+          f"{result['stored']} persisted at {result['persisted_rate']:,.0f}/s, "
+          f"{result['refused']} refused with 503, p50 {result['p50']:.2f}ms p99 {result['p99']:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
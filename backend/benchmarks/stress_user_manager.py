@@ -0,0 +1,152 @@
+"""Concurrency stress test for UserManager
+
+Spawns thousands of greenlets that enqueue, match, disconnect and end
+sessions for a shared pool of users, then checks the invariants:
+
+  - nobody is matched with themselves
+  - no user is in two sessions at once
+  - once everything settles, user_sessions only points at live sessions
+    that contain that user (mid-teardown a session can already be gone
+    while its users are still being unlinked, so this one is only checked
+    at the end)
+
+Greenlets only switch on I/O, so to make the interleaving meaningful every
+state backend call (and every shard lookup inside the session table) yields
+to the hub, the way a network round trip to Redis would. Exits non-zero if
+an invariant is violated.
+
+Usage: python benchmarks/stress_user_manager.py [greenlets] [ops_per_greenlet] [users]
+"""
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eventlet
+
+import app as backend
+from state import CHAT_TYPES, InMemoryStateBackend
+
+
+class YieldingBackend:
+    """Proxy that yields to other greenlets around every backend call"""
+
+    def __init__(self, state):
+        self._state = state
+
+    def __getattr__(self, name):
+        attr = getattr(self._state, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            eventlet.sleep(0)
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                eventlet.sleep(0)
+        return call
+
+
+def yielding_shard(table):
+    original = table._shard
+
+    def _shard(key):
+        eventlet.sleep(0)
+        return original(key)
+    table._shard = _shard
+
+
+def check_invariants(state, settled=False):
+    errors = []
+    sessions = state.local_sessions()
+    seen = Counter()
+    live = {}
+    for chat_session in sessions:
+        if chat_session.user1_id == chat_session.user2_id:
+            errors.append(f"self-match in {chat_session.session_id}")
+        seen[chat_session.user1_id] += 1
+        seen[chat_session.user2_id] += 1
+        live[chat_session.session_id] = chat_session
+    errors.extend(f"{user_id} is in {count} sessions" for user_id, count in seen.items() if count > 1)
+    if not settled:
+        return errors
+    for user_id, session_id in state.user_session_items().items():
+        chat_session = live.get(session_id)
+        if chat_session is None or not chat_session.is_user_in_session(user_id):
+            errors.append(f"{user_id} points at dead or foreign session {session_id}")
+    return errors
+
+
+def main():
+    greenlets = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    ops = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    logging.disable(logging.CRITICAL)
+
+    state = InMemoryStateBackend(backend.ChatSession)
+    yielding_shard(state.sessions)
+    manager = backend.UserManager(YieldingBackend(state))
+    user_ids = [f"user-{i}" for i in range(users)]
+    counts = Counter()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(ops):
+            user_id = rng.choice(user_ids)
+            chat_type = rng.choice(CHAT_TYPES)
+            op = rng.random()
+            if op < 0.35:
+                manager.add_waiting_user(user_id, chat_type)
+                counts['enqueue'] += 1
+            elif op < 0.55:
+                if manager.match_with_waiting_partner(user_id, chat_type):
+                    counts['direct_match'] += 1
+            elif op < 0.70:
+                counts['batch_match'] += len(manager.match_waiting_users(chat_type, 10))
+            elif op < 0.85:
+                session_id = manager.get_user_session(user_id)
+                if session_id and manager.remove_session(session_id):
+                    counts['ended'] += 1
+            else:
+                manager.remove_connected_user(user_id)
+                counts['disconnect'] += 1
+
+    violations = []
+
+    def checker():
+        while not done:
+            violations.extend(check_invariants(state))
+            eventlet.sleep(0.01)
+
+    done = False
+    start = time.perf_counter()
+    pool = eventlet.GreenPool(greenlets + 1)
+    pool.spawn(checker)
+    for seed in range(greenlets):
+        pool.spawn(worker, seed)
+    # Wait for workers, then stop the checker
+    while pool.running() > 1:
+        eventlet.sleep(0.05)
+    done = True
+    pool.waitall()
+    elapsed = time.perf_counter() - start
+    violations.extend(check_invariants(state, settled=True))
+
+    print(f"{greenlets} greenlets x {ops} ops over {users} users in {elapsed:.2f}s")
+    print(', '.join(f"{name}={count}" for name, count in sorted(counts.items())))
+    print(f"live sessions={manager.get_active_sessions_count()}")
+    if violations:
+        print(f"FAILED: {len(violations)} invariant violations, first few:")
+        for violation in violations[:10]:
+            print(f"  {violation}")
+        sys.exit(1)
+    print("OK: no self-matches, no user in two sessions, user_sessions consistent")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,623 @@
+import logging
+import os
+import threading
+import time
+
+from limits import parse_byte_limits, queued_bytes
+from matchmaking import normalize_tags
+from message_log import MessageLog
+from metrics import Counter, Gauge, Histogram
+from ratelimit import Quota, RedisTokenBucketLimiter, TokenBucketLimiter, parse_quotas
+from reaper import SessionReaper
+from signaling import RelayCache, Route
+from state import CHAT_TYPES, InMemoryStateBackend, RedisStateBackend
+from transcripts import SQLiteTranscriptStore, SegmentTranscriptStore, TranscriptRecord, TranscriptSink
+
+# Settings, metrics and the session model shared by the eventlet (app.py)
+# and asyncio (asgi_app.py) runtimes
+logger = logging.getLogger('app')
+match_logger = logging.getLogger('app.matchmaking')
+
+# Matchmaker settings
+MATCH_TICK_INTERVAL = int(os.environ.get('MATCH_TICK_INTERVAL_MS', '100')) / 1000.0
+MATCH_MAX_BATCH = int(os.environ.get('MATCH_MAX_BATCH', '500'))
+# Interest matching: users with tags only pair on a shared tag until they
+# have waited MATCH_RELAX_AFTER seconds, then with anyone
+MATCH_RELAX_AFTER = float(os.environ.get('MATCH_RELAX_AFTER', '10'))
+MATCH_MAX_TAGS = int(os.environ.get('MATCH_MAX_TAGS', '8'))
+
+# Serialization: JSON_BACKEND picks the encoder for HTTP responses and
+# Socket.IO packets ('auto' uses orjson when installed), 'msgpack' as
+# SOCKETIO_SERIALIZER switches Socket.IO to binary msgpack packets
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+SOCKETIO_SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER', 'json')
+
+# Shared state settings, 'redis' lets several workers match each other's users.
+# On Redis Cluster the key prefix needs a hash tag such as '{vc}:', which
+# keeps every key the scripts touch in one slot
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_KEY_PREFIX = os.environ.get('REDIS_KEY_PREFIX', 'vc:')
+
+# Multi-process sharding, set by supervisor.py for each worker: SHARD_COUNT
+# workers (1 = a single unsharded process), this worker's SHARD_INDEX and
+# the private directory holding the workers' Unix sockets. Users a worker
+# has not matched among its own within SHARD_OFFER_AFTER_MS are offered to
+# the other shards. Needs STATE_BACKEND=memory
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', '0'))
+SHARD_DIR = os.environ.get('SHARD_DIR', '')
+SHARD_OFFER_AFTER_MS = float(os.environ.get('SHARD_OFFER_AFTER_MS', '300'))
+
+# Messages kept per chat session, older ones are dropped
+MESSAGE_LOG_CAP = int(os.environ.get('MESSAGE_LOG_CAP', '500'))
+if MESSAGE_LOG_CAP < 1:
+    raise ValueError(f"MESSAGE_LOG_CAP must be at least 1, got {MESSAGE_LOG_CAP}")
+
+# Payload limits. MAX_HTTP_BUFFER_SIZE caps one Engine.IO WebSocket frame or
+# polling POST and HTTP_MAX_BODY a REST request body, both refused from
+# their length before the payload is read. Each Socket.IO packet is then
+# held to the byte limit for its event before it is decoded; PAYLOAD_LIMITS
+# overrides them, e.g. 'webrtc_signal=65536,user_typing=0' (0 falls back to
+# PAYLOAD_LIMIT_DEFAULT, which covers every other event). /send messages
+# are capped at MESSAGE_MAX_CHARS and a session accepts SESSION_BYTE_BUDGET
+# bytes of message text in total.
+PAYLOAD_LIMIT_DEFAULTS = {
+    # An SDP offer with a few tracks and codecs is 5-15 KiB, an ICE
+    # candidate a few hundred bytes
+    'webrtc_signal': 32768,
+    # msgpack packets are binary throughout, so this must fit an SDP too
+    'binary': 32768,
+    'connect': 2048,
+    'join_session': 256,
+    'leave_session': 256,
+    'client_ready': 256,
+    'user_typing': 256,
+    'ack': 256,
+}
+PAYLOAD_LIMITS = parse_byte_limits(os.environ.get('PAYLOAD_LIMITS', ''), PAYLOAD_LIMIT_DEFAULTS)
+PAYLOAD_LIMIT_DEFAULT = int(os.environ.get('PAYLOAD_LIMIT_DEFAULT', '1024'))
+MAX_HTTP_BUFFER_SIZE = int(os.environ.get('MAX_HTTP_BUFFER_SIZE', '65536'))
+HTTP_MAX_BODY = int(os.environ.get('HTTP_MAX_BODY', '65536'))
+MESSAGE_MAX_CHARS = int(os.environ.get('MESSAGE_MAX_CHARS', '2000'))
+SESSION_BYTE_BUDGET = int(os.environ.get('SESSION_BYTE_BUDGET', str(1024 * 1024)))
+
+# Transcripts: TRANSCRIPT_STORE=segments or sqlite keeps every text message
+# under TRANSCRIPT_PATH (a subdirectory per shard). add_message queues them
+# and a background writer stores batches of up to TRANSCRIPT_BATCH_MAX
+# every TRANSCRIPT_FLUSH_MS. With TRANSCRIPT_QUEUE_MAX messages waiting,
+# /send answers 503 until the writer catches up. Segment files roll over
+# at TRANSCRIPT_SEGMENT_BYTES; TRANSCRIPT_FSYNC=1 syncs each batch to disk
+TRANSCRIPT_STORE = os.environ.get('TRANSCRIPT_STORE', '')
+TRANSCRIPT_PATH = os.environ.get('TRANSCRIPT_PATH', 'transcript-data')
+TRANSCRIPT_FLUSH_MS = float(os.environ.get('TRANSCRIPT_FLUSH_MS', '200'))
+TRANSCRIPT_BATCH_MAX = int(os.environ.get('TRANSCRIPT_BATCH_MAX', '1000'))
+TRANSCRIPT_QUEUE_MAX = int(os.environ.get('TRANSCRIPT_QUEUE_MAX', '50000'))
+TRANSCRIPT_SEGMENT_BYTES = int(os.environ.get('TRANSCRIPT_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+TRANSCRIPT_FSYNC = os.environ.get('TRANSCRIPT_FSYNC', '0') == '1'
+
+# Match delivery: a client that has not acknowledged user_id within
+# READY_TIMEOUT_MS gets its matched event without acks; acknowledged
+# matched events are resent after MATCH_ACK_TIMEOUT_MS, MATCH_EMIT_RETRIES times
+READY_TIMEOUT_MS = float(os.environ.get('READY_TIMEOUT_MS', '500'))
+MATCH_ACK_TIMEOUT_MS = float(os.environ.get('MATCH_ACK_TIMEOUT_MS', '1000'))
+MATCH_EMIT_RETRIES = int(os.environ.get('MATCH_EMIT_RETRIES', '3'))
+
+# Reconnect resume: a user whose socket drops keeps its user_id, session and
+# waiting position for RESUME_GRACE seconds (0 tears down at once). Resume
+# tokens are signed with SECRET_KEY and accepted for RESUME_TOKEN_MAX_AGE
+# seconds; every worker must share SECRET_KEY
+RESUME_GRACE = float(os.environ.get('RESUME_GRACE', '15'))
+RESUME_TOKEN_MAX_AGE = int(os.environ.get('RESUME_TOKEN_MAX_AGE', '3600'))
+SECRET_KEY = os.environ.get('SECRET_KEY') or os.urandom(32).hex()
+
+# Sessions with no messages or signaling for SESSION_TTL seconds are ended;
+# the reaper checks for due sessions every REAPER_RESOLUTION seconds
+SESSION_TTL = float(os.environ.get('SESSION_TTL', '1800'))
+REAPER_RESOLUTION = float(os.environ.get('REAPER_RESOLUTION', '1.0'))
+REAPER_MAX_BATCH = int(os.environ.get('REAPER_MAX_BATCH', '1000'))
+
+# Upper bound on how long a /receive long-poll may park, in seconds
+LONG_POLL_MAX_WAIT = float(os.environ.get('LONG_POLL_MAX_WAIT', '25'))
+
+# ICE candidate coalescing: candidates a user sends within
+# SIGNAL_COALESCE_MS are relayed as one webrtc_signal_batch event (0 = off)
+SIGNAL_COALESCE_MS = float(os.environ.get('SIGNAL_COALESCE_MS', '0'))
+SIGNAL_BATCH_MAX = int(os.environ.get('SIGNAL_BATCH_MAX', '16'))
+
+# Typing indicators: changes are forwarded at most once per
+# TYPING_MIN_INTERVAL_MS per user, "typing" lapses after TYPING_EXPIRY seconds
+TYPING_MIN_INTERVAL_MS = float(os.environ.get('TYPING_MIN_INTERVAL_MS', '500'))
+TYPING_EXPIRY = float(os.environ.get('TYPING_EXPIRY', '5'))
+
+# Token-bucket rate limits per HTTP route / Socket.IO event and scope
+# ('user', 'sid' or 'ip'). RATE_LIMITS overrides them, e.g.
+# 'send.user=5/20,connect.ip=0' (rate per second/burst, 0 = no limit).
+# RATE_LIMIT_BACKEND=redis shares the buckets between workers.
+RATE_LIMIT_DEFAULTS = {
+    ('/start_video', 'user'): Quota(1, 5),
+    ('/start_video', 'ip'): Quota(20, 50),
+    ('/start', 'user'): Quota(1, 5),
+    ('/start', 'ip'): Quota(20, 50),
+    ('/send', 'user'): Quota(5, 20),
+    ('/send', 'ip'): Quota(50, 100),
+    ('/receive', 'user'): Quota(10, 20),
+    ('/receive', 'ip'): Quota(100, 200),
+    ('connect', 'ip'): Quota(10, 30),
+    ('request_user_id', 'sid'): Quota(1, 5),
+    ('client_ready', 'sid'): Quota(1, 5),
+    ('join_session', 'sid'): Quota(2, 10),
+    ('leave_session', 'sid'): Quota(2, 10),
+    ('webrtc_signal', 'sid'): Quota(100, 300),
+    ('user_typing', 'sid'): Quota(10, 20),
+}
+RATE_LIMITS = parse_quotas(os.environ.get('RATE_LIMITS', ''), RATE_LIMIT_DEFAULTS)
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+# Reverse proxies (load balancers) in front of the app that append to
+# X-Forwarded-For; the 'ip' scope and token-less 'user' buckets are keyed
+# on the address that many hops back. 0 trusts no header, the peer counts
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+
+# Admin state dump: how long a snapshot is reused, the largest page size and
+# an optional token required in the X-Admin-Token header
+ADMIN_SNAPSHOT_TTL = float(os.environ.get('ADMIN_SNAPSHOT_TTL', '5'))
+ADMIN_PAGE_MAX = int(os.environ.get('ADMIN_PAGE_MAX', '1000'))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Metrics, served on /metrics in the Prometheus text format
+WAITING_USERS = Gauge('videochat_waiting_users', 'Users in a waiting room', ['chat_type'])
+ACTIVE_USERS = Gauge('videochat_active_users', 'Users with an open socket')
+ACTIVE_SESSIONS = Gauge('videochat_active_sessions', 'Live chat sessions')
+MATCH_WAIT = Histogram('videochat_match_wait_seconds',
+                       'Time from entering a waiting room to being matched', ['chat_type'])
+SESSIONS_CREATED = Counter('videochat_sessions_created_total', 'Chat sessions created', ['chat_type'])
+SESSIONS_ENDED = Counter('videochat_sessions_ended_total', 'Chat sessions ended', ['reason'])
+SIGNALS_RELAYED = Counter('videochat_signals_relayed_total',
+                          'Signaling messages forwarded to a partner', ['event'])
+SIGNALS_RELAYED_WEBRTC = SIGNALS_RELAYED.labels('webrtc_signal')  # Bound once for the hot path
+SIGNAL_BATCH_SIZE = Histogram('videochat_signal_batch_size', 'ICE candidates per coalesced relay',
+                              buckets=(1, 2, 4, 8, 16, 32, 64))
+TYPING_SUPPRESSED = Counter('videochat_typing_suppressed_total',
+                            'user_typing events not forwarded to the partner', ['reason'])
+TYPING_EXPIRED = Counter('videochat_typing_expired_total',
+                         'Typing indicators cleared by the server after TYPING_EXPIRY')
+RATE_LIMITED = Counter('videochat_rate_limited_total',
+                       'Requests and events rejected by the rate limiter', ['name', 'scope'])
+EMIT_FAILURES = Counter('videochat_emit_failures_total', 'Socket.IO emits that raised', ['event'])
+RESUMES = Counter('videochat_resumes_total', 'Reconnects carrying a resume token', ['result'])
+DETACHED_USERS = Gauge('videochat_detached_users', 'Users inside their reconnect grace period')
+EMIT_RETRIES = Counter('videochat_emit_retries_total', 'Socket.IO emits resent for lack of an ack', ['event'])
+SHARD_BUS_FRAMES = Counter('videochat_shard_bus_frames_total',
+                           'Messages exchanged with other shard workers', ['kind', 'direction'])
+SHARD_FORWARDED = Counter('videochat_shard_forwarded_requests_total',
+                          'HTTP requests replayed on the worker owning their user or session', ['route'])
+CROSS_SHARD_PAIRS = Counter('videochat_cross_shard_pairs_total',
+                            'Offered users paired by the coordinator shard', ['scope'])
+MATCH_TICK_DURATION = Histogram('videochat_matchmaker_tick_seconds', 'Duration of one matchmaker tick')
+HTTP_DURATION = Histogram('videochat_http_request_duration_seconds', 'HTTP handler duration',
+                          ['endpoint', 'method', 'status'])
+SOCKET_DURATION = Histogram('videochat_socket_handler_duration_seconds',
+                            'Socket.IO event handler duration', ['event'])
+PAYLOADS_REJECTED = Counter('videochat_payloads_rejected_total',
+                            'Packets and messages refused for their size', ['name', 'reason'])
+CONNECTION_BUFFERED = Gauge('videochat_connection_buffered_bytes',
+                            'Encoded bytes queued to Engine.IO connections, in total and the largest queue',
+                            ['stat'])
+TRANSCRIPT_PERSISTED = Counter('videochat_transcript_messages_persisted_total',
+                               'Messages written to the transcript store')
+TRANSCRIPT_QUEUE = Gauge('videochat_transcript_queue_depth', 'Messages waiting for the transcript writer')
+TRANSCRIPT_BACKPRESSURE = Counter('videochat_transcript_backpressure_total',
+                                  '/send calls refused while the transcript queue was full')
+TRANSCRIPT_FLUSH_DURATION = Histogram('videochat_transcript_flush_seconds',
+                                      'Duration of one transcript batch write')
+MESSAGE_BYTES = Gauge('videochat_session_message_bytes',
+                      'Message text bytes accepted by live sessions, a bound on what their logs hold')
+
+
+class UserManager:
+    """Users, waiting rooms and sessions on top of a state backend
+
+    Shared by the eventlet (app.py) and asyncio (asgi_app.py) runtimes.
+    Under eventlet the locks are green locks, held across backend calls
+    that may yield on Redis I/O. Under asyncio nothing in here awaits, so
+    handlers never interleave inside a method and the locks are never
+    contended.
+    """
+
+    def __init__(self, state, reaper=None, on_session_removed=None):
+        # Room management for Omegle-like functionality. Waiting rooms,
+        # sessions, presence and socket mappings live in the state backend
+        # (in-memory or Redis, see state.py)
+        self.state = state
+        # Inactivity index for sessions created in this process
+        self.reaper = reaper or SessionReaper(SESSION_TTL)
+        self.user_rooms = {}  # user_id -> room_id
+        # One lock per waiting room, so video and text matching never
+        # serialize on each other. Sessions are locked per shard inside the
+        # state backend and presence updates are single atomic operations.
+        self.queue_locks = {chat_type: threading.Lock() for chat_type in CHAT_TYPES}
+        # (chat_type, user_id) -> time.monotonic() at enqueue, for the
+        # match wait histogram
+        self.wait_started = {}
+        # sid -> partner route for the webrtc_signal fast path
+        self.signal_routes = RelayCache()
+        # Called with each removed ChatSession, e.g. to drop typing state
+        self.on_session_removed = on_session_removed
+    
+    def add_active_user(self, user_id):
+        """Add user to active users (online)"""
+        self.state.add_member('active_users', user_id)
+        logger.info("User %s added to active users", user_id)
+    
+    def remove_active_user(self, user_id):
+        """Remove user from active users"""
+        self.state.discard_member('active_users', user_id)
+        logger.info("User %s removed from active users", user_id)
+    
+    def is_active_user(self, user_id):
+        """Check if user is online"""
+        return self.state.has_member('active_users', user_id)
+    
+    def get_active_users(self):
+        """List of online user IDs"""
+        return self.state.members('active_users')
+    
+    def add_waiting_user(self, user_id, chat_type, tags=None):
+        """Add user to waiting room, or update the tags they wait with"""
+        with self.queue_locks[chat_type]:
+            if self.state.enqueue_waiting(chat_type, user_id, tags):
+                self.wait_started.setdefault((chat_type, user_id), time.monotonic())
+                match_logger.info("User %s added to %s waiting room", user_id, chat_type)
+                return True
+            return False
+    
+    def is_waiting(self, user_id, chat_type):
+        """Check if user is in a waiting room"""
+        return self.state.is_waiting(chat_type, user_id)
+    
+    def get_waiting_partner(self, chat_type, exclude_user_id=None):
+        """Get next waiting user for matching"""
+        with self.queue_locks[chat_type]:
+            # Get the first user that's not the excluded user
+            partner = self.state.pop_waiting_partner(chat_type, exclude_user_id)
+            if partner:
+                match_logger.info("🔍 Found partner %s for %s (excluded %s)", partner, exclude_user_id, exclude_user_id)
+                return partner
+            # If no other user found, return None
+            match_logger.info("⚠️ No partner found for %s in %s waiting room", exclude_user_id, chat_type)
+            return None
+    
+    def add_connected_user(self, user_id):
+        """Add user to connected users (in chat session)"""
+        self.state.add_member('connected_users', user_id)
+        match_logger.info("User %s added to connected users", user_id)
+    
+    def remove_connected_user(self, user_id):
+        """Remove user from connected users"""
+        self.state.discard_member('connected_users', user_id)
+        # Remove from waiting rooms
+        for chat_type in CHAT_TYPES:
+            with self.queue_locks[chat_type]:
+                cancelled = self.state.cancel_waiting(chat_type, user_id)
+            self.wait_started.pop((chat_type, user_id), None)
+            if cancelled:
+                match_logger.info("Removed %s from %s waiting room", user_id, chat_type)
+        match_logger.info("User %s removed from connected users", user_id)
+    
+    def create_session(self, user1_id, user2_id, chat_type, session_id=None):
+        """Create a new chat session, None if either user is already in one
+
+        session_id is given for sessions paired by another shard, see
+        sharding.CrossShardMatcher.
+        """
+        # Claiming both users is atomic in the state backend, no lock needed
+        chat_session = self.state.create_session(user1_id, user2_id, chat_type, session_id)
+        if chat_session is None:
+            match_logger.info("Could not pair %s with %s, one of them is already in a session", user1_id, user2_id)
+            return None
+        self._session_created(chat_session)
+        
+        match_logger.info("Created session %s between %s and %s", chat_session.session_id, user1_id, user2_id)
+        return chat_session
+    
+    def match_with_waiting_partner(self, user_id, chat_type, tags=None):
+        """Pop a waiting partner for user_id and create their session in one step
+
+        With tags, only a partner sharing one of them (or, once user_id has
+        waited MATCH_RELAX_AFTER, anyone open) is taken.
+        """
+        with self.queue_locks[chat_type]:
+            while True:
+                partner_id = self.state.pop_waiting_partner(chat_type, user_id, tags)
+                if not partner_id:
+                    return None
+                # The partner was already waiting, it starts the WebRTC offer
+                chat_session = self.state.create_session(user_id, partner_id, chat_type,
+                                                         initiator_id=partner_id)
+                if chat_session:
+                    break
+                if self.state.get_user_session(user_id):
+                    # The requester got matched elsewhere, the partner keeps waiting
+                    self.state.requeue_waiting(chat_type, partner_id)
+                    return None
+                # Partner is already in a session, try the next one
+        
+        self._session_created(chat_session)
+        match_logger.info("Created session %s between %s and %s", chat_session.session_id, user_id, partner_id)
+        return chat_session
+    
+    def match_waiting_users(self, chat_type, max_pairs):
+        """Pair waiting users in FIFO order and create their sessions"""
+        with self.queue_locks[chat_type]:
+            sessions = self.state.match_waiting_pairs(chat_type, max_pairs)
+        
+        for chat_session in sessions:
+            self._session_created(chat_session)
+        if sessions:
+            match_logger.info("Matched %s %s pairs", len(sessions), chat_type)
+        return sessions
+    
+    def _session_created(self, chat_session):
+        """Start the inactivity timer and record metrics for a new session"""
+        self.reaper.track(chat_session)
+        chat_type = chat_session.chat_type
+        SESSIONS_CREATED.labels(chat_type).inc()
+        now = time.monotonic()
+        for user_id in (chat_session.user1_id, chat_session.user2_id):
+            # Unknown for users who never waited or were queued on another worker
+            started = self.wait_started.pop((chat_type, user_id), None)
+            if started is not None:
+                MATCH_WAIT.labels(chat_type).observe(now - started)
+    
+    def get_user_session(self, user_id):
+        """Get session for a user"""
+        return self.state.get_user_session(user_id)
+    
+    def get_session(self, session_id):
+        """Get session by ID"""
+        return self.state.get_session(session_id)
+    
+    def remove_session(self, session_id, reason='ended'):
+        """Remove a session and clean up"""
+        session = self.state.remove_session(session_id)
+        self.reaper.forget(session_id)
+        self.signal_routes.drop_session(session_id)
+        if session:
+            SESSIONS_ENDED.labels(reason).inc()
+            MESSAGE_BYTES.dec(session.bytes_received)
+            if self.on_session_removed is not None:
+                self.on_session_removed(session)
+            # Wake any /receive long-polls so they see the disconnect
+            session.close()
+            logger.info("Removed session %s", session_id)
+        return session
+    
+    def map_socket(self, socket_id, user_id):
+        """Map a Socket.IO sid to its user"""
+        self.state.map_set('socket_user_map', socket_id, user_id)
+    
+    def get_socket_user(self, socket_id):
+        """Get user_id for a Socket.IO sid"""
+        return self.state.map_get('socket_user_map', socket_id)
+    
+    def unmap_socket(self, socket_id):
+        """Forget a Socket.IO sid"""
+        return self.state.map_pop('socket_user_map', socket_id)
+    
+    def bind_user_socket(self, user_id, socket_id):
+        """Make socket_id the user's current socket, returns the previous one"""
+        return self.state.map_swap('user_socket_map', user_id, socket_id)
+    
+    def get_user_socket(self, user_id):
+        """Current Socket.IO sid of a user"""
+        return self.state.map_get('user_socket_map', user_id)
+    
+    def release_user_socket(self, user_id, socket_id):
+        """Unbind the user only if socket_id is still its current socket"""
+        return self.state.map_pop_if('user_socket_map', user_id, socket_id)
+    
+    def resolve_signal_route(self, socket_id, session_id):
+        """Validate that socket_id's user is in session_id and cache the route"""
+        user_id = self.get_socket_user(socket_id)
+        if not user_id:
+            return None
+        chat_session = self.get_session(session_id)
+        if not chat_session or not chat_session.is_user_in_session(user_id):
+            return None
+        route = Route(session_id, user_id, chat_session.get_partner_id(user_id), chat_session)
+        self.signal_routes.put(socket_id, route)
+        return route
+    
+    def get_waiting_count(self, chat_type):
+        """Get number of waiting users"""
+        return self.state.waiting_count(chat_type)
+    
+    def get_active_sessions_count(self):
+        """Get number of active sessions"""
+        return self.state.session_count()
+    
+    def get_counts(self):
+        """User, waiting and session counts for status endpoints"""
+        return self.state.counts()
+    
+    def debug_snapshot(self):
+        """Full state dump for debugging, O(users), keep it off hot paths"""
+        return {
+            'active_users': self.state.members('active_users'),
+            'connected_users': self.state.members('connected_users'),
+            'waiting_rooms': {
+                chat_type: self.state.waiting_snapshot(chat_type)
+                for chat_type in CHAT_TYPES
+            },
+            'user_sessions': self.state.user_session_items(),
+            'active_session_ids': self.state.session_ids()
+        }
+    
+    def admin_sections(self):
+        """debug_snapshot flattened into sorted lists for paging"""
+        snapshot = self.debug_snapshot()
+        sections = {
+            'active_users': sorted(snapshot['active_users']),
+            'connected_users': sorted(snapshot['connected_users']),
+            'user_sessions': [
+                {'user_id': user_id, 'session_id': session_id}
+                for user_id, session_id in sorted(snapshot['user_sessions'].items())
+            ],
+            'sessions': sorted(snapshot['active_session_ids'])
+        }
+        for chat_type, waiting in snapshot['waiting_rooms'].items():
+            sections['waiting_' + chat_type] = waiting  # Keep queue order
+        return sections
+
+
+class ChatSession:
+    """One chat between two users
+
+    Runtime specific subclasses add wait_for_update(timeout), parking a
+    /receive long-poll until notify() wakes it through _wake(update).
+    """
+    
+    transcripts = None  # TranscriptSink shared by every session, set by the runtime
+    
+    # Slots instead of a per-instance __dict__, there can be hundreds of
+    # thousands of these
+    __slots__ = (
+        'session_id', 'user1_id', 'user2_id', 'chat_type', 'initiator_id', 'messages',
+        'created_at', 'is_active', 'last_activity', 'bytes_received', '_update'
+    )
+    
+    def __init__(self, session_id, user1_id, user2_id, chat_type, initiator_id=None):
+        self.session_id = session_id
+        self.user1_id = user1_id
+        self.user2_id = user2_id
+        self.chat_type = chat_type
+        # The user who sends the WebRTC offer, fixed when the pair is made
+        self.initiator_id = initiator_id or user1_id
+        self.messages = MessageLog(MESSAGE_LOG_CAP)
+        self.created_at = time.time()  # Epoch seconds
+        self.is_active = True
+        self.last_activity = time.monotonic()
+        self.bytes_received = 0  # Message text accepted, against SESSION_BYTE_BUDGET
+        self._update = None  # Event parked /receive long-polls wait on, set by subclasses
+        
+    def add_message(self, user_id, message):
+        """Add a message to the session, returns its Message record
+
+        Returns None, storing nothing, once the session's message text
+        would exceed SESSION_BYTE_BUDGET.
+        """
+        size = len(message.encode())
+        if self.bytes_received + size > SESSION_BYTE_BUDGET:
+            return None
+        self.bytes_received += size
+        MESSAGE_BYTES.inc(size)
+        sender = 'you' if user_id == self.user1_id else 'stranger'
+        msg = self.messages.append(sender, message, time.time())
+        if self.transcripts is not None:
+            # /send has checked the sink is not saturated, this never refuses
+            self.transcripts.offer(TranscriptRecord(self.session_id, msg.seq, user_id, message, msg.ts))
+        self.touch()
+        self.notify()
+        return msg
+    
+    def touch(self):
+        """Record activity, pushing back the inactivity deadline"""
+        self.last_activity = time.monotonic()
+    
+    def close(self):
+        """Mark the session inactive and wake long-polls"""
+        self.is_active = False
+        self.notify()
+    
+    def notify(self):
+        """Wake every long-poll parked in wait_for_update"""
+        update, self._update = self._update, None
+        if update is not None:
+            self._wake(update)
+    
+    @staticmethod
+    def _wake(update):
+        update.set()
+    
+    def get_messages(self, since_timestamp=None, since_seq=None):
+        """Get messages after a sequence cursor or (legacy) an ISO timestamp"""
+        if since_seq is not None:
+            return self.messages.since_seq(since_seq)
+        if since_timestamp:
+            return self.messages.since_timestamp(since_timestamp)
+        return list(self.messages)
+    
+    def get_partner_id(self, user_id):
+        """Get partner's user ID"""
+        return self.user2_id if user_id == self.user1_id else self.user1_id
+    
+    def is_user_in_session(self, user_id):
+        """Check if user is part of this session"""
+        return user_id in [self.user1_id, self.user2_id]
+
+
+def create_state_backend(session_factory, new_session_id=None):
+    """Build the state backend selected by STATE_BACKEND"""
+    if STATE_BACKEND == 'redis':
+        if SHARD_COUNT > 1:
+            raise ValueError("SHARD_COUNT > 1 needs STATE_BACKEND=memory")
+        logger.info("Using Redis state backend at %s", REDIS_URL)
+        if MATCH_MAX_TAGS > 0:
+            logger.warning("The Redis state backend does not match on interest tags, users "
+                           "sending tags are paired in FIFO order; set MATCH_MAX_TAGS=0 to turn tags off")
+        return RedisStateBackend.from_url(REDIS_URL, session_factory, REDIS_KEY_PREFIX)
+    return InMemoryStateBackend(session_factory, relax_after=MATCH_RELAX_AFTER, new_session_id=new_session_id)
+
+
+def create_transcript_sink():
+    """Build the transcript sink selected by TRANSCRIPT_STORE, None when off"""
+    if not TRANSCRIPT_STORE:
+        return None
+    path = TRANSCRIPT_PATH if SHARD_COUNT == 1 else os.path.join(TRANSCRIPT_PATH, f'shard-{SHARD_INDEX}')
+    if TRANSCRIPT_STORE == 'sqlite':
+        os.makedirs(path, exist_ok=True)
+        store = SQLiteTranscriptStore(os.path.join(path, 'transcripts.sqlite3'), fsync=TRANSCRIPT_FSYNC)
+    elif TRANSCRIPT_STORE == 'segments':
+        store = SegmentTranscriptStore(path, TRANSCRIPT_SEGMENT_BYTES, fsync=TRANSCRIPT_FSYNC)
+    else:
+        raise ValueError(f"Unknown TRANSCRIPT_STORE {TRANSCRIPT_STORE!r}, expected segments or sqlite")
+    logger.info("Writing transcripts to %s (%s)", path, TRANSCRIPT_STORE)
+    return TranscriptSink(store, TRANSCRIPT_QUEUE_MAX, TRANSCRIPT_BATCH_MAX)
+
+
+def create_rate_limiter():
+    """Build the rate limiter selected by RATE_LIMIT_BACKEND"""
+    if RATE_LIMIT_BACKEND == 'redis':
+        logger.info("Using Redis rate limiter at %s", REDIS_URL)
+        return RedisTokenBucketLimiter.from_url(REDIS_URL, RATE_LIMITS)
+    return TokenBucketLimiter(RATE_LIMITS)
+
+
+def update_state_gauges(user_manager, grace_periods):
+    """Refresh state gauges from the O(1) counters, runs on each scrape"""
+    counts = user_manager.get_counts()
+    for chat_type in CHAT_TYPES:
+        WAITING_USERS.labels(chat_type).set(counts['waiting_' + chat_type])
+    ACTIVE_USERS.set(counts['active_users'])
+    ACTIVE_SESSIONS.set(counts['active_sessions'])
+    DETACHED_USERS.set(len(grace_periods))
+
+
+def update_buffer_gauges(eio_sockets):
+    """Refresh the Engine.IO send queue gauges, runs on each scrape
+
+    Visits every connection, but a drained queue costs only a length check.
+    """
+    sizes = [queued_bytes(eio_socket) for eio_socket in list(eio_sockets.values())]
+    CONNECTION_BUFFERED.labels('total').set(sum(sizes))
+    CONNECTION_BUFFERED.labels('max').set(max(sizes, default=0))
+
+
+def parse_tags(data, args):
+    """Interest tags from a JSON body or query args, None if there are none"""
+    if not isinstance(data, dict):
+        data = {}
+    tags = normalize_tags(data.get('tags') or args.get('tags'),
+                          data.get('language') or args.get('language'),
+                          MATCH_MAX_TAGS)
+    return tags or None
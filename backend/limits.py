@@ -0,0 +1,104 @@
+import inspect
+import re
+
+# Start of an encoded Socket.IO packet: type digit, attachment count of a
+# binary packet, namespace, ack id, then (for events) the quoted event name
+_PACKET_HEAD = re.compile(r'(\d)(?:\d+-)?(?:/[^,]*,)?\d*(?:\["((?:[^"\\]|\\.){1,64})")?')
+_HEAD_SCAN = 128  # Event names are short, never look further into the packet
+_PACKET_KINDS = {'0': 'connect', '1': 'disconnect', '3': 'ack', '4': 'connect_error', '6': 'ack'}
+
+
+def parse_byte_limits(spec, defaults=None):
+    """Parse 'webrtc_signal=32768,user_typing=256' into {name: bytes}
+
+    The result is merged over defaults; a limit of 0 removes the name,
+    leaving it to the catch-all limit.
+    """
+    limits = dict(defaults or {})
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, value = item.partition('=')
+        value = int(value)
+        if value <= 0:
+            limits.pop(name.strip(), None)
+        else:
+            limits[name.strip()] = value
+    return limits
+
+
+def packet_name(data):
+    """Event name of an encoded Socket.IO packet, without decoding it
+
+    Only the first bytes are matched. Packets that are not events are named
+    after their type ('connect', 'ack', ...); binary packets and their
+    attachments are all 'binary', their event name is inside the payload.
+    """
+    if not isinstance(data, str):
+        return 'binary'
+    match = _PACKET_HEAD.match(data, 0, _HEAD_SCAN)
+    if match is None:
+        return 'invalid'
+    kind, event = match.groups()
+    if kind == '2':
+        return event or 'invalid'
+    return 'binary' if kind == '5' else _PACKET_KINDS.get(kind, 'invalid')
+
+
+def queued_bytes(eio_socket):
+    """Encoded size of the packets an Engine.IO socket has not sent yet"""
+    queue = eio_socket.queue
+    pending = getattr(queue, '_queue', None)  # asyncio.Queue
+    if pending is None:
+        pending = queue.queue  # eventlet and standard library queues
+    return sum(len(pkt.encode()) for pkt in list(pending) if pkt is not None)
+
+
+class PacketSizeGuard:
+    """Per-event size limits for inbound Socket.IO packets
+
+    Installed in front of python-socketio's Engine.IO message handler,
+    so an oversized packet is dropped as the raw string Engine.IO hands
+    over, before its JSON is parsed. limits maps event names (and the
+    packet_name() kinds) to a byte limit, anything else gets default.
+    Names without a limit are reported as 'other', keeping the callback's
+    labels to a bounded set.
+
+    on_rejected(name, size) is called for each dropped packet.
+    """
+
+    def __init__(self, limits, default=1024, on_rejected=None):
+        self.limits = limits
+        self.default = default
+        self.on_rejected = on_rejected
+        # Packets no bigger than the smallest limit pass without a name lookup
+        self.floor = min(default, *limits.values()) if limits else default
+
+    def allow(self, data):
+        """Whether a packet is within the limit for its event"""
+        size = len(data)
+        if size <= self.floor:
+            return True
+        name = packet_name(data)
+        limit = self.limits.get(name)
+        if limit is None:
+            name, limit = 'other', self.default
+        if size <= limit:
+            return True
+        if self.on_rejected is not None:
+            self.on_rejected(name, size)
+        return False
+
+    def wrap(self, handler):
+        """Guard an Engine.IO 'message' handler(eio_sid, data), sync or async"""
+        if inspect.iscoroutinefunction(handler):
+            async def guarded(eio_sid, data):
+                if self.allow(data):
+                    return await handler(eio_sid, data)
+        else:
+            def guarded(eio_sid, data):
+                if self.allow(data):
+                    return handler(eio_sid, data)
+        return guarded
+
+    def install(self, eio_server):
+        """Wrap the message handler python-socketio registered on eio_server"""
+        eio_server.on('message', self.wrap(eio_server.handlers['message']))
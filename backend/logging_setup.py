@@ -0,0 +1,112 @@
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+
+try:
+    # Under eventlet the threading and queue modules are monkey patched, so
+    # take the originals to get a real OS thread doing the log I/O
+    from eventlet import patcher
+    _queue = patcher.original('queue')
+    _threading = patcher.original('threading')
+except ImportError:
+    import queue as _queue
+    import threading as _threading
+
+# Subsystem loggers, levels can be set per subsystem with LOG_LEVELS
+SUBSYSTEMS = {
+    'matchmaking': 'app.matchmaking',
+    'signaling': 'app.signaling',
+    'transport': 'app.transport'
+}
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+class ThreadQueueListener(logging.handlers.QueueListener):
+    """QueueListener whose worker is a real OS thread, not a greenlet"""
+
+    def start(self):
+        self._thread = _threading.Thread(target=self._monitor, name='log-listener', daemon=True)
+        self._thread.start()
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that only defers the handler I/O to the listener thread
+
+    The message is %-formatted here, in the calling greenlet, like the
+    stock handler does: the args (signal payloads, request args) may be
+    changed by the caller before the listener gets to the record. The
+    timestamp prefix, any traceback and the write are left to the
+    listener; the queue never leaves the process, so nothing is pickled.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def parse_levels(spec):
+    """Parse 'matchmaking=DEBUG,transport=WARNING' into {logger_name: level}"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = item.partition('=')
+        name = SUBSYSTEMS.get(name.strip(), name.strip())
+        levels[name] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """Set up leveled, queued logging from environment variables
+
+    LOG_LEVEL      root level (default INFO)
+    LOG_LEVELS     per-subsystem levels, e.g. 'matchmaking=DEBUG,transport=WARNING'
+    LOG_QUEUE      '0' to write log records synchronously
+    LOG_SAMPLE_N   emit one in N sampled debug state dumps (default 100)
+    """
+    global _sample_every
+    _sample_every = max(1, int(os.environ.get('LOG_SAMPLE_N', '100')))
+
+    root = logging.getLogger()
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(LOG_FORMAT))
+    if os.environ.get('LOG_QUEUE', '1') != '0':
+        # Greenlets only enqueue records, formatting and writing happen on
+        # the listener thread
+        log_queue = _queue.SimpleQueue()
+        root.addHandler(DeferredQueueHandler(log_queue))
+        listener = ThreadQueueListener(log_queue, stream, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        root.addHandler(stream)
+
+    # Socket.IO packet and connection logging is very chatty, keep it quiet
+    # unless LOG_LEVELS asks for it, e.g. 'transport=INFO'
+    levels = {SUBSYSTEMS['transport']: 'WARNING'}
+    levels.update(parse_levels(os.environ.get('LOG_LEVELS', '')))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+
+_sample_every = 100
+_sample_counter = itertools.count()
+
+
+def sample_debug(logger, msg, *arg_factories):
+    """Log a debug-level state dump for one in LOG_SAMPLE_N calls
+
+    Arguments are zero-argument callables, so expensive dumps (user lists,
+    waiting rooms) are only built when the record is actually emitted.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if next(_sample_counter) % _sample_every:
+        return
+    logger.debug(msg, *(factory() for factory in arg_factories))
@@ -0,0 +1,330 @@
+import time
+from collections import OrderedDict, deque, namedtuple
+from itertools import islice
+
+# One user in a TagMatchQueue: their tags and time.monotonic() at enqueue
+Waiting = namedtuple('Waiting', ('user_id', 'tags', 'enqueued_at'))
+
+
+def normalize_tags(tags=None, language=None, max_tags=8):
+    """Interest tags as a frozenset of lowercase strings
+
+    tags is a list or a comma separated string; a language becomes a
+    'lang:<code>' tag. At most max_tags are kept.
+    """
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    found = []
+    if language and isinstance(language, str):
+        found.append('lang:' + language.strip().lower())
+    for tag in tags or ():
+        if isinstance(tag, str) and tag.strip():
+            found.append(tag.strip().lower())
+    return frozenset(found[:max_tags])
+
+
+class MatchQueue:
+    """FIFO waiting room with O(1) enqueue, cancel and dequeue-excluding-self
+
+    Backed by an OrderedDict keyed on user_id, so membership checks and
+    cancellation are hash lookups instead of list scans. Dequeue only ever
+    needs to look at the first two entries: the head is either a valid
+    partner or the excluded user, in which case the next entry is.
+    """
+
+    def __init__(self):
+        self._users = OrderedDict()
+
+    def enqueue(self, user_id):
+        """Add user to the back of the queue, returns False if already waiting"""
+        if user_id in self._users:
+            return False
+        self._users[user_id] = None
+        return True
+
+    def dequeue(self, exclude_user_id=None):
+        """Pop the oldest waiting user that is not exclude_user_id"""
+        it = iter(self._users)
+        partner = next(it, None)
+        if partner is not None and partner == exclude_user_id:
+            # Head is the excluded user, the partner (if any) is next in line
+            partner = next(it, None)
+        if partner is not None:
+            del self._users[partner]
+        return partner
+
+    def requeue_front(self, user_id):
+        """Put a just-dequeued user back at the head of the queue"""
+        self._users[user_id] = None
+        self._users.move_to_end(user_id, last=False)
+
+    def cancel(self, user_id):
+        """Remove user from the queue, returns True if they were waiting"""
+        if user_id in self._users:
+            del self._users[user_id]
+            return True
+        return False
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def snapshot(self):
+        """List of waiting user IDs in queue order"""
+        return list(self._users)
+
+
+class TagMatchQueue:
+    """Waiting room that pairs users by shared interest tags
+
+    Besides the FIFO of all waiting users, every tag has its own FIFO
+    bucket (an inverted index) and untagged users share one more. A user
+    looking for a partner only probes the first scan_depth entries of the
+    buckets for their own tags and takes the candidate with the most tags
+    in common, oldest first on ties, so finding a partner never scans the
+    room.
+
+    A pair is acceptable if it shares a tag, or if both users are open to
+    anyone: untagged, or waiting for relax_after seconds or more. The
+    longest waiting users are at the head of the global FIFO, so relaxed
+    users are always found there.
+
+    Users are only checked when they arrive (or change tags) and again
+    once they relax, which keeps pop_pair() at O(tags * scan_depth) per
+    pair. Without tags it pairs users in plain FIFO order, like
+    MatchQueue, and it offers the same interface.
+    """
+
+    UNTAGGED = None  # Bucket key for users without tags
+
+    def __init__(self, relax_after=10.0, scan_depth=8, clock=time.monotonic):
+        self.relax_after = relax_after
+        self.scan_depth = scan_depth
+        self.clock = clock
+        self._users = OrderedDict()  # user_id -> Waiting, oldest first
+        self._buckets = {}  # tag -> OrderedDict of user_ids, oldest first
+        self._arrivals = deque()  # user_ids not checked for a partner yet
+        self._recent = {}  # user_id -> Waiting, just dequeued, for requeue_front
+
+    def _bucket_keys(self, entry):
+        return entry.tags or (self.UNTAGGED,)
+
+    def _index(self, entry):
+        for tag in self._bucket_keys(entry):
+            self._buckets.setdefault(tag, OrderedDict())[entry.user_id] = None
+
+    def _unindex(self, entry):
+        for tag in self._bucket_keys(entry):
+            bucket = self._buckets.get(tag)
+            if bucket is not None:
+                bucket.pop(entry.user_id, None)
+                if not bucket:
+                    del self._buckets[tag]
+
+    def enqueue(self, user_id, tags=None):
+        """Add user to the back of the queue, returns False if already waiting
+
+        A waiting user enqueued with different tags is re-indexed under the
+        new ones and keeps their wait time; tags=None keeps their tags.
+        """
+        tags = frozenset(tags) if tags is not None else None
+        entry = self._users.get(user_id)
+        if entry is not None:
+            if tags is not None and entry.tags != tags:
+                self._unindex(entry)
+                entry = self._users[user_id] = entry._replace(tags=tags)
+                self._index(entry)
+                self._arrivals.append(user_id)
+            return False
+        entry = self._users[user_id] = Waiting(user_id, tags or frozenset(), self.clock())
+        self._index(entry)
+        self._arrivals.append(user_id)
+        return True
+
+    def _remove(self, user_id):
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            self._unindex(entry)
+        return entry
+
+    def _is_open(self, entry, now):
+        return not entry.tags or now - entry.enqueued_at >= self.relax_after
+
+    def _find_partner(self, entry, now):
+        """Best waiting partner for entry, None if no acceptable one"""
+        best = best_key = None
+        for tag in entry.tags:
+            for user_id in islice(self._buckets.get(tag, ()), self.scan_depth):
+                if user_id == entry.user_id:
+                    continue
+                candidate = self._users[user_id]
+                key = (-len(entry.tags & candidate.tags), candidate.enqueued_at)
+                if best_key is None or key < best_key:
+                    best, best_key = candidate, key
+        if best is not None or not self._is_open(entry, now):
+            return best
+
+        # No shared tag: any other open user will do, the oldest first
+        options = []
+        for user_id in islice(self._buckets.get(self.UNTAGGED, ()), 2):
+            if user_id != entry.user_id:
+                options.append(self._users[user_id])
+                break
+        for user_id in islice(self._users, 2):
+            if user_id != entry.user_id:
+                candidate = self._users[user_id]
+                if self._is_open(candidate, now):
+                    options.append(candidate)
+                break
+        return min(options, key=lambda candidate: candidate.enqueued_at, default=None)
+
+    def pop_pair(self):
+        """Remove and return the next acceptable (older, newer) pair of user_ids
+
+        Returns None once no new arrival and no relaxed user at the head
+        can be paired.
+        """
+        now = self.clock()
+        self._recent = {}
+        while self._arrivals:
+            entry = self._users.get(self._arrivals.popleft())
+            if entry is None:
+                continue  # Matched or cancelled since arriving
+            partner = self._find_partner(entry, now)
+            if partner is not None:
+                return self._pop_both(entry, partner)
+        head = self._users[next(iter(self._users))] if self._users else None
+        if head is not None and self._is_open(head, now):
+            partner = self._find_partner(head, now)
+            if partner is not None:
+                return self._pop_both(head, partner)
+        return None
+
+    def _pop_both(self, first, second):
+        older, newer = sorted((first, second), key=lambda entry: entry.enqueued_at)
+        for entry in (older, newer):
+            self._remove(entry.user_id)
+            self._recent[entry.user_id] = entry
+        return older.user_id, newer.user_id
+
+    def dequeue(self, exclude_user_id=None, tags=None):
+        """Pop the best waiting partner for exclude_user_id
+
+        The requester's tags are `tags` if given, else the ones they are
+        waiting with; a requester without tags takes the oldest open user.
+        """
+        now = self.clock()
+        waiting = self._users.get(exclude_user_id) if exclude_user_id is not None else None
+        if tags is None:
+            tags = waiting.tags if waiting is not None else frozenset()
+        probe = Waiting(exclude_user_id, frozenset(tags), waiting.enqueued_at if waiting else now)
+        partner = self._find_partner(probe, now)
+        self._recent = {}
+        if partner is None:
+            return None
+        self._remove(partner.user_id)
+        self._recent[partner.user_id] = partner
+        return partner.user_id
+
+    def requeue_front(self, user_id):
+        """Put a user from the last dequeue() or pop_pair() back, keeping tags and wait time"""
+        entry = self._recent.pop(user_id, None)
+        if entry is None:
+            self.enqueue(user_id)
+            self._users.move_to_end(user_id, last=False)
+            return
+        self._users[user_id] = entry
+        self._users.move_to_end(user_id, last=False)
+        self._index(entry)
+        self._arrivals.append(user_id)
+
+    def cancel(self, user_id):
+        """Remove user from the queue, returns True if they were waiting"""
+        return self._remove(user_id) is not None
+
+    def tags_of(self, user_id):
+        entry = self._users.get(user_id)
+        return entry.tags if entry is not None else None
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def snapshot(self):
+        """List of waiting user IDs in queue order"""
+        return list(self._users)
+
+
+class Matchmaker:
+    """Pairs waiting users in bulk on a fixed tick
+
+    A single loop calls tick() every tick_interval seconds instead of each
+    connect spawning its own matching greenlet. Each tick drains up to
+    max_batch pairs, taking the UserManager lock once per chat type, and
+    hands the new sessions to on_match so all `matched` events go out in
+    one pass.
+    """
+
+    def __init__(self, user_manager, on_match, tick_interval=0.1, max_batch=500,
+                 chat_types=('video', 'text')):
+        self.user_manager = user_manager
+        self.on_match = on_match
+        self.tick_interval = tick_interval
+        self.max_batch = max_batch
+        self.chat_types = chat_types
+        self.ticks = 0
+        self.matches_total = 0
+        self.last_batch_size = 0
+        self.match_rate = 0.0  # Pairs per second, exponentially smoothed
+        self.last_tick_at = None  # time.monotonic() of the last completed tick
+
+    def tick(self):
+        """Match as many waiting pairs as the batch size allows"""
+        sessions = []
+        for chat_type in self.chat_types:
+            remaining = self.max_batch - len(sessions)
+            if remaining <= 0:
+                break
+            sessions.extend(self.user_manager.match_waiting_users(chat_type, remaining))
+
+        self.ticks += 1
+        self.matches_total += len(sessions)
+        self.last_batch_size = len(sessions)
+        rate = len(sessions) / self.tick_interval if self.tick_interval else float(len(sessions))
+        self.match_rate = 0.2 * rate + 0.8 * self.match_rate
+        self.last_tick_at = time.monotonic()
+
+        if sessions:
+            self.on_match(sessions)
+        return sessions
+
+    def is_stalled(self, max_missed=10):
+        """True if the loop has not completed a tick for max_missed intervals"""
+        if self.last_tick_at is None:
+            return False
+        return time.monotonic() - self.last_tick_at > max_missed * max(self.tick_interval, 0.1)
+
+    def stats(self):
+        """Counters for the health check"""
+        return {
+            'ticks': self.ticks,
+            'matches_total': self.matches_total,
+            'last_batch_size': self.last_batch_size,
+            'match_rate': round(self.match_rate, 2),
+            'queue_depth': {
+                chat_type: self.user_manager.get_waiting_count(chat_type)
+                for chat_type in self.chat_types
+            },
+            'tick_interval_ms': int(self.tick_interval * 1000),
+            'max_batch': self.max_batch
+        }
@@ -0,0 +1,95 @@
+from collections import namedtuple
+from datetime import datetime
+
+# Compact message record: seq is the per-session integer ID, sender the
+# 'you'/'stranger' label and ts an epoch float
+Message = namedtuple('Message', ('seq', 'sender', 'text', 'ts'))
+
+
+def format_timestamp(ts):
+    """ISO timestamp for an epoch float, as sent to clients"""
+    return datetime.fromtimestamp(ts).isoformat()
+
+
+def message_to_dict(session_id, msg):
+    """Serialize a Message to the JSON shape clients expect"""
+    return {
+        'id': f"{session_id}:{msg.seq}",
+        'seq': msg.seq,
+        'from': msg.sender,
+        'text': msg.text,
+        'timestamp': format_timestamp(msg.ts)
+    }
+
+
+class MessageLog:
+    """Bounded per-session message log with integer sequence cursors
+
+    Messages live in a fixed-size ring buffer; message number `seq` sits in
+    slot (seq - 1) % capacity, so once the log is full the oldest message is
+    overwritten. Sequence numbers start at 1 and never repeat, which makes
+    "messages after seq X" a direct slot computation instead of a scan.
+    The buffer grows on demand and is only allocated with the first
+    message, so sessions that never chat (most video calls) don't pay for
+    it at all.
+    """
+
+    __slots__ = ('capacity', '_slots', 'last_seq')
+
+    def __init__(self, capacity=500):
+        self.capacity = capacity
+        self._slots = ()  # Becomes a list with the first message
+        self.last_seq = 0  # Sequence number of the newest message
+
+    @property
+    def first_seq(self):
+        """Sequence number of the oldest message still retained"""
+        return max(1, self.last_seq - self.capacity + 1)
+
+    def append(self, sender, text, ts):
+        """Store a message under the next sequence number
+
+        ts is raised to the previous message's if the wall clock went
+        back, so timestamps never decrease along the log.
+        """
+        if self._slots:
+            ts = max(ts, self._slots[(self.last_seq - 1) % self.capacity].ts)
+        self.last_seq += 1
+        msg = Message(self.last_seq, sender, text, ts)
+        if not self._slots:
+            self._slots = [msg]
+        elif len(self._slots) < self.capacity:
+            self._slots.append(msg)
+        else:
+            self._slots[(self.last_seq - 1) % self.capacity] = msg
+        return msg
+
+    def _range(self, start_seq):
+        return [self._slots[(seq - 1) % self.capacity] for seq in range(start_seq, self.last_seq + 1)]
+
+    def since_seq(self, seq):
+        """Messages with a sequence number greater than seq"""
+        return self._range(max(seq + 1, self.first_seq))
+
+    def since_timestamp(self, timestamp):
+        """Messages with an ISO timestamp later than the given one
+
+        Timestamps never decrease along the log (see append), so this is a
+        binary search over the retained range rather than a full scan. Only the
+        probed records are formatted, comparing exactly like the strings
+        clients were sent.
+        """
+        lo, hi = self.first_seq, self.last_seq + 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if format_timestamp(self._slots[(mid - 1) % self.capacity].ts) > timestamp:
+                hi = mid
+            else:
+                lo = mid + 1
+        return self._range(lo)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __iter__(self):
+        return iter(self._range(self.first_seq))
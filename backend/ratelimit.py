@@ -0,0 +1,152 @@
+import time
+from collections import OrderedDict, namedtuple
+
+# Sustained requests per second and the burst allowed on top of it
+Quota = namedtuple('Quota', ('rate', 'burst'))
+
+# Takes one token from the bucket at KEYS[1] if there is one.
+# ARGV: rate per second, burst, now in milliseconds. Buckets are hashes
+# {tokens, ts} that expire once they would have refilled completely.
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return allowed
+"""
+
+
+def forwarded_client(peer, forwarded_for, hops):
+    """Client address `hops` trusted proxies back, else the peer address
+
+    Each proxy appends the address it got the request from to
+    X-Forwarded-For, so the client is the hops-th entry from the right;
+    entries further left were written by the client and are not trusted.
+    With hops=0, or fewer entries than hops, the peer address is used, as
+    werkzeug's ProxyFix does.
+    """
+    if hops <= 0 or not forwarded_for:
+        return peer
+    entries = [entry.strip() for entry in forwarded_for.split(',')]
+    if len(entries) < hops:
+        return peer
+    return entries[-hops] or peer
+
+
+def parse_quotas(spec, defaults=None):
+    """Parse 'send.user=5/20,connect.ip=10/30' into {(name, scope): Quota}
+
+    Each item is <route or event>.<scope>=<rate per second>/<burst>; the
+    result is merged over defaults. A rate of 0 removes the limit.
+    """
+    quotas = dict(defaults or {})
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        target, _, value = item.partition('=')
+        name, _, scope = target.strip().rpartition('.')
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        if rate <= 0:
+            quotas.pop((name, scope), None)
+        else:
+            quotas[(name, scope)] = Quota(rate, float(burst or rate))
+    return quotas
+
+
+class TokenBucketLimiter:
+    """In-process token buckets, one per (name, scope, key)
+
+    name is an HTTP route or Socket.IO event, scope says what key is (a
+    'user' id, a socket 'sid' or an 'ip'). Only (name, scope) pairs with a
+    quota are limited. A bucket starts full, refills at quota.rate tokens a
+    second up to quota.burst, and every allowed call takes one token.
+
+    Like the metrics, this takes no locks: under eventlet a check never
+    yields halfway. Buckets are kept in least recently used order, so
+    sweep() can drop the idle ones (which would be full again anyway)
+    from the front without scanning the rest.
+    """
+
+    def __init__(self, quotas, clock=time.monotonic):
+        self.quotas = quotas
+        self.clock = clock
+        self._buckets = OrderedDict()  # (name, scope, key) -> [tokens, updated_at]
+        # A bucket idle this long is full whatever its quota
+        self._idle_after = max((quota.burst / quota.rate for quota in quotas.values()), default=0)
+
+    def allow(self, name, scope, key):
+        """Take a token, returns False if the caller is over its quota"""
+        quota = self.quotas.get((name, scope))
+        if quota is None or key is None:
+            return True
+        now = self.clock()
+        bucket_key = (name, scope, key)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = [quota.burst, now]
+        else:
+            self._buckets.move_to_end(bucket_key)
+            bucket[0] = min(quota.burst, bucket[0] + (now - bucket[1]) * quota.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def sweep(self, max_items=10000):
+        """Forget buckets idle long enough to have refilled, returns how many"""
+        cutoff = self.clock() - self._idle_after
+        dropped = 0
+        while self._buckets and dropped < max_items:
+            bucket_key, bucket = next(iter(self._buckets.items()))
+            if bucket[1] > cutoff:
+                break
+            del self._buckets[bucket_key]
+            dropped += 1
+        return dropped
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisTokenBucketLimiter:
+    """Token buckets shared by all workers, for STATE_BACKEND=redis setups
+
+    Same quotas and semantics as TokenBucketLimiter. Each check is one Lua
+    script call; Redis expires idle buckets, so sweep() has nothing to do.
+    """
+
+    def __init__(self, client, quotas, prefix='vc:rl:', clock=time.time):
+        self.client = client
+        self.quotas = quotas
+        self.prefix = prefix
+        self.clock = clock
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, quotas, prefix='vc:rl:'):
+        import redis
+        return cls(redis.Redis.from_url(url, decode_responses=True), quotas, prefix)
+
+    def allow(self, name, scope, key):
+        quota = self.quotas.get((name, scope))
+        if quota is None or key is None:
+            return True
+        now_ms = int(self.clock() * 1000)
+        return bool(self._take(keys=[f"{self.prefix}{name}:{scope}:{key}"],
+                               args=[quota.rate, quota.burst, now_ms]))
+
+    def sweep(self, max_items=10000):
+        return 0
+
+    def __len__(self):
+        return 0
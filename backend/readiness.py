@@ -0,0 +1,134 @@
+class _Client:
+    __slots__ = ('sid', 'ready', 'acks', 'pending', 'ready_timer')
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.ready = False
+        self.acks = False  # Client answers Socket.IO acks
+        self.pending = []  # (event, payload) held until the client is ready
+        self.ready_timer = None
+
+
+class _Delivery:
+    __slots__ = ('user_id', 'sid', 'event', 'payload', 'attempt', 'timer', 'acked')
+
+    def __init__(self, user_id, sid, event, payload):
+        self.user_id = user_id
+        self.sid = sid
+        self.event = event
+        self.payload = payload
+        self.attempt = 0
+        self.timer = None
+        self.acked = False
+
+
+class ReadinessTracker:
+    """Delivers match events as soon as the client can receive them
+
+    A socket counts as ready once it has joined its personal room and
+    acknowledged the user_id event (or sent client_ready). Events for a
+    ready client go out at once, with a Socket.IO ack; if the ack does not
+    arrive within ack_timeout the event is sent again, up to `retries`
+    times, so clients should ignore a repeated matched for the same
+    session_id. Events for a client that is not ready yet are held and
+    flushed when it acknowledges.
+
+    Clients that never acknowledge are treated as ready ready_timeout
+    seconds after they registered and from then on get plain emits without
+    acks. Users registered on another worker are not tracked here and also
+    get plain emits to their personal room.
+
+    emit(event, payload, to, callback=None) sends one event;
+    spawn_after(seconds, fn, *args) schedules a timer with cancel().
+    on_retry(event) and on_failed(event, user_id) feed metrics and logs.
+    """
+
+    def __init__(self, emit, spawn_after, ready_timeout=0.5, ack_timeout=1.0, retries=3,
+                 on_retry=None, on_failed=None):
+        self.emit = emit
+        self.spawn_after = spawn_after
+        self.ready_timeout = ready_timeout
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.on_retry = on_retry
+        self.on_failed = on_failed
+        self._clients = {}  # user_id -> _Client
+
+    def register(self, user_id, sid):
+        """Start tracking a socket that has joined its personal room"""
+        self.forget(user_id)
+        client = self._clients[user_id] = _Client(sid)
+        client.ready_timer = self.spawn_after(self.ready_timeout, self._ready_timeout, user_id, sid)
+
+    def mark_ready(self, user_id, acks=True):
+        """The client acknowledged user_id, flush whatever was held for it"""
+        client = self._clients.get(user_id)
+        if client is None or (client.ready and (client.acks or not acks)):
+            return
+        if client.ready_timer is not None:
+            client.ready_timer.cancel()
+            client.ready_timer = None
+        client.ready = True
+        client.acks = client.acks or acks
+        pending, client.pending = client.pending, []
+        for event, payload in pending:
+            self._send(user_id, client, event, payload)
+
+    def is_ready(self, user_id):
+        client = self._clients.get(user_id)
+        return client is not None and client.ready
+
+    def deliver(self, user_id, event, payload):
+        """Send event to user_id now if ready, else once it is"""
+        client = self._clients.get(user_id)
+        if client is None:
+            self.emit(event, payload, user_id)
+        elif not client.ready:
+            client.pending.append((event, payload))
+        else:
+            self._send(user_id, client, event, payload)
+
+    def forget(self, user_id):
+        """Stop tracking a user whose socket disconnected"""
+        client = self._clients.pop(user_id, None)
+        if client is not None and client.ready_timer is not None:
+            client.ready_timer.cancel()
+
+    def _ready_timeout(self, user_id, sid):
+        client = self._clients.get(user_id)
+        if client is not None and client.sid == sid and not client.ready:
+            client.ready_timer = None
+            self.mark_ready(user_id, acks=False)
+
+    def _send(self, user_id, client, event, payload):
+        if not client.acks:
+            self.emit(event, payload, user_id)
+            return
+        self._attempt(_Delivery(user_id, client.sid, event, payload))
+
+    def _attempt(self, delivery):
+        def acked(*args):
+            delivery.acked = True
+            if delivery.timer is not None:
+                delivery.timer.cancel()
+        self.emit(delivery.event, delivery.payload, delivery.sid, acked)
+        if not delivery.acked:
+            delivery.timer = self.spawn_after(self.ack_timeout, self._ack_timeout, delivery)
+
+    def _ack_timeout(self, delivery):
+        if delivery.acked:
+            return
+        client = self._clients.get(delivery.user_id)
+        if client is None or client.sid != delivery.sid:
+            return  # Socket went away, nothing left to deliver to
+        if delivery.attempt >= self.retries:
+            if self.on_failed is not None:
+                self.on_failed(delivery.event, delivery.user_id)
+            return
+        delivery.attempt += 1
+        if self.on_retry is not None:
+            self.on_retry(delivery.event)
+        self._attempt(delivery)
+
+    def __len__(self):
+        return len(self._clients)
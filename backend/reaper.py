@@ -0,0 +1,65 @@
+import heapq
+import threading
+import time
+
+
+class SessionReaper:
+    """Expiry index for inactive chat sessions
+
+    Keeps a min-heap of (deadline, session_id) with one entry per tracked
+    session. Activity only updates ChatSession.last_activity (a
+    time.monotonic() reading), it never touches the heap: when an entry
+    comes due the real deadline is recomputed and, if the session was
+    active since, the entry is pushed back with the new deadline. Each
+    reaper pass therefore only looks at sessions that are actually due
+    instead of scanning all of them.
+    """
+
+    def __init__(self, ttl=1800, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._heap = []
+        self._sessions = {}  # session_id -> ChatSession
+        self._lock = threading.Lock()
+
+    def _deadline(self, chat_session):
+        return chat_session.last_activity + self.ttl
+
+    def track(self, chat_session):
+        """Start watching a session for inactivity"""
+        with self._lock:
+            self._sessions[chat_session.session_id] = chat_session
+            heapq.heappush(self._heap, (self._deadline(chat_session), chat_session.session_id))
+
+    def forget(self, session_id):
+        """Stop watching a session that ended some other way"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            # Drop stale heap entries once they outnumber live ones
+            if len(self._heap) > 2 * len(self._sessions) + 64:
+                self._heap = [entry for entry in self._heap if entry[1] in self._sessions]
+                heapq.heapify(self._heap)
+
+    def pop_expired(self, max_batch=None):
+        """Remove and return sessions whose inactivity deadline has passed"""
+        now = self.clock()
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                if max_batch is not None and len(expired) >= max_batch:
+                    break
+                _, session_id = heapq.heappop(self._heap)
+                chat_session = self._sessions.get(session_id)
+                if chat_session is None:
+                    continue  # Already ended
+                deadline = self._deadline(chat_session)
+                if deadline > now:
+                    # Active since this entry was pushed, check again later
+                    heapq.heappush(self._heap, (deadline, session_id))
+                    continue
+                del self._sessions[session_id]
+                expired.append(chat_session)
+        return expired
+
+    def __len__(self):
+        return len(self._sessions)
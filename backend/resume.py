@@ -0,0 +1,68 @@
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+
+class ResumeTokens:
+    """Signed tokens that let a reconnecting socket take over its old user_id
+
+    A token is the user_id signed with the app secret and a timestamp, so
+    clients cannot mint one for somebody else's user_id (which partners
+    learn from matched events). Tokens older than max_age are rejected.
+    """
+
+    def __init__(self, secret, max_age=3600, salt='videochat-resume'):
+        self._serializer = URLSafeTimedSerializer(secret, salt=salt)
+        self.max_age = max_age
+
+    def issue(self, user_id):
+        return self._serializer.dumps(user_id)
+
+    def user_id(self, token):
+        """user_id the token was issued for, None if forged or expired"""
+        if not isinstance(token, str):
+            return None
+        try:
+            return self._serializer.loads(token, max_age=self.max_age)
+        except BadSignature:
+            return None
+
+
+class GracePeriods:
+    """Deferred teardown for users whose socket dropped
+
+    start() schedules on_expire(user_id, sid) `grace` seconds after a
+    disconnect; a resume in the meantime cancels it. on_expire still has to
+    check that the user did not resume on another worker, where this timer
+    cannot be cancelled.
+
+    spawn_after(seconds, fn, *args) schedules a timer with cancel().
+    """
+
+    def __init__(self, grace, spawn_after, on_expire):
+        self.grace = grace
+        self.spawn_after = spawn_after
+        self.on_expire = on_expire
+        self._timers = {}  # user_id -> (sid, timer)
+
+    def start(self, user_id, sid):
+        self.cancel(user_id)
+        self._timers[user_id] = (sid, self.spawn_after(self.grace, self._expire, user_id, sid))
+
+    def cancel(self, user_id):
+        """Stop a pending teardown, returns True if there was one"""
+        entry = self._timers.pop(user_id, None)
+        if entry is None:
+            return False
+        entry[1].cancel()
+        return True
+
+    def _expire(self, user_id, sid):
+        entry = self._timers.get(user_id)
+        if entry is not None and entry[0] == sid:
+            del self._timers[user_id]
+            self.on_expire(user_id, sid)
+
+    def __contains__(self, user_id):
+        return user_id in self._timers
+
+    def __len__(self):
+        return len(self._timers)
@@ -0,0 +1,581 @@
+import base64
+import hashlib
+import hmac
+import os
+import pickle
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+from bisect import bisect
+from collections import OrderedDict
+from http import HTTPStatus
+from http.client import HTTPConnection
+from urllib.parse import parse_qs
+
+from socketio.pubsub_manager import PubSubManager
+
+from matchmaking import TagMatchQueue
+
+# Shard that pairs users the other shards could not match among their own
+COORDINATOR = 0
+
+_FRAME = struct.Struct('!I')
+
+# Set in the WSGI environ of requests that came in through a worker's
+# private listener, i.e. were already routed by the first worker
+FORWARDED_ENVIRON_KEY = 'videochat.shard_forwarded'
+
+# Headers that describe one HTTP hop and must not be copied to the next
+HOP_HEADERS = frozenset(('connection', 'keep-alive', 'transfer-encoding', 'content-length',
+                         'proxy-connection', 'te', 'trailer', 'upgrade'))
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping keys (user and session ids) to shards
+
+    Each shard gets vnodes points on the ring, so changing the number of
+    shards moves about 1/N of the keys instead of nearly all of them as
+    with hash % N.
+    """
+
+    def __init__(self, nodes, vnodes=64):
+        points = sorted((_hash(f'{node}:{i}'), node) for node in nodes for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def lookup(self, key):
+        index = bisect(self._points, _hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+def mint_key(ring, node):
+    """Random uuid4 string that the ring maps to node
+
+    Takes about N attempts for N shards. Used for user and session ids, so
+    any worker can tell which shard owns one without asking.
+    """
+    while True:
+        key = str(uuid.uuid4())
+        if ring.lookup(key) == node:
+            return key
+
+
+class ShardBus:
+    """Messages between the worker processes of one host over Unix sockets
+
+    Each worker listens on <socket_dir>/bus-<index>.sock. send() pickles
+    (sender, kind, payload) into a length-prefixed frame on a persistent
+    connection to the target worker, which calls the handler registered for
+    kind with (payload, sender). Frames from one worker to another arrive
+    in order; frames from different workers are not ordered with each
+    other. Pickle is safe here because the socket directory is private to
+    the supervisor's user.
+
+    spawn(fn, *args) starts a green thread. on_frame(kind, direction) and
+    on_error(kind, exc) feed metrics and logs.
+    """
+
+    def __init__(self, index, count, socket_dir, spawn, on_frame=None, on_error=None):
+        self.index = index
+        self.count = count
+        self.socket_dir = socket_dir
+        self.spawn = spawn
+        self.on_frame = on_frame
+        self.on_error = on_error
+        self.handlers = {}
+        self._peers = {}  # index -> connected socket
+        self._send_locks = [threading.Lock() for _ in range(count)]
+
+    def path(self, index, name='bus'):
+        return os.path.join(self.socket_dir, f'{name}-{index}.sock')
+
+    def on(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def start(self):
+        server = listen_unix(self.path(self.index))
+        self.spawn(self._accept, server)
+
+    def _accept(self, server):
+        while True:
+            conn, _ = server.accept()
+            self.spawn(self._read, conn)
+
+    def _read(self, conn):
+        rfile = conn.makefile('rb')
+        try:
+            while True:
+                header = rfile.read(_FRAME.size)
+                if len(header) < _FRAME.size:
+                    return
+                sender, kind, payload = pickle.loads(rfile.read(_FRAME.unpack(header)[0]))
+                self._dispatch(kind, payload, sender)
+        finally:
+            rfile.close()
+            conn.close()
+
+    def _dispatch(self, kind, payload, sender):
+        if self.on_frame is not None:
+            self.on_frame(kind, 'in')
+        handler = self.handlers.get(kind)
+        if handler is None:
+            return
+        try:
+            handler(payload, sender)
+        except Exception as e:
+            if self.on_error is not None:
+                self.on_error(kind, e)
+
+    def send(self, index, kind, payload):
+        """Deliver payload to the kind handler of worker index, False if it is unreachable
+
+        Messages to this worker itself are handled synchronously.
+        """
+        if index == self.index:
+            self._dispatch(kind, payload, self.index)
+            return True
+        frame = pickle.dumps((self.index, kind, payload), pickle.HIGHEST_PROTOCOL)
+        data = _FRAME.pack(len(frame)) + frame
+        with self._send_locks[index]:
+            for _ in range(2):  # Reconnect once if the worker was restarted
+                sock = self._peers.get(index)
+                try:
+                    if sock is None:
+                        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        sock.connect(self.path(index))
+                        self._peers[index] = sock
+                    sock.sendall(data)
+                except OSError as e:
+                    self._peers.pop(index, None)
+                    if sock is not None:
+                        sock.close()
+                    error = e
+                    continue
+                if self.on_frame is not None:
+                    self.on_frame(kind, 'out')
+                return True
+        if self.on_error is not None:
+            self.on_error(kind, error)
+        return False
+
+    def broadcast(self, kind, payload):
+        for index in range(self.count):
+            if index != self.index:
+                self.send(index, kind, payload)
+
+
+def listen_unix(path, backlog=1024):
+    """Listening Unix stream socket at path, replacing a stale one"""
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(backlog)
+    return server
+
+
+class ShardClientManager(PubSubManager):
+    """Socket.IO client manager that relays emits between shard workers
+
+    An emit to a room with members on this worker stays local. An emit to
+    any other room goes over the bus to the one worker that owns it,
+    route(room), which is right for user rooms since user ids are minted
+    to hash to the worker holding their socket. Unlike the Redis manager,
+    where every worker receives every emit, a relayed webrtc_signal costs
+    one frame to one process. Broadcasts, disconnects and ack callbacks go
+    to all workers.
+    """
+
+    name = 'shardbus'
+
+    def __init__(self, bus, route):
+        super().__init__(channel='socketio')
+        self.bus = bus
+        self.route = route
+        self._inbox = queue.Queue()
+        bus.on('socketio', lambda message, sender: self._inbox.put(message))
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, **kwargs):
+        namespace = namespace or '/'
+        if kwargs.get('ignore_queue') or room is None:
+            return super().emit(event, data, namespace=namespace, room=room,
+                                skip_sid=skip_sid, callback=callback, **kwargs)
+        if self.rooms.get(namespace, {}).get(room):
+            return super().emit(event, data, namespace=namespace, room=room,
+                                skip_sid=skip_sid, callback=callback, ignore_queue=True)
+        owner = self.route(room)
+        if owner == self.bus.index:
+            return None  # Owned here but nobody is in it (anymore)
+        if callback is not None:
+            callback = (room, namespace, self._generate_ack_id(room, callback))
+        self.bus.send(owner, 'socketio', {
+            'method': 'emit', 'event': event, 'data': data, 'namespace': namespace,
+            'room': room, 'skip_sid': skip_sid, 'callback': callback, 'host_id': self.host_id
+        })
+        return None
+
+    def _publish(self, data):
+        self.bus.broadcast('socketio', data)
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def forward_http(path, method, url, headers, body, timeout):
+    """Replay an HTTP request on another worker's Unix socket
+
+    Returns (status, headers, body) of its response, without hop-by-hop
+    headers.
+    """
+    conn = UnixHTTPConnection(path, timeout)
+    try:
+        conn.request(method, url, body=body,
+                     headers={name: value for name, value in headers if name.lower() not in HOP_HEADERS})
+        response = conn.getresponse()
+        return (response.status,
+                [(name, value) for name, value in response.getheaders() if name.lower() not in HOP_HEADERS],
+                response.read())
+    finally:
+        conn.close()
+
+
+def mark_forwarded(wsgi_app):
+    """WSGI wrapper for the private listener, see FORWARDED_ENVIRON_KEY"""
+    def wrapper(environ, start_response):
+        environ[FORWARDED_ENVIRON_KEY] = True
+        return wsgi_app(environ, start_response)
+    return wrapper
+
+
+class ShardSids:
+    """Engine.IO session ids that name the worker holding the session
+
+    sign() turns a sid from the Engine.IO server into
+    '<shard>.<sid>.<mac>', with an HMAC over the first two parts, so any
+    worker can tell where a polling request or WebSocket upgrade belongs
+    and clients cannot point one at a worker of their choosing.
+    """
+
+    def __init__(self, secret, index):
+        self._key = secret.encode() if isinstance(secret, str) else secret
+        self.index = index
+
+    def _mac(self, body):
+        digest = hmac.new(self._key, body.encode(), hashlib.sha256).digest()[:9]
+        return base64.urlsafe_b64encode(digest).decode()
+
+    def sign(self, sid):
+        body = f'{self.index}.{sid}'
+        return f'{body}.{self._mac(body)}'
+
+    def owner(self, sid):
+        """Shard of a signed sid, None if it is not one or the mac is wrong"""
+        body, _, mac = sid.rpartition('.')
+        shard, _, _ = body.partition('.')
+        if not shard.isdigit() or not hmac.compare_digest(mac, self._mac(body)):
+            return None
+        return int(shard)
+
+
+class EngineIOAffinity:
+    """WSGI middleware sending Engine.IO requests to the worker holding their session
+
+    Polling requests (and the POSTs carrying client packets) with a sid
+    owned by another worker are replayed there over its private HTTP
+    socket, so the polling transport works whichever worker the kernel
+    picked. A WebSocket upgrade for such a sid is spliced through to the
+    owner byte for byte. A handshake (no sid yet) with a resume_token in
+    its query goes to the worker resume_owner(token) names, the owner of
+    the user being resumed. Other handshakes and unsigned sids stay here.
+    Splicing needs eventlet's WSGI server.
+
+    socket_path(index) is a worker's private HTTP socket, on_forward(kind)
+    is called with 'polling' or 'websocket' for each request sent on.
+    """
+
+    def __init__(self, wsgi_app, sids, socket_path, spawn, timeout=60, path='/socket.io',
+                 on_forward=None, resume_owner=None):
+        self.wsgi_app = wsgi_app
+        self.sids = sids
+        self.socket_path = socket_path
+        self.spawn = spawn
+        self.timeout = timeout
+        self.path = path
+        self.on_forward = on_forward
+        self.resume_owner = resume_owner
+
+    def _owner(self, environ):
+        """Worker that should serve an Engine.IO request, None for this one"""
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        sid = query.get('sid')
+        if sid:
+            return self.sids.owner(sid[0])
+        token = query.get('resume_token')
+        if token and self.resume_owner is not None:
+            return self.resume_owner(token[0])
+        return None
+
+    def __call__(self, environ, start_response):
+        if (environ.get('PATH_INFO', '').startswith(self.path)
+                and not environ.get(FORWARDED_ENVIRON_KEY)):
+            owner = self._owner(environ)
+            if owner is not None and owner != self.sids.index:
+                if environ.get('HTTP_UPGRADE', '').lower() == 'websocket':
+                    return self._splice(environ, owner)
+                return self._forward(environ, start_response, owner)
+        return self.wsgi_app(environ, start_response)
+
+    @staticmethod
+    def _headers(environ):
+        headers = [(key[5:].replace('_', '-').title(), value)
+                   for key, value in environ.items() if key.startswith('HTTP_')]
+        if environ.get('CONTENT_TYPE'):
+            headers.append(('Content-Type', environ['CONTENT_TYPE']))
+        return headers
+
+    @staticmethod
+    def _url(environ):
+        query = environ.get('QUERY_STRING')
+        return environ.get('PATH_INFO', '') + ('?' + query if query else '')
+
+    def _forward(self, environ, start_response, owner):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else None
+        try:
+            status, headers, body = forward_http(self.socket_path(owner), environ['REQUEST_METHOD'],
+                                                 self._url(environ), self._headers(environ),
+                                                 body, self.timeout)
+        except OSError:
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return [b'Shard unavailable']
+        if self.on_forward is not None:
+            self.on_forward('polling')
+        start_response(f'{status} {HTTPStatus(status).phrase}', headers)
+        return [body]
+
+    def _splice(self, environ, owner):
+        from eventlet import wsgi
+        client = environ['eventlet.input'].get_socket()
+        upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            upstream.connect(self.socket_path(owner))
+            head = [f"GET {self._url(environ)} HTTP/1.1"]
+            head += [f'{name}: {value}' for name, value in self._headers(environ)]
+            upstream.sendall(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+            if self.on_forward is not None:
+                self.on_forward('websocket')
+            pump = self.spawn(_pump, upstream, client)
+            _pump(client, upstream)
+            pump.wait()
+        except OSError:
+            pass
+        finally:
+            upstream.close()
+        # The connection was answered by the owner, eventlet must not respond
+        wsgi.WSGI_LOCAL.already_handled = True
+        return []
+
+
+def _pump(source, target):
+    """Copy bytes until source closes, then close target's write side"""
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            target.sendall(data)
+    except OSError:
+        pass
+    finally:
+        try:
+            target.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class CrossShardMatcher:
+    """Pairs users across shard workers through the coordinator shard
+
+    Every worker matches its own waiting users first (the regular
+    Matchmaker). tick() then moves users that have waited offer_after
+    seconds out of the local waiting room and offers them to the
+    coordinator, which pairs offers from all shards (with tags, like the
+    local rooms) and sends each owner a 'pair' message. Each owner creates
+    its replica of the session, under the session id minted by the
+    coordinator to hash to user1's shard, and calls on_match(chat_session,
+    local_user_ids).
+
+    If an owner finds its user gone (disconnected, or matched locally
+    meanwhile) it tells the partner's owner, which ends the session with
+    on_pair_failed(chat_session), or if its 'pair' has not arrived yet,
+    puts its user back on offer when it does.
+
+    Removing a session replica on one worker removes the other replica
+    too: call session_removed() from UserManager.on_session_removed, and
+    withdraw() when a user goes offline. Offers are repeated every
+    reoffer_after seconds, in case the coordinator was restarted.
+    on_pair(cross_shard) counts the coordinator's pairings.
+    """
+
+    def __init__(self, user_manager, bus, ring, on_match, on_pair_failed, offer_after=0.3,
+                 reoffer_after=30.0, relax_after=10.0, max_batch=500, chat_types=('video', 'text'),
+                 clock=time.monotonic, on_pair=None):
+        self.user_manager = user_manager
+        self.bus = bus
+        self.ring = ring
+        self.on_match = on_match
+        self.on_pair_failed = on_pair_failed
+        self.on_pair = on_pair
+        self.offer_after = offer_after
+        self.reoffer_after = reoffer_after
+        self.max_batch = max_batch
+        self.chat_types = chat_types
+        self.clock = clock
+        self.offered = {}  # (chat_type, user_id) -> (tags, offered_at), users on offer
+        self._tombstones = OrderedDict()  # session_id -> None, failed before our 'pair' came
+        self._removing = None  # session_id being removed on request of the other replica
+        if bus.index == COORDINATOR:
+            self.rooms = {chat_type: TagMatchQueue(relax_after) for chat_type in chat_types}
+            self.owners = {}  # user_id -> shard, for users on offer
+        bus.on('offer', self._on_offer)
+        bus.on('withdraw', self._on_withdraw)
+        bus.on('pair', self._on_pair)
+        bus.on('session_removed', self._on_session_removed)
+
+    def is_local(self, key):
+        return self.ring.lookup(key) == self.bus.index
+
+    def tick(self):
+        """Offer users that waited too long here, and pair offers on the coordinator"""
+        manager = self.user_manager
+        now = self.clock()
+        for key, started in list(manager.wait_started.items()):
+            if now - started < self.offer_after:
+                continue
+            chat_type, user_id = key
+            offer = self.offered.get(key)
+            if offer is not None:
+                if now - offer[1] >= self.reoffer_after:
+                    self._offer(chat_type, user_id, offer[0])
+                continue
+            with manager.queue_locks[chat_type]:
+                tags = manager.state.waiting_tags(chat_type, user_id)
+                if not manager.state.cancel_waiting(chat_type, user_id):
+                    continue
+            self._offer(chat_type, user_id, tags)
+        if self.bus.index == COORDINATOR:
+            self._pair_offers()
+
+    def _offer(self, chat_type, user_id, tags):
+        self.offered[(chat_type, user_id)] = (tags, self.clock())
+        if not self.bus.send(COORDINATOR, 'offer', (chat_type, user_id, tags)):
+            # Coordinator down, keep waiting here and retry after offer_after
+            del self.offered[(chat_type, user_id)]
+            self.user_manager.add_waiting_user(user_id, chat_type, tags)
+
+    def withdraw(self, user_id):
+        """The user left, take back its offers"""
+        for chat_type in self.chat_types:
+            if self.offered.pop((chat_type, user_id), None) is not None:
+                self.bus.send(COORDINATOR, 'withdraw', (chat_type, user_id))
+
+    def session_removed(self, chat_session):
+        """Drop the other worker's replica of a session removed here"""
+        if chat_session.session_id == self._removing:
+            return
+        for user_id in (chat_session.user1_id, chat_session.user2_id):
+            owner = self.ring.lookup(user_id)
+            if owner != self.bus.index:
+                self.bus.send(owner, 'session_removed', (chat_session.session_id, False))
+
+    # Coordinator side
+    def _on_offer(self, payload, sender):
+        chat_type, user_id, tags = payload
+        self.owners[user_id] = sender
+        self.rooms[chat_type].enqueue(user_id, tags)
+
+    def _on_withdraw(self, payload, sender):
+        chat_type, user_id = payload
+        if self.rooms[chat_type].cancel(user_id):
+            self.owners.pop(user_id, None)
+
+    def _pair_offers(self):
+        for chat_type in self.chat_types:
+            room = self.rooms[chat_type]
+            for _ in range(self.max_batch):
+                pair = room.pop_pair()
+                if pair is None:
+                    break
+                user1_id, user2_id = pair
+                shards = {self.owners.pop(user1_id, None), self.owners.pop(user2_id, None)}
+                shards.discard(None)
+                # The session lives on user1's shard, see the class docstring
+                message = (mint_key(self.ring, self.ring.lookup(user1_id)), chat_type, user1_id, user2_id)
+                for shard in shards:
+                    self.bus.send(shard, 'pair', message)
+                if self.on_pair is not None:
+                    self.on_pair(len(shards) > 1)
+
+    # Owner side
+    def _on_pair(self, payload, sender):
+        session_id, chat_type, user1_id, user2_id = payload
+        manager = self.user_manager
+        local = [user_id for user_id in (user1_id, user2_id) if self.is_local(user_id)]
+        ready = []
+        for user_id in local:
+            offer = self.offered.pop((chat_type, user_id), None)
+            if (offer is not None and manager.is_active_user(user_id)
+                    and not manager.get_user_session(user_id)):
+                ready.append((user_id, offer[0]))
+        tombstoned = self._tombstones.pop(session_id, False) is not False
+        chat_session = None
+        if len(ready) == len(local) and not tombstoned:
+            chat_session = manager.create_session(user1_id, user2_id, chat_type, session_id)
+        if chat_session is None:
+            # Put our users that are still around back on offer, tell the
+            # partner's worker unless the failure came from there
+            for user_id, tags in ready:
+                self._offer(chat_type, user_id, tags)
+            if not tombstoned:
+                for user_id in (user1_id, user2_id):
+                    if not self.is_local(user_id):
+                        self.bus.send(self.ring.lookup(user_id), 'session_removed', (session_id, True))
+            return
+        self.on_match(chat_session, local)
+
+    def _on_session_removed(self, payload, sender):
+        session_id, pair_failed = payload
+        manager = self.user_manager
+        chat_session = manager.get_session(session_id)
+        if chat_session is None:
+            if pair_failed:
+                self._tombstones[session_id] = None
+                while len(self._tombstones) > 10000:
+                    self._tombstones.popitem(last=False)
+            return
+        self._removing = session_id
+        try:
+            manager.remove_session(session_id, 'partner_disconnected' if pair_failed else 'replica')
+        finally:
+            self._removing = None
+        if pair_failed:
+            self.on_pair_failed(chat_session)
@@ -0,0 +1,241 @@
+import time
+from collections import namedtuple
+
+# Where a socket's signaling messages go: the session they belong to, the
+# sending user, the partner's personal room and the session (for touch())
+Route = namedtuple('Route', ('session_id', 'user_id', 'partner_id', 'chat_session'))
+
+
+class RelayCache:
+    """Per-socket routes for the WebRTC signal relay
+
+    The first signal a socket sends for a session is validated against the
+    state backend (socket -> user, session membership, partner). The result
+    is cached by sid, so the dozens of ICE candidates that follow only need
+    a session_id comparison instead of two backend lookups each. Routes are
+    dropped when the session ends or the socket disconnects, and a signal
+    for any other session_id misses the cache and is validated again.
+    """
+
+    def __init__(self):
+        self._routes = {}  # sid -> Route
+        self._session_sids = {}  # session_id -> {sid}, for invalidation
+
+    def get(self, sid, session_id):
+        """Cached route for sid if it belongs to session_id, else None"""
+        route = self._routes.get(sid)
+        if route is not None and route.session_id == session_id:
+            return route
+        return None
+
+    def put(self, sid, route):
+        self.drop_sid(sid)
+        self._routes[sid] = route
+        self._session_sids.setdefault(route.session_id, set()).add(sid)
+
+    def drop_sid(self, sid):
+        route = self._routes.pop(sid, None)
+        if route is not None:
+            sids = self._session_sids.get(route.session_id)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._session_sids[route.session_id]
+
+    def drop_session(self, session_id):
+        for sid in self._session_sids.pop(session_id, ()):
+            self._routes.pop(sid, None)
+
+    def __len__(self):
+        return len(self._routes)
+
+
+def is_candidate(signal):
+    """True for trickle ICE candidates, False for offers, answers and the rest"""
+    return isinstance(signal, dict) and (signal.get('type') == 'candidate' or 'candidate' in signal)
+
+
+class SignalCoalescer:
+    """Batches trickle ICE candidates into one webrtc_signal_batch per window
+
+    Candidates from one user in one session are held for up to `window`
+    seconds (or until max_batch of them are waiting) and then sent to the
+    partner as a single event, instead of one Socket.IO packet each. Any
+    other signal (offer, answer) first flushes the pending candidates and
+    is then sent on its own right away, so ordering is preserved. A flush
+    with a single candidate goes out as a plain webrtc_signal.
+
+    emit(event, payload, room) sends an event; spawn_after(seconds, fn,
+    *args) schedules a flush and returns something with cancel(), e.g.
+    eventlet.spawn_after.
+    """
+
+    def __init__(self, emit, spawn_after, window=0.005, max_batch=16, on_batch=None):
+        self.emit = emit
+        self.spawn_after = spawn_after
+        self.window = window
+        self.max_batch = max_batch
+        self.on_batch = on_batch  # Called with the size of every flush
+        self._pending = {}  # (session_id, user_id) -> [route, [data, ...], timer]
+
+    def relay(self, route, data):
+        """Send or buffer one signal payload (a dict with 'signal' and 'from')"""
+        key = (route.session_id, route.user_id)
+        if not is_candidate(data.get('signal')):
+            self.flush(key)
+            self.emit('webrtc_signal', data, route.partner_id)
+            return
+
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [route, [], None]
+            entry[2] = self.spawn_after(self.window, self.flush, key)
+        entry[1].append(data)
+        if len(entry[1]) >= self.max_batch:
+            self.flush(key)
+
+    def flush(self, key):
+        """Send whatever is buffered for key"""
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return
+        route, batch, timer = entry
+        if timer is not None:
+            timer.cancel()
+        if not route.chat_session.is_active:
+            return  # Session ended while the candidates were buffered
+        if self.on_batch is not None:
+            self.on_batch(len(batch))
+        if len(batch) == 1:
+            self.emit('webrtc_signal', batch[0], route.partner_id)
+            return
+        self.emit('webrtc_signal_batch', {
+            'session_id': route.session_id,
+            'from': route.user_id,
+            'signals': [data['signal'] for data in batch]
+        }, route.partner_id)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class _TypingState:
+    __slots__ = ('route', 'wanted', 'sent', 'sent_at', 'typing_until', 'flush_timer', 'expiry_timer')
+
+    def __init__(self, route):
+        self.route = route
+        self.wanted = False  # Latest state the user reported
+        self.sent = False  # State the partner last saw
+        self.sent_at = float('-inf')
+        self.typing_until = 0.0
+        self.flush_timer = None
+        self.expiry_timer = None
+
+
+class TypingThrottle:
+    """Forwards typing indicators only when they change, at a bounded rate
+
+    Per user and session:
+      - repeats of the state the partner already sees are dropped
+        ('duplicate'), a repeated "typing" only extends its expiry
+      - state changes are sent at most once every min_interval seconds;
+        changes inside the interval are folded into one trailing send
+        carrying the latest state ('throttled')
+      - "typing" turns into "not typing" by itself after `expiry` seconds
+        without a new "typing" event, so a client that never sends false
+        does not leave the indicator stuck
+
+    emit(route, is_typing) sends the indicator to the partner;
+    spawn_after(seconds, fn, *args) schedules a timer with cancel().
+    on_suppressed(reason) and on_expired() feed the metrics.
+    """
+
+    def __init__(self, emit, spawn_after, min_interval=0.5, expiry=5.0, clock=time.monotonic,
+                 on_suppressed=None, on_expired=None):
+        self.emit = emit
+        self.spawn_after = spawn_after
+        self.min_interval = min_interval
+        self.expiry = expiry
+        self.clock = clock
+        self.on_suppressed = on_suppressed
+        self.on_expired = on_expired
+        self._states = {}  # (session_id, user_id) -> _TypingState
+
+    def update(self, route, is_typing):
+        """Handle one user_typing event"""
+        key = (route.session_id, route.user_id)
+        now = self.clock()
+        state = self._states.get(key)
+        if state is None:
+            if not is_typing:
+                return self._suppressed('duplicate')
+            state = self._states[key] = _TypingState(route)
+        if is_typing:
+            state.typing_until = now + self.expiry
+        if is_typing == state.wanted:
+            return self._suppressed('duplicate')
+        state.wanted = is_typing
+        if state.flush_timer is not None:
+            # A trailing send is already scheduled and will carry this state
+            return self._suppressed('throttled')
+        self._send_or_schedule(key, state, now)
+
+    def _suppressed(self, reason):
+        if self.on_suppressed is not None:
+            self.on_suppressed(reason)
+
+    def _send_or_schedule(self, key, state, now):
+        wait = state.sent_at + self.min_interval - now
+        if wait > 0:
+            state.flush_timer = self.spawn_after(wait, self._flush, key)
+        else:
+            self._deliver(key, state, now)
+
+    def _flush(self, key):
+        state = self._states.get(key)
+        if state is not None:
+            state.flush_timer = None
+            self._deliver(key, state, self.clock())
+
+    def _deliver(self, key, state, now):
+        if not state.route.chat_session.is_active:
+            self._drop(key)
+            return
+        if state.wanted != state.sent:
+            self.emit(state.route, state.wanted)
+            state.sent = state.wanted
+            state.sent_at = now
+        if state.sent and state.expiry_timer is None:
+            state.expiry_timer = self.spawn_after(max(0.0, state.typing_until - now), self._expire, key)
+
+    def _expire(self, key):
+        state = self._states.get(key)
+        if state is None:
+            return
+        now = self.clock()
+        state.expiry_timer = None
+        if state.wanted and now < state.typing_until:
+            # Typing was refreshed since the timer was set
+            state.expiry_timer = self.spawn_after(state.typing_until - now, self._expire, key)
+            return
+        if state.wanted:
+            state.wanted = False
+            if self.on_expired is not None:
+                self.on_expired()
+        if state.flush_timer is None:
+            self._send_or_schedule(key, state, now)
+
+    def _drop(self, key):
+        state = self._states.pop(key, None)
+        if state is not None:
+            for timer in (state.flush_timer, state.expiry_timer):
+                if timer is not None:
+                    timer.cancel()
+
+    def drop_session(self, chat_session):
+        """Forget both users' typing state when their session ends"""
+        for user_id in (chat_session.user1_id, chat_session.user2_id):
+            self._drop((chat_session.session_id, user_id))
+
+    def __len__(self):
+        return len(self._states)
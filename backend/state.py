@@ -0,0 +1,673 @@
+import json
+import threading
+import time
+import uuid
+
+from matchmaking import TagMatchQueue
+from message_log import Message, format_timestamp
+
+CHAT_TYPES = ('video', 'text')
+
+
+class ShardedSessionTable:
+    """Session table split into independently locked shards
+
+    Sessions are sharded by session_id and the user -> session index by
+    user_id, so lookups and teardown for unrelated users take different
+    locks. create() claims both users atomically: it locks their index
+    shards (in shard order, to avoid deadlock) and fails if either user is
+    already in a session, which keeps a user from ever being in two.
+    """
+
+    def __init__(self, shards=16):
+        self._sessions = [{} for _ in range(shards)]
+        self._session_locks = [threading.Lock() for _ in range(shards)]
+        self._users = [{} for _ in range(shards)]
+        self._user_locks = [threading.Lock() for _ in range(shards)]
+        self._shards = shards
+
+    def _shard(self, key):
+        return hash(key) % self._shards
+
+    def create(self, chat_session):
+        """Insert a session and claim both users, returns False if either is taken"""
+        session_id = chat_session.session_id
+        users = (chat_session.user1_id, chat_session.user2_id)
+        if users[0] == users[1]:
+            return False
+        user_shards = sorted({self._shard(user_id) for user_id in users})
+        locks = [self._user_locks[i] for i in user_shards]
+        for lock in locks:
+            lock.acquire()
+        try:
+            if any(user_id in self._users[self._shard(user_id)] for user_id in users):
+                return False
+            # Publish the session while the users are still locked, so it
+            # is never visible without both users pointing at it
+            shard = self._shard(session_id)
+            with self._session_locks[shard]:
+                self._sessions[shard][session_id] = chat_session
+            for user_id in users:
+                self._users[self._shard(user_id)][user_id] = session_id
+            return True
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def get(self, session_id):
+        return self._sessions[self._shard(session_id)].get(session_id)
+
+    def get_user_session(self, user_id):
+        return self._users[self._shard(user_id)].get(user_id)
+
+    def remove(self, session_id):
+        shard = self._shard(session_id)
+        with self._session_locks[shard]:
+            chat_session = self._sessions[shard].pop(session_id, None)
+        if chat_session:
+            for user_id in (chat_session.user1_id, chat_session.user2_id):
+                user_shard = self._shard(user_id)
+                with self._user_locks[user_shard]:
+                    # Only unlink users that still point at this session
+                    if self._users[user_shard].get(user_id) == session_id:
+                        del self._users[user_shard][user_id]
+        return chat_session
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._sessions)
+
+    def session_ids(self):
+        return [session_id for shard in self._sessions for session_id in list(shard)]
+
+    def sessions(self):
+        return [chat_session for shard in self._sessions for chat_session in list(shard.values())]
+
+    def user_items(self):
+        return {user_id: session_id for shard in self._users for user_id, session_id in list(shard.items())}
+
+
+class InMemoryStateBackend:
+    """Process-local state, the default for a single worker
+
+    Single dict and set operations are atomic, so presence sets and the
+    socket map need no locks. Waiting rooms are TagMatchQueues guarded by
+    UserManager's per-chat-type queue locks; sessions live in a
+    ShardedSessionTable. new_session_id() mints session ids, uuid4 by
+    default (sharded workers mint ids that hash to themselves).
+    """
+
+    def __init__(self, session_factory, session_shards=16, relax_after=10.0, new_session_id=None):
+        self.session_factory = session_factory
+        self.new_session_id = new_session_id or (lambda: str(uuid.uuid4()))
+        self.waiting_rooms = {chat_type: TagMatchQueue(relax_after) for chat_type in CHAT_TYPES}
+        self.sessions = ShardedSessionTable(session_shards)
+        self.sets = {'active_users': set(), 'connected_users': set()}
+        self.maps = {'socket_user_map': {}, 'user_socket_map': {}}
+
+    # Presence sets
+    def add_member(self, name, member):
+        self.sets[name].add(member)
+
+    def discard_member(self, name, member):
+        self.sets[name].discard(member)
+
+    def has_member(self, name, member):
+        return member in self.sets[name]
+
+    def count_members(self, name):
+        return len(self.sets[name])
+
+    def members(self, name):
+        return list(self.sets[name])
+
+    # Lookup tables
+    def map_set(self, name, key, value):
+        self.maps[name][key] = value
+
+    def map_get(self, name, key):
+        return self.maps[name].get(key)
+
+    def map_pop(self, name, key):
+        return self.maps[name].pop(key, None)
+
+    def map_swap(self, name, key, value):
+        """Set key to value, returns the previous value"""
+        table = self.maps[name]
+        previous = table.get(key)
+        table[key] = value
+        return previous
+
+    def map_pop_if(self, name, key, expected):
+        """Delete key only if it is still set to expected, returns True if deleted"""
+        table = self.maps[name]
+        if table.get(key) != expected:
+            return False
+        del table[key]
+        return True
+
+    def map_items(self, name):
+        return dict(self.maps[name])
+
+    # Waiting rooms, callers hold the queue lock for chat_type
+    def enqueue_waiting(self, chat_type, user_id, tags=None):
+        return self.waiting_rooms[chat_type].enqueue(user_id, tags)
+
+    def pop_waiting_partner(self, chat_type, exclude_user_id=None, tags=None):
+        return self.waiting_rooms[chat_type].dequeue(exclude_user_id, tags)
+
+    def requeue_waiting(self, chat_type, user_id):
+        """Put back a partner just popped by pop_waiting_partner"""
+        self.waiting_rooms[chat_type].requeue_front(user_id)
+
+    def cancel_waiting(self, chat_type, user_id):
+        return self.waiting_rooms[chat_type].cancel(user_id)
+
+    def is_waiting(self, chat_type, user_id):
+        return user_id in self.waiting_rooms[chat_type]
+
+    def waiting_tags(self, chat_type, user_id):
+        return self.waiting_rooms[chat_type].tags_of(user_id)
+
+    def waiting_count(self, chat_type):
+        return len(self.waiting_rooms[chat_type])
+
+    def waiting_snapshot(self, chat_type):
+        return self.waiting_rooms[chat_type].snapshot()
+
+    def match_waiting_pairs(self, chat_type, max_pairs):
+        """Pair waiting users by shared tags (FIFO without tags) and create their sessions"""
+        room = self.waiting_rooms[chat_type]
+        sessions = []
+        while len(sessions) < max_pairs:
+            pair = room.pop_pair()
+            if pair is None:
+                break
+            # The user who waited longest is the initiator
+            chat_session = self.create_session(pair[0], pair[1], chat_type)
+            if chat_session:
+                sessions.append(chat_session)
+                continue
+            # One of them was matched elsewhere (e.g. /start_video) since
+            # enqueueing, the other one keeps waiting
+            for user_id in pair:
+                if not self.sessions.get_user_session(user_id):
+                    room.requeue_front(user_id)
+        return sessions
+
+    # Sessions
+    def create_session(self, user1_id, user2_id, chat_type, session_id=None, initiator_id=None):
+        """Create a session, or return None if either user is already in one"""
+        chat_session = self.session_factory(session_id or self.new_session_id(), user1_id, user2_id, chat_type,
+                                            initiator_id)
+        if not self.sessions.create(chat_session):
+            return None
+        self.sets['connected_users'].add(user1_id)
+        self.sets['connected_users'].add(user2_id)
+        return chat_session
+
+    def get_session(self, session_id):
+        return self.sessions.get(session_id)
+
+    def get_user_session(self, user_id):
+        return self.sessions.get_user_session(user_id)
+
+    def user_session_items(self):
+        return self.sessions.user_items()
+
+    def remove_session(self, session_id):
+        return self.sessions.remove(session_id)
+
+    def session_count(self):
+        return len(self.sessions)
+
+    def counts(self):
+        """Presence, waiting and session counts, all O(1) size lookups"""
+        counts = {name: len(members) for name, members in self.sets.items()}
+        counts.update(('waiting_' + chat_type, len(room)) for chat_type, room in self.waiting_rooms.items())
+        counts['active_sessions'] = len(self.sessions)
+        return counts
+
+    def session_ids(self):
+        return self.sessions.session_ids()
+
+    def local_sessions(self):
+        """Sessions whose ChatSession object lives in this process"""
+        return self.sessions.sessions()
+
+
+# Enqueue with a monotonically increasing score so the sorted set is FIFO
+ENQUEUE_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local seq = redis.call('INCR', KEYS[2])
+return redis.call('ZADD', KEYS[1], seq, ARGV[1])
+"""
+
+# Pop the oldest waiting user that is not ARGV[1]; only the first two
+# entries ever need to be looked at
+POP_PARTNER_SCRIPT = """
+local head = redis.call('ZRANGE', KEYS[1], 0, 1)
+for _, user_id in ipairs(head) do
+    if user_id ~= ARGV[1] then
+        redis.call('ZREM', KEYS[1], user_id)
+        return user_id
+    end
+end
+return false
+"""
+
+# Put ARGV[1] back ahead of everyone waiting, unless it is queued already
+REQUEUE_FRONT_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+local score = 0
+if head[2] then
+    score = tonumber(head[2]) - 1
+end
+return redis.call('ZADD', KEYS[1], score, ARGV[1])
+"""
+
+# Drain up to ARGV[1] pairs from the waiting room and write their session
+# records in the same atomic step, so two workers can never match the same
+# user. Session IDs are minted by the caller and passed from ARGV[3] on,
+# the keys of their records from KEYS[5] on.
+MATCH_PAIRS_SCRIPT = """
+local max_pairs = tonumber(ARGV[1])
+local chat_type = ARGV[2]
+local result = {}
+local made = 0
+local pending, pending_score
+while made < max_pairs do
+    local popped = redis.call('ZPOPMIN', KEYS[1])
+    if #popped == 0 then
+        break
+    end
+    local user_id, score = popped[1], popped[2]
+    if redis.call('HEXISTS', KEYS[2], user_id) == 0 then
+        if not pending then
+            pending, pending_score = user_id, score
+        else
+            made = made + 1
+            local session_id = ARGV[2 + made]
+            redis.call('HSET', KEYS[4 + made],
+                'user1_id', pending, 'user2_id', user_id, 'chat_type', chat_type, 'initiator_id', pending)
+            redis.call('SADD', KEYS[3], session_id)
+            redis.call('HSET', KEYS[2], pending, session_id, user_id, session_id)
+            redis.call('SADD', KEYS[4], pending, user_id)
+            table.insert(result, session_id)
+            table.insert(result, pending)
+            table.insert(result, user_id)
+            pending = nil
+        end
+    end
+end
+if pending then
+    redis.call('ZADD', KEYS[1], pending_score, pending)
+end
+return result
+"""
+
+# Create a session only if neither user is already in one (and they are
+# not the same user). KEYS[4] is the session record
+CREATE_SESSION_SCRIPT = """
+if ARGV[2] == ARGV[3] or redis.call('HEXISTS', KEYS[2], ARGV[2]) == 1
+        or redis.call('HEXISTS', KEYS[2], ARGV[3]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[4], 'user1_id', ARGV[2], 'user2_id', ARGV[3], 'chat_type', ARGV[4],
+    'initiator_id', ARGV[5])
+redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[1], ARGV[3], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[2], ARGV[3])
+return 1
+"""
+
+# Delete a hash field only if it still holds ARGV[2]
+POP_IF_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# Delete the session record KEYS[3] and its messages KEYS[4], unlink its
+# users (only those that still point at this session) and tell the other
+# workers on channel ARGV[2]
+REMOVE_SESSION_SCRIPT = """
+local record = redis.call('HMGET', KEYS[3], 'user1_id', 'user2_id', 'chat_type', 'initiator_id')
+if not record[1] then
+    return false
+end
+redis.call('DEL', KEYS[3], KEYS[4])
+redis.call('PUBLISH', ARGV[2], 'removed:' .. ARGV[1])
+redis.call('SREM', KEYS[1], ARGV[1])
+for i = 1, 2 do
+    if redis.call('HGET', KEYS[2], record[i]) == ARGV[1] then
+        redis.call('HDEL', KEYS[2], record[i])
+    end
+end
+return record
+"""
+
+# Number a message with the session record KEYS[1]'s last_seq, append it to
+# the list KEYS[2] keeping the newest ARGV[2] and publish ARGV[4] on channel
+# ARGV[3]. Returns 0 if the session has ended
+APPEND_MESSAGE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local seq = redis.call('HINCRBY', KEYS[1], 'last_seq', 1)
+redis.call('RPUSH', KEYS[2], seq .. ':' .. ARGV[1])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('PUBLISH', ARGV[3], ARGV[4])
+return seq
+"""
+
+# last_seq of the session record KEYS[1], then the messages of KEYS[2]
+# numbered above ARGV[1]; the list holds consecutive numbers ending at
+# last_seq, so they are its last last_seq - ARGV[1] entries
+MESSAGES_SINCE_SCRIPT = """
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_seq') or '0')
+local count = last - tonumber(ARGV[1])
+local messages = {}
+if count > 0 then
+    messages = redis.call('LRANGE', KEYS[2], -count, -1)
+end
+table.insert(messages, 1, tostring(last))
+return messages
+"""
+
+
+class RedisMessageLog:
+    """A session's message log kept in Redis, shared by every worker
+
+    Same interface as message_log.MessageLog. The newest `capacity`
+    messages are a list of '<seq>:<JSON [sender, text, ts]>' entries,
+    numbered by the session record's last_seq. Appending publishes a
+    'message:<session_id>' event, which wakes the long-polls other
+    workers have parked on the session.
+    """
+
+    __slots__ = ('capacity', '_backend', '_session_id', '_keys')
+
+    def __init__(self, backend, session_id, capacity):
+        self.capacity = capacity
+        self._backend = backend
+        self._session_id = session_id
+        self._keys = [backend._key('session', session_id), backend._key('messages', session_id)]
+
+    @property
+    def last_seq(self):
+        return int(self._backend.client.hget(self._keys[0], 'last_seq') or 0)
+
+    @property
+    def first_seq(self):
+        return max(1, self.last_seq - self.capacity + 1)
+
+    def append(self, sender, text, ts):
+        """Store a message under the next sequence number"""
+        backend = self._backend
+        seq = backend._append_message(keys=self._keys, args=[
+            json.dumps([sender, text, ts]), self.capacity,
+            backend.events_channel, 'message:' + self._session_id
+        ])
+        if not seq:
+            raise LookupError(f"Session {self._session_id} has ended")
+        return Message(seq, sender, text, ts)
+
+    def since_seq(self, seq):
+        """Messages with a sequence number greater than seq"""
+        entries = self._backend._messages_since(keys=self._keys, args=[max(seq, 0)])
+        messages = []
+        for entry in entries[1:]:
+            number, _, payload = entry.partition(':')
+            messages.append(Message(int(number), *json.loads(payload)))
+        return messages
+
+    def since_timestamp(self, timestamp):
+        """Messages with an ISO timestamp later than the given one"""
+        return [msg for msg in self.since_seq(0) if format_timestamp(msg.ts) > timestamp]
+
+    def __len__(self):
+        return self._backend.client.llen(self._keys[1])
+
+    def __iter__(self):
+        return iter(self.since_seq(0))
+
+
+class RedisStateBackend:
+    """Shared state in Redis so several workers can match each other's users
+
+    Waiting rooms are sorted sets scored by enqueue order, lookup tables are
+    hashes and presence is kept in sets. Matching and session creation and
+    teardown run as Lua scripts so they are atomic across workers. Scripts
+    get every key they touch through KEYS; on Redis Cluster, a prefix with
+    a hash tag ('{vc}:') puts them all in one slot.
+    Waiting rooms are plain FIFO: interest tags are only matched on by the
+    in-memory backend.
+
+    Session records (users, chat type, initiator) and their messages
+    (RedisMessageLog) are shared. Each worker caches the ChatSession
+    objects it has looked up, for their long-poll waiters; listen()
+    subscribes to the events channel, waking those waiters when a message
+    is appended on another worker and evicting sessions another worker
+    removed. Run it as a background task in every worker.
+    """
+
+    def __init__(self, client, session_factory, prefix='vc:'):
+        self.client = client
+        self.session_factory = session_factory
+        self.prefix = prefix
+        self._local_sessions = {}  # session_id -> ChatSession cached in this process
+        self._enqueue = client.register_script(ENQUEUE_SCRIPT)
+        self._pop_partner = client.register_script(POP_PARTNER_SCRIPT)
+        self._match_pairs = client.register_script(MATCH_PAIRS_SCRIPT)
+        self._create_session = client.register_script(CREATE_SESSION_SCRIPT)
+        self._remove_session = client.register_script(REMOVE_SESSION_SCRIPT)
+        self._pop_if = client.register_script(POP_IF_SCRIPT)
+        self._requeue_front = client.register_script(REQUEUE_FRONT_SCRIPT)
+        self._append_message = client.register_script(APPEND_MESSAGE_SCRIPT)
+        self._messages_since = client.register_script(MESSAGES_SINCE_SCRIPT)
+        self.events_channel = self._key('session_events')
+
+    @classmethod
+    def from_url(cls, url, session_factory, prefix='vc:'):
+        import redis
+        return cls(redis.Redis.from_url(url, decode_responses=True), session_factory, prefix)
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(parts)
+
+    # Presence sets
+    def add_member(self, name, member):
+        self.client.sadd(self._key(name), member)
+
+    def discard_member(self, name, member):
+        self.client.srem(self._key(name), member)
+
+    def has_member(self, name, member):
+        return bool(self.client.sismember(self._key(name), member))
+
+    def count_members(self, name):
+        return self.client.scard(self._key(name))
+
+    def members(self, name):
+        return list(self.client.smembers(self._key(name)))
+
+    # Lookup tables
+    def map_set(self, name, key, value):
+        self.client.hset(self._key(name), key, value)
+
+    def map_get(self, name, key):
+        return self.client.hget(self._key(name), key)
+
+    def map_pop(self, name, key):
+        pipe = self.client.pipeline()
+        pipe.hget(self._key(name), key)
+        pipe.hdel(self._key(name), key)
+        value, _ = pipe.execute()
+        return value
+
+    def map_swap(self, name, key, value):
+        pipe = self.client.pipeline()  # MULTI/EXEC, so nothing runs in between
+        pipe.hget(self._key(name), key)
+        pipe.hset(self._key(name), key, value)
+        previous, _ = pipe.execute()
+        return previous
+
+    def map_pop_if(self, name, key, expected):
+        return bool(self._pop_if(keys=[self._key(name)], args=[key, expected]))
+
+    def map_items(self, name):
+        return self.client.hgetall(self._key(name))
+
+    # Waiting rooms, FIFO only: interest tags are accepted and ignored
+    def enqueue_waiting(self, chat_type, user_id, tags=None):
+        keys = [self._key('waiting', chat_type), self._key('waiting_seq')]
+        return bool(self._enqueue(keys=keys, args=[user_id]))
+
+    def pop_waiting_partner(self, chat_type, exclude_user_id=None, tags=None):
+        partner = self._pop_partner(keys=[self._key('waiting', chat_type)],
+                                    args=[exclude_user_id or ''])
+        return partner or None
+
+    def requeue_waiting(self, chat_type, user_id):
+        """Put back a partner just popped by pop_waiting_partner, at the front"""
+        self._requeue_front(keys=[self._key('waiting', chat_type)], args=[user_id])
+
+    def cancel_waiting(self, chat_type, user_id):
+        return bool(self.client.zrem(self._key('waiting', chat_type), user_id))
+
+    def is_waiting(self, chat_type, user_id):
+        return self.client.zscore(self._key('waiting', chat_type), user_id) is not None
+
+    def waiting_tags(self, chat_type, user_id):
+        return None  # Redis waiting rooms do not keep tags
+
+    def waiting_count(self, chat_type):
+        return self.client.zcard(self._key('waiting', chat_type))
+
+    def waiting_snapshot(self, chat_type):
+        return self.client.zrange(self._key('waiting', chat_type), 0, -1)
+
+    def match_waiting_pairs(self, chat_type, max_pairs):
+        """Pair waiting users in FIFO order and create their sessions"""
+        # Mint enough IDs for the whole batch up front, but cap the round
+        # trip size by what is actually waiting
+        max_pairs = min(max_pairs, self.waiting_count(chat_type) // 2)
+        if max_pairs <= 0:
+            return []
+        session_ids = [str(uuid.uuid4()) for _ in range(max_pairs)]
+        keys = [
+            self._key('waiting', chat_type),
+            self._key('user_sessions'),
+            self._key('sessions'),
+            self._key('connected_users')
+        ] + [self._key('session', session_id) for session_id in session_ids]
+        flat = self._match_pairs(keys=keys, args=[max_pairs, chat_type] + session_ids)
+        sessions = []
+        for i in range(0, len(flat), 3):
+            sessions.append(self._adopt(self.session_factory(flat[i], flat[i + 1], flat[i + 2], chat_type)))
+        return sessions
+
+    # Sessions
+    def create_session(self, user1_id, user2_id, chat_type, session_id=None, initiator_id=None):
+        """Create a session, or return None if either user is already in one"""
+        chat_session = self.session_factory(session_id or str(uuid.uuid4()), user1_id, user2_id, chat_type,
+                                            initiator_id)
+        session_id = chat_session.session_id
+        keys = [self._key('sessions'), self._key('user_sessions'), self._key('connected_users'),
+                self._key('session', session_id)]
+        args = [session_id, user1_id, user2_id, chat_type, chat_session.initiator_id]
+        if not self._create_session(keys=keys, args=args):
+            return None
+        return self._adopt(chat_session)
+
+    def get_session(self, session_id):
+        record = self.client.hgetall(self._key('session', session_id))
+        if not record:
+            # Ended on another worker
+            self._local_sessions.pop(session_id, None)
+            return None
+        chat_session = self._local_sessions.get(session_id)
+        if chat_session is None:
+            chat_session = self._adopt(self.session_factory(session_id, record['user1_id'], record['user2_id'],
+                                                            record['chat_type'], record.get('initiator_id')))
+        return chat_session
+
+    def _adopt(self, chat_session):
+        """Give a new ChatSession the shared message log and cache it"""
+        chat_session.messages = RedisMessageLog(self, chat_session.session_id, chat_session.messages.capacity)
+        self._local_sessions[chat_session.session_id] = chat_session
+        return chat_session
+
+    def get_user_session(self, user_id):
+        return self.client.hget(self._key('user_sessions'), user_id)
+
+    def user_session_items(self):
+        return self.client.hgetall(self._key('user_sessions'))
+
+    def remove_session(self, session_id):
+        record = self._remove_session(keys=[self._key('sessions'), self._key('user_sessions'),
+                                            self._key('session', session_id), self._key('messages', session_id)],
+                                      args=[session_id, self.events_channel])
+        chat_session = self._local_sessions.pop(session_id, None)
+        if not record:
+            return None
+        if chat_session is None:
+            chat_session = self.session_factory(session_id, record[0], record[1], record[2], record[3])
+        return chat_session
+
+    def listen(self, dispatch=None, retry_after=1.0):
+        """Apply other workers' session events to the cached sessions, forever
+
+        dispatch(fn, *args) runs each update where the sessions live, e.g.
+        loop.call_soon_threadsafe when this runs on a thread; by default
+        updates run right here. Reconnects after retry_after seconds if the
+        connection drops; events sent in the meantime are lost, sessions
+        removed then are still evicted by the next get_session.
+        """
+        import redis
+        dispatch = dispatch or (lambda fn, *args: fn(*args))
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.events_channel)
+                for event in pubsub.listen():
+                    kind, _, session_id = event['data'].partition(':')
+                    dispatch(self.apply_event, kind, session_id)
+            except redis.ConnectionError:
+                time.sleep(retry_after)
+
+    def apply_event(self, kind, session_id):
+        """Wake the long-polls of a cached session, or close and drop it"""
+        if kind == 'removed':
+            chat_session = self._local_sessions.pop(session_id, None)
+            if chat_session is not None:
+                chat_session.close()
+        elif kind == 'message':
+            chat_session = self._local_sessions.get(session_id)
+            if chat_session is not None:
+                chat_session.notify()
+
+    def session_count(self):
+        return self.client.scard(self._key('sessions'))
+
+    def counts(self):
+        """Presence, waiting and session counts in one round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.scard(self._key('active_users'))
+        pipe.scard(self._key('connected_users'))
+        for chat_type in CHAT_TYPES:
+            pipe.zcard(self._key('waiting', chat_type))
+        pipe.scard(self._key('sessions'))
+        results = pipe.execute()
+        names = ['active_users', 'connected_users'] + ['waiting_' + chat_type for chat_type in CHAT_TYPES]
+        names.append('active_sessions')
+        return dict(zip(names, results))
+
+    def session_ids(self):
+        return list(self.client.smembers(self._key('sessions')))
@@ -0,0 +1,73 @@
+"""Run the eventlet backend as one sharded worker process per core
+
+Usage: python supervisor.py [--workers N] [--host HOST] [--port PORT]
+
+Starts N copies of app.py (default: one per CPU), all accepting on the
+same port through SO_REUSEPORT, with SHARD_INDEX/SHARD_COUNT/SHARD_DIR set
+so each owns a slice of the user and session ids (see sharding.py). Workers
+that exit are restarted; SIGINT or SIGTERM stops them all. Every other
+setting is passed on through the environment; SECRET_KEY is generated once
+here if unset, since resume tokens must verify on every worker.
+"""
+import argparse
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from logging_setup import configure_logging
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_CODE = 'import sys, app; app.run_shard_worker(sys.argv[1], int(sys.argv[2]))'
+
+logger = logging.getLogger('app.supervisor')
+
+
+def start_worker(index, count, socket_dir, host, port):
+    env = dict(os.environ, SHARD_INDEX=str(index), SHARD_COUNT=str(count), SHARD_DIR=socket_dir)
+    return subprocess.Popen([sys.executable, '-c', WORKER_CODE, host, str(port)], cwd=BACKEND_DIR, env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+    configure_logging()
+    os.environ.setdefault('SECRET_KEY', os.urandom(32).hex())
+
+    # mkdtemp creates the directory 0700, nobody else can reach the bus
+    socket_dir = tempfile.mkdtemp(prefix='videochat-shards-')
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    workers = [start_worker(i, args.workers, socket_dir, args.host, args.port) for i in range(args.workers)]
+    logger.info("Started %s workers on %s:%s", args.workers, args.host, args.port)
+    try:
+        while not stopping:
+            time.sleep(0.5)
+            for index, worker in enumerate(workers):
+                if worker.poll() is not None and not stopping:
+                    logger.error("Worker %s exited with %s, restarting", index, worker.returncode)
+                    workers[index] = start_worker(index, args.workers, socket_dir, args.host, args.port)
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+        logger.info("Stopped %s workers", len(workers))
+
+
+if __name__ == '__main__':
+    main()
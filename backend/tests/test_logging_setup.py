@@ -0,0 +1,22 @@
+import logging
+import queue
+
+from logging_setup import DeferredQueueHandler, parse_levels
+
+
+def test_message_is_formatted_before_it_is_queued():
+    records = queue.SimpleQueue()
+    logger = logging.getLogger('test.deferred')
+    logger.propagate = False
+    logger.addHandler(DeferredQueueHandler(records))
+    data = {'type': 'offer'}
+    logger.warning("signal %s", data)
+    data['type'] = 'changed'  # The caller reuses its payload right away
+    record = records.get_nowait()
+    assert record.getMessage() == "signal {'type': 'offer'}"
+    assert record.args is None
+
+
+def test_parse_levels_maps_subsystems():
+    assert parse_levels('transport=info, custom.logger=DEBUG') == {
+        'app.transport': 'INFO', 'custom.logger': 'DEBUG'}
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+from message_log import MessageLog, format_timestamp
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_timestamps_never_decrease_when_the_clock_goes_back():
+    log = MessageLog(capacity=10)
+    log.append('you', 'one', 1760648065.0)
+    log.append('stranger', 'two', 1760648070.0)
+    # Wall clock stepped back five seconds
+    third = log.append('you', 'three', 1760648066.0)
+    assert third.ts == 1760648070.0
+    later = log.since_timestamp(format_timestamp(1760648065.0))
+    assert [msg.text for msg in later] == ['two', 'three']
+
+
+def test_since_seq_and_timestamp_after_wrapping():
+    log = MessageLog(capacity=3)
+    for seq in range(1, 6):
+        log.append('you', f'message {seq}', 1760648065.0 + seq)
+    assert len(log) == 3
+    assert [msg.seq for msg in log.since_seq(0)] == [3, 4, 5]
+    assert [msg.seq for msg in log.since_timestamp(format_timestamp(1760648068.0))] == [4, 5]
+
+
+def test_zero_capacity_is_rejected_at_startup():
+    env = dict(os.environ, MESSAGE_LOG_CAP='0')
+    result = subprocess.run([sys.executable, '-c', 'import core'], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True)
+    assert result.returncode != 0
+    assert 'MESSAGE_LOG_CAP must be at least 1' in result.stderr
@@ -0,0 +1,24 @@
+from ratelimit import Quota, TokenBucketLimiter, forwarded_client, parse_quotas
+
+
+def test_forwarded_client_takes_the_address_hops_back():
+    assert forwarded_client('10.0.0.2', 'spoofed, 203.0.113.7, 10.0.0.1', 2) == '203.0.113.7'
+    assert forwarded_client('10.0.0.2', '203.0.113.7', 1) == '203.0.113.7'
+
+
+def test_forwarded_client_falls_back_to_the_peer():
+    assert forwarded_client('10.0.0.2', '203.0.113.7', 0) == '10.0.0.2'
+    assert forwarded_client('10.0.0.2', None, 1) == '10.0.0.2'
+    assert forwarded_client('10.0.0.2', '203.0.113.7', 2) == '10.0.0.2'
+
+
+def test_parse_quotas_overrides_and_removes():
+    quotas = parse_quotas('/send.user=5/20,connect.ip=0', {('connect', 'ip'): Quota(10, 30)})
+    assert quotas == {('/send', 'user'): Quota(5, 20)}
+
+
+def test_bucket_refuses_past_the_burst_per_key():
+    limiter = TokenBucketLimiter({('/send', 'user'): Quota(0.001, 2)})
+    assert [limiter.allow('/send', 'user', 'a') for _ in range(3)] == [True, True, False]
+    assert limiter.allow('/send', 'user', 'b')
+    assert limiter.allow('/receive', 'user', 'a')  # No quota for the route
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+socketio = pytest.importorskip('socketio')
+pytest.importorskip('eventlet')
+
+import supervisor
+from sharding import HashRing
+
+WORKERS = 4
+TIMEOUT = 20
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    """WORKERS sharded eventlet workers, yields (port, socket_dir)"""
+    monkeypatch.setenv('SECRET_KEY', 'test-shards')
+    monkeypatch.setenv('LOG_LEVEL', 'WARNING')
+    # Offer unmatched users across workers almost at once
+    monkeypatch.setenv('SHARD_OFFER_AFTER_MS', '50')
+    socket_dir = tempfile.mkdtemp(prefix='videochat-test-shards-')
+    port = free_port()
+    workers = [supervisor.start_worker(i, WORKERS, socket_dir, '127.0.0.1', port) for i in range(WORKERS)]
+    try:
+        deadline = time.monotonic() + TIMEOUT
+        while not all(os.path.exists(os.path.join(socket_dir, f'http-{i}.sock')) for i in range(WORKERS)):
+            assert all(worker.poll() is None for worker in workers), "a worker exited"
+            assert time.monotonic() < deadline, "workers did not start"
+            time.sleep(0.1)
+        yield port, socket_dir
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(10)
+            except Exception:
+                worker.kill()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+class Client:
+    """One user, reached over an explicit aiohttp session"""
+
+    def __init__(self, connector=None):
+        self.http = aiohttp.ClientSession(connector=connector)
+        self.sio = socketio.AsyncClient(reconnection=False, http_session=self.http)
+        self.hello = None
+        self.session_id = None
+        self.got_user_id = asyncio.Event()
+        self.matched = asyncio.Event()
+        self.sio.on('user_id', self.on_user_id)
+        self.sio.on('matched', self.on_matched)
+
+    async def on_user_id(self, data):
+        self.hello = data
+        self.got_user_id.set()
+        return True
+
+    async def on_matched(self, data):
+        self.session_id = data['session_id']
+        self.matched.set()
+        return True
+
+    async def connect(self, url, transport):
+        await self.sio.connect(url, transports=[transport])
+        await asyncio.wait_for(self.got_user_id.wait(), TIMEOUT)
+
+    async def close(self):
+        if self.sio.connected:
+            await self.sio.disconnect()
+        # Else a long-poll still running opens a new HTTP session of its own
+        tasks = [task for task in (self.sio.eio.read_loop_task, self.sio.eio.write_loop_task) if task]
+        if tasks:
+            await asyncio.wait(tasks, timeout=TIMEOUT)
+        await self.http.close()
+
+
+async def pair_and_resume(port, socket_dir):
+    ring = HashRing(range(WORKERS))
+    # One user per worker, connected on its private socket: no worker can
+    # pair its own user, so both sessions have to be made across workers
+    users = []
+    for index in range(WORKERS):
+        client = Client(aiohttp.UnixConnector(path=os.path.join(socket_dir, f'http-{index}.sock')))
+        users.append(client)
+        await client.connect('http://localhost', 'polling')
+        assert ring.lookup(client.hello['user_id']) == index
+    try:
+        for client in users:
+            headers = {'X-Resume-Token': client.hello['resume_token']}
+            async with client.http.post('http://localhost/start_video', headers=headers,
+                                        json={'user_id': client.hello['user_id']}) as response:
+                assert response.status == 200
+        await asyncio.wait_for(asyncio.gather(*(client.matched.wait() for client in users)), TIMEOUT)
+        sessions = {}
+        for client in users:
+            sessions.setdefault(client.session_id, []).append(client.hello['user_id'])
+        assert len(sessions) == WORKERS // 2
+        for pair in sessions.values():
+            assert len(pair) == 2 and ring.lookup(pair[0]) != ring.lookup(pair[1])
+    finally:
+        for client in users:
+            await client.close()
+
+    # Resumes come in on the shared port, whichever worker accepts them
+    for number, previous in enumerate(users):
+        resumed = Client()
+        try:
+            url = f"http://127.0.0.1:{port}/?resume_token={previous.hello['resume_token']}"
+            await resumed.connect(url, 'polling' if number % 2 else 'websocket')
+            assert resumed.hello['resumed'] is True
+            assert resumed.hello['user_id'] == previous.hello['user_id']
+            assert resumed.hello['session_id'] == previous.session_id
+        finally:
+            await resumed.close()
+
+
+def test_cross_shard_pairs_and_resumes(shards):
+    asyncio.run(pair_and_resume(*shards))
@@ -0,0 +1,136 @@
+"""RedisStateBackend against fakeredis with Lua scripting (pip install "fakeredis[lua]")"""
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+
+from core import ChatSession
+from state import RedisStateBackend
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def worker(server, prefix='{vc}:'):
+    """One worker's backend; workers built on the same server share state"""
+    return RedisStateBackend(fakeredis.FakeRedis(server=server, decode_responses=True), ChatSession, prefix)
+
+
+def test_enqueue_is_deduplicated(server):
+    state = worker(server)
+    assert state.enqueue_waiting('video', 'a')
+    assert not state.enqueue_waiting('video', 'a')
+    assert state.waiting_snapshot('video') == ['a']
+
+
+def test_pop_skips_self_and_requeue_goes_to_the_front(server):
+    state = worker(server)
+    for user_id in ('a', 'b', 'c'):
+        state.enqueue_waiting('video', user_id)
+    assert state.pop_waiting_partner('video', exclude_user_id='a') == 'b'
+    state.requeue_waiting('video', 'b')
+    assert state.waiting_snapshot('video') == ['b', 'a', 'c']
+    state.requeue_waiting('video', 'b')  # Already queued, stays where it is
+    assert state.waiting_snapshot('video') == ['b', 'a', 'c']
+
+
+def test_every_key_carries_the_prefix(server):
+    state = worker(server)
+    state.enqueue_waiting('video', 'a')
+    state.create_session('a', 'b', 'text', initiator_id='b')
+    assert all(key.startswith('{vc}:') for key in state.client.keys('*'))
+
+
+def test_create_refuses_users_already_in_a_session(server):
+    state = worker(server)
+    assert state.create_session('a', 'b', 'text') is not None
+    assert state.create_session('b', 'c', 'text') is None
+    assert state.create_session('c', 'c', 'text') is None
+
+
+def test_initiator_survives_another_worker_loading_the_session(server):
+    chat_session = worker(server).create_session('a', 'b', 'video', initiator_id='b')
+    assert worker(server).get_session(chat_session.session_id).initiator_id == 'b'
+
+
+def test_match_pairs_in_fifo_order(server):
+    state = worker(server)
+    for user_id in ('a', 'b', 'c'):
+        state.enqueue_waiting('video', user_id)
+    [chat_session] = state.match_waiting_pairs('video', 10)
+    assert (chat_session.user1_id, chat_session.user2_id, chat_session.initiator_id) == ('a', 'b', 'a')
+    assert state.get_user_session('a') == chat_session.session_id
+    assert state.waiting_snapshot('video') == ['c']
+
+
+def test_pop_if_only_deletes_the_expected_value(server):
+    state = worker(server)
+    state.map_set('user_socket_map', 'a', 'sid1')
+    assert not state.map_pop_if('user_socket_map', 'a', 'sid2')
+    assert state.map_pop_if('user_socket_map', 'a', 'sid1')
+    assert state.map_get('user_socket_map', 'a') is None
+
+
+def test_messages_are_shared_between_workers(server):
+    one, two = worker(server), worker(server)
+    session_id = one.create_session('a', 'b', 'text').session_id
+    one.get_session(session_id).add_message('a', 'hello')
+    two.get_session(session_id).add_message('b', 'hi')
+
+    for state in (one, two):
+        messages = state.get_session(session_id).get_messages()
+        assert [(msg.seq, msg.sender, msg.text) for msg in messages] == [(1, 'you', 'hello'), (2, 'stranger', 'hi')]
+        assert [msg.text for msg in state.get_session(session_id).get_messages(since_seq=1)] == ['hi']
+        assert state.get_session(session_id).messages.last_seq == 2
+
+
+def test_message_log_keeps_the_newest_capacity(server):
+    state = worker(server)
+    chat_session = state.create_session('a', 'b', 'text')
+    capacity = chat_session.messages.capacity
+    for i in range(capacity + 3):
+        chat_session.add_message('a', str(i))
+    messages = chat_session.get_messages(since_seq=0)
+    assert len(messages) == capacity
+    assert messages[0].seq == 4 and messages[-1].seq == capacity + 3
+
+
+def test_remove_evicts_other_workers_copies(server):
+    one, two = worker(server), worker(server)
+    session_id = one.create_session('a', 'b', 'text').session_id
+    cached = two.get_session(session_id)
+    events = two.client.pubsub(ignore_subscribe_messages=True)
+    events.subscribe(two.events_channel)
+
+    removed = one.remove_session(session_id)
+    assert (removed.user1_id, removed.user2_id) == ('a', 'b')
+    assert one.get_user_session('a') is None
+    assert not two.client.exists(two._key('messages', session_id))
+
+    # The first read only consumes the subscribe reply
+    event = events.get_message(timeout=1) or events.get_message(timeout=1)
+    kind, _, event_session_id = event['data'].partition(':')
+    two.apply_event(kind, event_session_id)
+    assert not cached.is_active
+    assert two.get_session(session_id) is None
+    assert one.remove_session(session_id) is None
+
+
+def test_listen_wakes_long_polls_on_other_workers(server):
+    one, two = worker(server), worker(server)
+    session_id = one.create_session('a', 'b', 'text').session_id
+    cached = two.get_session(session_id)
+    woken = threading.Event()
+    cached._update = woken  # What wait_for_update parks on
+    threading.Thread(target=two.listen, daemon=True).start()
+
+    # The subscription may not be in place yet, keep sending until it is
+    for _ in range(50):
+        one.get_session(session_id).add_message('a', 'hello')
+        if woken.wait(0.1):
+            break
+    assert woken.is_set()
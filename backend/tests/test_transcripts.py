@@ -0,0 +1,64 @@
+from transcripts import SegmentTranscriptStore, TranscriptRecord, TranscriptSink
+
+
+def record(seq):
+    return TranscriptRecord('s1', seq, 'u1', f'message {seq}', 1760648065.0 + seq)
+
+
+class RecordingStore:
+    """Store that notes the sink's pending count while a batch is written"""
+
+    def __init__(self, fail=False):
+        self.sink = None
+        self.fail = fail
+        self.records = []
+        self.pending_during_append = []
+
+    def append(self, records):
+        self.pending_during_append.append(self.sink.pending)
+        if self.fail:
+            raise OSError('disk full')
+        self.records.extend(records)
+
+
+def test_pending_counts_the_batch_being_written():
+    store = RecordingStore()
+    sink = store.sink = TranscriptSink(store, max_pending=10, batch_max=4)
+    for seq in range(1, 7):
+        assert sink.offer(record(seq))
+    assert sink.flush() == 4
+    assert store.pending_during_append == [6]
+    assert sink.pending == 2
+
+
+def test_failed_batch_goes_back_to_the_front():
+    store = RecordingStore(fail=True)
+    sink = store.sink = TranscriptSink(store, batch_max=2)
+    for seq in range(1, 4):
+        sink.offer(record(seq))
+    try:
+        sink.flush()
+    except OSError:
+        pass
+    assert sink.pending == 3
+    store.fail = False
+    while sink.flush():
+        pass
+    assert [r.seq for r in store.records] == [1, 2, 3]
+
+
+def test_offer_refuses_past_max_pending():
+    sink = TranscriptSink(RecordingStore(), max_pending=2)
+    assert sink.offer(record(1)) and sink.offer(record(2))
+    assert sink.saturated
+    assert not sink.offer(record(3))
+
+
+def test_segments_roll_over_and_read_back(tmp_path):
+    store = SegmentTranscriptStore(str(tmp_path), segment_bytes=256)
+    store.append([record(seq) for seq in range(1, 11)])
+    store.close()
+    reopened = SegmentTranscriptStore(str(tmp_path), segment_bytes=256)
+    assert len(reopened.segments()) > 1
+    assert [r.seq for r in reopened.read()] == list(range(1, 11))
+    assert reopened.records == 10
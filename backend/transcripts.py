@@ -0,0 +1,231 @@
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import zlib
+from collections import deque, namedtuple
+
+# One persisted chat message; seq is the session's message number
+TranscriptRecord = namedtuple('TranscriptRecord', ('session_id', 'seq', 'user_id', 'text', 'ts'))
+
+# Segment record framing: payload length and CRC-32, then the payload, a
+# JSON array of the TranscriptRecord fields
+_HEADER = struct.Struct('!II')
+SEGMENT_SUFFIX = '.seg'
+
+
+def encode_record(record):
+    """Framed bytes of one record, as appended to a segment"""
+    payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode()
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def scan_segment(path):
+    """Yield (end offset, record) for the intact records of a segment
+
+    The file is mapped read-only rather than read, so scanning a large
+    segment costs page cache, not a copy on the heap. Stops at the first
+    short or corrupt record: only a crash mid-write leaves one, and only
+    at the end of the newest segment.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        offset = 0
+        while offset + _HEADER.size <= size:
+            length, crc = _HEADER.unpack_from(view, offset)
+            start = offset + _HEADER.size
+            end = start + length
+            if end > size:
+                break
+            payload = view[start:end]
+            if zlib.crc32(payload) != crc:
+                break
+            offset = end
+            yield offset, TranscriptRecord(*json.loads(payload))
+
+
+class SegmentTranscriptStore:
+    """Append-only transcript segment files in one directory
+
+    Records are appended to the newest segment until it would grow past
+    segment_bytes, then a new segment is started. Each segment is named
+    after the number of records written before it, so names sort in write
+    order and a record's position is its segment plus its index there.
+    Nothing is rewritten in place; on open, a torn record a crash left at
+    the end of the newest segment is cut off before appending resumes.
+
+    A batch is one write() and, with fsync, one fsync().
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.records = 0  # Records written across every segment
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        if not segments:
+            self._open(0)
+            return
+        last = segments[-1]
+        count, end = 0, 0
+        for end, _ in scan_segment(last):
+            count += 1
+        with open(last, 'r+b') as f:
+            f.truncate(end)
+        self.records = int(os.path.basename(last)[:-len(SEGMENT_SUFFIX)]) + count
+        self._open_path(last)
+
+    def segments(self):
+        """Segment paths, oldest first"""
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _open(self, first_record):
+        self._open_path(os.path.join(self.directory, f'{first_record:020d}{SEGMENT_SUFFIX}'))
+
+    def _open_path(self, path):
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+
+    def _write(self, chunks):
+        if chunks:
+            self._file.write(b''.join(chunks))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def append(self, records):
+        """Write a batch of records, rolling over to new segments as needed"""
+        chunks = []
+        for record in records:
+            data = encode_record(record)
+            if self._size and self._size + len(data) > self.segment_bytes:
+                self._write(chunks)
+                chunks = []
+                self._file.close()
+                self._open(self.records)
+            chunks.append(data)
+            self._size += len(data)
+            self.records += 1
+        self._write(chunks)
+
+    def read(self, session_id=None):
+        """Yield stored records in write order, optionally for one session"""
+        for path in self.segments():
+            for _, record in scan_segment(path):
+                if session_id is None or record.session_id == session_id:
+                    yield record
+
+    def close(self):
+        self._file.close()
+
+
+class SQLiteTranscriptStore:
+    """Transcripts in a SQLite database in WAL mode
+
+    Each batch is one transaction, which in WAL mode is a sequential
+    append to the log; synchronous=NORMAL skips the fsync per commit
+    unless fsync is set. Rows are appended in rowid order and indexed by
+    (session_id, seq) for reading one session back.
+    """
+
+    def __init__(self, path, fsync=False):
+        # Batches are written from a worker thread, one at a time
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=' + ('FULL' if fsync else 'NORMAL'))
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'session_id TEXT NOT NULL, seq INTEGER NOT NULL, user_id TEXT, '
+            'text TEXT NOT NULL, ts REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, seq)')
+        self._db.commit()
+
+    def append(self, records):
+        """Write a batch of records in one transaction"""
+        with self._db:
+            self._db.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)', records)
+
+    def read(self, session_id=None):
+        """Yield stored records in write order, optionally for one session"""
+        if session_id is None:
+            rows = self._db.execute('SELECT * FROM messages ORDER BY rowid')
+        else:
+            rows = self._db.execute('SELECT * FROM messages WHERE session_id = ? ORDER BY seq', (session_id,))
+        for row in rows:
+            yield TranscriptRecord(*row)
+
+    def close(self):
+        self._db.close()
+
+
+class TranscriptSink:
+    """In-memory queue between ChatSession.add_message and a store
+
+    offer() is on the /send path and only appends to a deque. flush()
+    writes up to batch_max queued records as one store.append(); it is
+    meant to run off the event loop (eventlet.tpool, run_in_executor), one
+    call at a time. A batch whose write raises goes back to the front of
+    the queue and the error propagates for the caller to log.
+
+    pending counts queued records and the batch a flush() is writing, so
+    it only reaches 0 once everything offered is in the store. At most
+    max_pending records wait. Callers check saturated and push back (/send
+    answers 503) before accepting a message; offer() refuses records past
+    the limit.
+    """
+
+    def __init__(self, store, max_pending=50000, batch_max=1000):
+        self.store = store
+        self.max_pending = max_pending
+        self.batch_max = batch_max
+        self._pending = deque()
+        self._in_flight = 0  # Records taken by the flush() in progress
+
+    @property
+    def pending(self):
+        return len(self._pending) + self._in_flight
+
+    @property
+    def saturated(self):
+        return self.pending >= self.max_pending
+
+    def offer(self, record):
+        """Queue a record for the writer, False if the queue is full"""
+        if self.pending >= self.max_pending:
+            return False
+        self._pending.append(record)
+        return True
+
+    def flush(self):
+        """Write one batch of queued records, returns how many"""
+        pending = self._pending
+        count = min(len(pending), self.batch_max)
+        if not count:
+            return 0
+        # Counted in flight before leaving the queue, so pending never dips
+        self._in_flight = count
+        batch = [pending.popleft() for _ in range(count)]
+        try:
+            self.store.append(batch)
+        except Exception:
+            pending.extendleft(reversed(batch))
+            raise
+        finally:
+            self._in_flight = 0
+        return count
+
+    def close(self):
+        """Write everything still queued and close the store
+
+        The caller stops its writer first: close() flushes on the calling
+        thread and must not run alongside another flush().
+        """
+        while self.flush():
+            pass
+        self.store.close()
@@ -141,6 +141,12 @@ const VideoChat = () => {
       
       // Register listener BEFORE connecting
       socketService.onUserId(handleUserId);
+      // Keep the signed resume token, the backend keys per-user rate limits on it
+      socketService.on('user_id', (data: any) => {
+        if (data?.resume_token) {
+          sessionStorage.setItem('resume_token', data.resume_token);
+        }
+      });
       
       // Connect to WebSocket AFTER setting up listener
       console.log('Connecting to WebSocket...');
@@ -158,7 +164,12 @@ const VideoChat = () => {
             // Also try to get it via API
             const response = await fetch('http://localhost:8081/start_video', {
               method: 'POST',
-              headers: { 'Content-Type': 'application/json' },
+              headers: {
+                'Content-Type': 'application/json',
+                ...(sessionStorage.getItem('resume_token')
+                  ? { 'X-Resume-Token': sessionStorage.getItem('resume_token') as string }
+                  : {})
+              },
               body: JSON.stringify({ user_id: 'temp' })
             });
             